@@ -3,7 +3,9 @@ from __future__ import (absolute_import, print_function,
 
 from .system import System
 from .electrode import (PolygonPixelElectrode, PointPixelElectrode,
-        CoverElectrode, MeshPixelElectrode, GridElectrode)
+        CoverElectrode, MeshPixelElectrode, GridElectrode,
+        MultiGridElectrode, TaylorElectrode, InstanceElectrode,
+        set_num_threads, get_num_threads)
 from .pattern_constraints import (PotentialObjective, PatternRangeConstraint,
         MultiPotentialObjective)
 from .transformations import euler_from_matrix, euler_matrix
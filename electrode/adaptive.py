@@ -20,11 +20,13 @@
 from __future__ import print_function, division, absolute_import
 
 from functools import partial
+from collections import OrderedDict
 
 import numpy as np
+from scipy.spatial import cKDTree
 
 from .system import System
-from .electrode import PolygonPixelElectrode
+from .electrode import PolygonPixelElectrode, MeshPixelElectrode
 from .utils import area_centroid
 
 from bem.pytriangle import triangulate
@@ -67,9 +69,92 @@ def transformer(transformations):
     return partial(transformed_copy, transformations)
 
 
+def _triangle_key(electrode):
+    """Geometry key of an electrode for `_AdaptiveSystem`.
+
+    Polygon electrodes are identified by their vertex coordinates and
+    cover parameters, all others by identity."""
+    if type(electrode) is PolygonPixelElectrode:
+        return (electrode.cover_nmax, electrode.cover_height,
+                tuple(np.ascontiguousarray(p, np.double).tobytes()
+                    for p in electrode.paths))
+    return id(electrode)
+
+
+class _AdaptiveSystem(System):
+    """System that evaluates the individual potentials of its electrodes
+    by geometry.
+
+    Electrodes with identical geometry are evaluated once. If
+    `responses` is given, the unit responses are shared with other
+    instances through it and only electrodes whose geometry has not
+    been seen before are evaluated. `responses` maps `(x,
+    derivative)` to a dict from `_triangle_key()` to the individual
+    potential of that electrode.
+
+    If `mesh` is true, the polygon electrodes are evaluated as one
+    `MeshPixelElectrode` where edges shared between triangles are
+    evaluated only once.
+    """
+    def __init__(self, electrodes=[], responses=None, mesh=False,
+            **kwargs):
+        super(_AdaptiveSystem, self).__init__(electrodes, **kwargs)
+        self.responses = responses
+        self.mesh = mesh
+
+    def individual_potential(self, x, derivative=0):
+        x = np.asanyarray(x, dtype=np.double).reshape(-1, 3)
+        if self.responses is None:
+            cache = {}
+        else:
+            cache = self.responses.setdefault((x.shape, x.tobytes(),
+                derivative), {})
+        keys = [_triangle_key(ei) for ei in self]
+        new = OrderedDict()
+        for ei, k in zip(self, keys):
+            if k not in cache:
+                new.setdefault(k, ei)
+        if new:
+            cache.update(zip(new, self._evaluate(list(new.values()), x,
+                derivative)))
+        return np.array([cache[k] for k in keys])
+
+    def _evaluate(self, electrodes, x, derivative):
+        if not self.mesh:
+            return System(electrodes).individual_potential(x, derivative)
+        pot = [None]*len(electrodes)
+        groups = OrderedDict()
+        for i, ei in enumerate(electrodes):
+            if type(ei) is PolygonPixelElectrode:
+                groups.setdefault((ei.cover_nmax, ei.cover_height),
+                        []).append(i)
+        for (cover_nmax, cover_height), idx in groups.items():
+            m = MeshPixelElectrode.from_polygon_system(
+                    [electrodes[i] for i in idx], np.ones(len(idx)),
+                    cover_nmax=cover_nmax, cover_height=cover_height)
+            for i, p in zip(idx, m.polygon_potentials(x, [derivative])):
+                pot[i] = p
+        rest = [i for i, p in enumerate(pot) if p is None]
+        if rest:
+            for i, p in zip(rest, System([electrodes[i] for i in
+                    rest]).individual_potential(x, derivative)):
+                pot[i] = p
+        return pot
+
+    def prune(self):
+        """Drops the shared responses of electrodes no longer in
+        `self`."""
+        keys = set(_triangle_key(ei) for ei in self)
+        for cache in self.responses.values():
+            for k in list(cache):
+                if k not in keys:
+                    del cache[k]
+
+
 def adapt_mesh(constraints, variable, fixed=[], threshold=.5,
         nmax=int(2**15.5), a=1, q=20, up=16., down=4., verbose=False,
-        symmetry=lambda p: [p], **kwargs):
+        symmetry=lambda p: [p], incremental=False, mesh=False,
+        **kwargs):
     """Adaptively refines the electrode boundaries based on the
     incremental `System.optimize()` results.
 
@@ -111,6 +196,15 @@ def adapt_mesh(constraints, variable, fixed=[], threshold=.5,
         `symmetry(triangle)`. With triangle being a (3, 2) array of
         corners. See `transformed_copy()` and `transformer()` for some
         utilities how to write these symmetry functions.
+    incremental : bool
+        Keep the individual potentials of the triangles across
+        refinement rounds and only evaluate the new triangles. Also
+        solve with the `"lp"` backend of `System.optimize()`, warm
+        started from the previous voltages interpolated onto the new
+        triangles (by nearest centroid).
+    mesh : bool
+        Evaluate the triangles as a `MeshPixelElectrode` where the
+        edges shared by adjacent triangles are evaluated only once.
 
     Returns
     -------
@@ -124,6 +218,8 @@ def adapt_mesh(constraints, variable, fixed=[], threshold=.5,
     opts = "Qq%fa%fn" % (q, a)
     args = paths_to_mesh(variable)
     s = v = c = None
+    responses = {}
+    previous = None
     while True:
         args = triangulate(opts=opts, **args)
         n = args["triangles"].shape[0]
@@ -134,11 +230,26 @@ def adapt_mesh(constraints, variable, fixed=[], threshold=.5,
         areas = np.empty(n, dtype=np.double)
         centroids = np.empty((n, 2), dtype=np.double)
         paths = args["points"][args["triangles"], :]
-        s = System(fixed)
+        if incremental or mesh:
+            s = _AdaptiveSystem(fixed, mesh=mesh,
+                    responses=responses if incremental else None)
+        else:
+            s = System(fixed)
         for i, p in enumerate(paths):
             areas[i], centroids[i] = area_centroid(p)
             s.append(PolygonPixelElectrode(paths=symmetry(p), **kwargs))
-        v, c = s.optimize(constraints, verbose=False) #verbose)
+        if incremental:
+            s.prune()
+            x0 = None
+            if previous is not None:
+                v0, c0 = previous
+                j = cKDTree(c0).query(centroids)[1]
+                x0 = np.r_[v0[:len(fixed)], v0[len(fixed):][j]]
+            v, c = s.optimize(constraints, verbose=False, backend="lp",
+                    x0=x0)
+            previous = v, centroids
+        else:
+            v, c = s.optimize(constraints, verbose=False) #verbose)
         if verbose: 
             print("objective:", c)
         potentials = v[len(fixed):]
@@ -146,5 +257,8 @@ def adapt_mesh(constraints, variable, fixed=[], threshold=.5,
         edge_changes = potentials.take(neighbors) - potentials[:, None]
         refine = np.fabs(edge_changes).max(1) > threshold
         args["triangleareas"] = np.where(refine, areas/down, areas*up)
+    if isinstance(s, _AdaptiveSystem):
+        # drop the shared responses
+        s = System(s)
     return s, v, c
 
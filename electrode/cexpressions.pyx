@@ -23,6 +23,7 @@
 
 from __future__ import division
 import cython
+from cython.parallel cimport prange
 import numpy as np
 cimport numpy as np
 np.import_array()
@@ -32,6 +33,33 @@ dtype = np.double
 ctypedef np.double_t dtype_t
 ctypedef int intc_t
 
+cdef int _num_threads = 1
+
+
+def set_num_threads(n=None):
+    """Set the number of threads the kernels split the evaluation
+    points over.
+
+    Parameters
+    ----------
+    n : int or None
+        Number of threads. If None, use one thread per CPU.
+        The default is one thread.
+    """
+    global _num_threads
+    if n is None:
+        import multiprocessing
+        n = multiprocessing.cpu_count()
+    if n < 1:
+        raise ValueError("need at least one thread")
+    _num_threads = n
+
+
+def get_num_threads():
+    """Return the number of threads used by the kernels."""
+    return _num_threads
+
+
 def point_potential(np.ndarray[dtype_t, ndim=2] x not None,
                 np.ndarray[dtype_t, ndim=2] points not None,
                 np.ndarray[dtype_t, ndim=1] areas not None,
@@ -49,9 +77,9 @@ def point_potential(np.ndarray[dtype_t, ndim=2] x not None,
         out = np.zeros([nx, derivative*2+1], dtype=dtype)
 
     with nogil:
-        for i in range(nv):
-            a0 = areas[i]*potential
-            for j in range(nx):
+        for j in prange(nx, num_threads=_num_threads, schedule="static"):
+            for i in range(nv):
+                a0 = areas[i]*potential
                 x0 = x[j, 0] - points[i, 0]
                 y0 = x[j, 1] - points[i, 1]
                 for k in range(-cover_nmax, cover_nmax+1):
@@ -80,7 +108,8 @@ def polygon_potential(np.ndarray[dtype_t, ndim=2] x not None,
         no = polygon.shape[0]
         assert polygon.shape[1] == 2
         with nogil:
-            for j in range(nx):
+            for j in prange(nx, num_threads=_num_threads,
+                    schedule="static"):
                 for m in range(-cover_nmax, cover_nmax+1):
                     x2 = x[j, 0] - polygon[no-1, 0]
                     y2 = x[j, 1] - polygon[no-1, 1]
@@ -118,8 +147,8 @@ def mesh_potential(np.ndarray[dtype_t, ndim=2] x not None,
         out = np.zeros([nx, derivative*2+1], dtype=dtype)
 
     with nogil:
-        for i in range(ne):
-            for j in range(nx):
+        for j in prange(nx, num_threads=_num_threads, schedule="static"):
+            for i in range(ne):
                 for k in range(-cover_nmax, cover_nmax+1):
                     z = x[j, 2] + 2*k*cover_height
                     x1 = x[j, 0] - points[edges[i, 0], 0]
@@ -135,6 +164,224 @@ def mesh_potential(np.ndarray[dtype_t, ndim=2] x not None,
     return out
 
 
+def _offsets(np.ndarray[intc_t, ndim=1] derivatives):
+    offsets = np.zeros(derivatives.shape[0] + 1, dtype=np.intc)
+    np.cumsum(2*derivatives + 1, out=offsets[1:])
+    return offsets
+
+
+def point_potentials(np.ndarray[dtype_t, ndim=2] x not None,
+                np.ndarray[dtype_t, ndim=2] points not None,
+                np.ndarray[dtype_t, ndim=1] areas not None,
+                double potential,
+                np.ndarray[intc_t, ndim=1] derivatives not None,
+                int cover_nmax, double cover_height,
+                np.ndarray[dtype_t, ndim=2, mode="c"] out):
+    cdef int nx = x.shape[0], nv = points.shape[0]
+    cdef int nd = derivatives.shape[0]
+    cdef int i, j, k, l
+    cdef double x0, y0, z0, a0, r0
+    cdef np.ndarray[intc_t, ndim=1] offsets = _offsets(derivatives)
+
+    assert x.shape[1] == 3
+    assert points.shape[1] == 2
+
+    if out is None:
+        out = np.zeros([nx, offsets[nd]], dtype=dtype)
+    assert out.shape[1] == offsets[nd]
+
+    with nogil:
+        for j in prange(nx, num_threads=_num_threads, schedule="static"):
+            for i in range(nv):
+                a0 = areas[i]*potential
+                x0 = x[j, 0] - points[i, 0]
+                y0 = x[j, 1] - points[i, 1]
+                for k in range(-cover_nmax, cover_nmax+1):
+                    z0 = x[j, 2] + 2*k*cover_height
+                    r0 = sqrt(x0**2 + y0**2 + z0**2)
+                    for l in range(nd):
+                        point_potential_expr(x0, y0, z0, r0, a0,
+                                derivatives[l], &out[j, offsets[l]])
+    return out
+
+
+def polygon_potentials(np.ndarray[dtype_t, ndim=2] x not None,
+                  polygons not None, double potential,
+                  np.ndarray[intc_t, ndim=1] derivatives not None,
+                  int cover_nmax, double cover_height,
+                  np.ndarray[dtype_t, ndim=2, mode="c"] out):
+    cdef int nx = x.shape[0]
+    cdef int nd = derivatives.shape[0]
+    cdef int i, j, k, no, m, l
+    cdef double x1, y1, z1, r1, x2, y2, r2, z, l2
+    cdef np.ndarray[dtype_t, ndim=2] polygon
+    cdef np.ndarray[intc_t, ndim=1] offsets = _offsets(derivatives)
+
+    assert x.shape[1] == 3
+
+    if out is None:
+        out = np.zeros([nx, offsets[nd]], dtype=dtype)
+    assert out.shape[1] == offsets[nd]
+
+    for polygon in iter(polygons):
+        no = polygon.shape[0]
+        assert polygon.shape[1] == 2
+        with nogil:
+            for j in prange(nx, num_threads=_num_threads,
+                    schedule="static"):
+                for m in range(-cover_nmax, cover_nmax+1):
+                    x2 = x[j, 0] - polygon[no-1, 0]
+                    y2 = x[j, 1] - polygon[no-1, 1]
+                    z = x[j, 2] + 2*m*cover_height
+                    r2 = sqrt(x2**2 + y2**2 + z**2)
+                    for k in range(no):
+                        x1, y1, r1 = x2, y2, r2
+                        x2 = x[j, 0] - polygon[k, 0]
+                        y2 = x[j, 1] - polygon[k, 1]
+                        r2 = sqrt(x2**2 + y2**2 + z**2)
+                        l2 = (x1 - x2)**2 + (y1 - y2)**2
+                        for l in range(nd):
+                            edge_potential_expr(x1, x2, y1, y2, r1, r2,
+                                    l2, z, potential, derivatives[l],
+                                    &out[j, offsets[l]])
+    return out
+
+
+def packed_polygon_potentials(np.ndarray[dtype_t, ndim=2] x not None,
+                  np.ndarray[dtype_t, ndim=2] points not None,
+                  np.ndarray[intc_t, ndim=1] offsets not None,
+                  np.ndarray[intc_t, ndim=1] index not None,
+                  np.ndarray[dtype_t, ndim=1] potentials not None,
+                  np.ndarray[intc_t, ndim=1] derivatives not None,
+                  int cover_nmax, double cover_height,
+                  np.ndarray[dtype_t, ndim=3, mode="c"] out):
+    cdef int nx = x.shape[0], npoly = index.shape[0]
+    cdef int nd = derivatives.shape[0]
+    cdef int i, j, k, m, l, a, b
+    cdef double x1, y1, r1, x2, y2, r2, z, l2
+    cdef np.ndarray[intc_t, ndim=1] doffsets = _offsets(derivatives)
+
+    assert x.shape[1] == 3
+    assert points.shape[1] == 2
+    assert offsets.shape[0] == npoly + 1
+    assert potentials.shape[0] == npoly
+    assert npoly == 0 or offsets[npoly] <= points.shape[0]
+
+    if out is None:
+        out = np.zeros([index.max() + 1 if npoly else 1, nx,
+            doffsets[nd]], dtype=dtype)
+    assert out.shape[1] == nx
+    assert out.shape[2] == doffsets[nd]
+    assert npoly == 0 or (index.min() >= 0 and index.max() < out.shape[0])
+
+    with nogil:
+        for j in prange(nx, num_threads=_num_threads, schedule="static"):
+            for i in range(npoly):
+                a = offsets[i]
+                b = offsets[i+1]
+                if b <= a:
+                    continue
+                for m in range(-cover_nmax, cover_nmax+1):
+                    x2 = x[j, 0] - points[b-1, 0]
+                    y2 = x[j, 1] - points[b-1, 1]
+                    z = x[j, 2] + 2*m*cover_height
+                    r2 = sqrt(x2**2 + y2**2 + z**2)
+                    for k in range(a, b):
+                        x1, y1, r1 = x2, y2, r2
+                        x2 = x[j, 0] - points[k, 0]
+                        y2 = x[j, 1] - points[k, 1]
+                        r2 = sqrt(x2**2 + y2**2 + z**2)
+                        l2 = (x1 - x2)**2 + (y1 - y2)**2
+                        for l in range(nd):
+                            edge_potential_expr(x1, x2, y1, y2, r1, r2,
+                                    l2, z, potentials[i], derivatives[l],
+                                    &out[index[i], j, doffsets[l]])
+    return out
+
+
+def mesh_potentials(np.ndarray[dtype_t, ndim=2] x not None,
+                   np.ndarray[dtype_t, ndim=2] points not None,
+                   np.ndarray[intc_t, ndim=2] edges not None,
+                   np.ndarray[intc_t, ndim=1] polygons not None,
+                   np.ndarray[dtype_t, ndim=1] potentials not None,
+                   np.ndarray[intc_t, ndim=1] derivatives not None,
+                   int cover_nmax, double cover_height,
+                   np.ndarray[dtype_t, ndim=2, mode="c"] out):
+    cdef int nx = x.shape[0], ne = edges.shape[0]
+    cdef int nd = derivatives.shape[0]
+    cdef int i, j, k, l
+    cdef double x1, y1, z, r1, x2, y2, r2, l2, potential
+    cdef np.ndarray[intc_t, ndim=1] offsets = _offsets(derivatives)
+
+    assert polygons.shape[0] == edges.shape[0]
+    assert edges.shape[1] == 2
+    assert points.shape[1] == 2
+    assert x.shape[1] == 3
+
+    if out is None:
+        out = np.zeros([nx, offsets[nd]], dtype=dtype)
+    assert out.shape[1] == offsets[nd]
+
+    with nogil:
+        for j in prange(nx, num_threads=_num_threads, schedule="static"):
+            for i in range(ne):
+                for k in range(-cover_nmax, cover_nmax+1):
+                    z = x[j, 2] + 2*k*cover_height
+                    x1 = x[j, 0] - points[edges[i, 0], 0]
+                    y1 = x[j, 1] - points[edges[i, 0], 1]
+                    r1 = sqrt(x1**2 + y1**2 + z**2)
+                    x2 = x[j, 0] - points[edges[i, 1], 0]
+                    y2 = x[j, 1] - points[edges[i, 1], 1]
+                    r2 = sqrt(x2**2 + y2**2 + z**2)
+                    l2 = (x1 - x2)**2 + (y1 - y2)**2
+                    potential = potentials[polygons[i]]
+                    for l in range(nd):
+                        edge_potential_expr(x1, x2, y1, y2, r1, r2, l2, z,
+                                potential, derivatives[l],
+                                &out[j, offsets[l]])
+    return out
+
+
+def mesh_edge_potentials(np.ndarray[dtype_t, ndim=2] x not None,
+                   np.ndarray[dtype_t, ndim=2] points not None,
+                   np.ndarray[intc_t, ndim=2] edges not None,
+                   np.ndarray[intc_t, ndim=1] derivatives not None,
+                   int cover_nmax, double cover_height,
+                   np.ndarray[dtype_t, ndim=3, mode="c"] out):
+    cdef int nx = x.shape[0], ne = edges.shape[0]
+    cdef int nd = derivatives.shape[0]
+    cdef int i, j, k, l
+    cdef double x1, y1, z, r1, x2, y2, r2, l2
+    cdef np.ndarray[intc_t, ndim=1] offsets = _offsets(derivatives)
+
+    assert edges.shape[1] == 2
+    assert points.shape[1] == 2
+    assert x.shape[1] == 3
+
+    if out is None:
+        out = np.zeros([ne, nx, offsets[nd]], dtype=dtype)
+    assert out.shape[0] == ne
+    assert out.shape[1] == nx
+    assert out.shape[2] == offsets[nd]
+
+    with nogil:
+        for j in prange(nx, num_threads=_num_threads, schedule="static"):
+            for i in range(ne):
+                for k in range(-cover_nmax, cover_nmax+1):
+                    z = x[j, 2] + 2*k*cover_height
+                    x1 = x[j, 0] - points[edges[i, 0], 0]
+                    y1 = x[j, 1] - points[edges[i, 0], 1]
+                    r1 = sqrt(x1**2 + y1**2 + z**2)
+                    x2 = x[j, 0] - points[edges[i, 1], 0]
+                    y2 = x[j, 1] - points[edges[i, 1], 1]
+                    r2 = sqrt(x2**2 + y2**2 + z**2)
+                    l2 = (x1 - x2)**2 + (y1 - y2)**2
+                    for l in range(nd):
+                        edge_potential_expr(x1, x2, y1, y2, r1, r2, l2, z,
+                                1., derivatives[l], &out[i, j, offsets[l]])
+    return out
+
+
 cdef inline void point_potential_expr(double x, double y, double z,
         double r, double a, int derivative, double *d) nogil:
     cdef double n
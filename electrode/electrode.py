@@ -20,20 +20,45 @@
 from __future__ import (absolute_import, print_function,
         unicode_literals, division)
 
+import os
+from collections import deque
+from math import factorial
+
 import numpy as np
-from scipy.ndimage.interpolation import map_coordinates
+from scipy import sparse
+from scipy.ndimage import spline_filter
 
-from .utils import area_centroid, construct_derivative
+from .utils import (area_centroid, construct_derivative, expand_tensor,
+        select_tensor, DummyPool)
 
 try:
     if False: # test slow python only or fast numba expressions
         raise ImportError
     from .cexpressions import (point_potential, polygon_potential,
-            mesh_potential)
+            mesh_potential, point_potentials, polygon_potentials,
+            mesh_potentials, packed_polygon_potentials,
+            mesh_edge_potentials, set_num_threads, get_num_threads)
 except ImportError:
     from .expressions import (point_potential, polygon_potential,
-            mesh_potential)
-
+            mesh_potential, point_potentials, polygon_potentials,
+            mesh_potentials, packed_polygon_potentials,
+            mesh_edge_potentials, set_num_threads, get_num_threads)
+
+
+def _split_potentials(pot, derivatives, out=None):
+    """Split the concatenated output of the fused `*_potentials()`
+    kernels into one array per derivative order. Add them to the
+    arrays in `out` if given."""
+    pots = []
+    i = 0
+    for j, d in enumerate(derivatives):
+        p = pot[:, i:i + 2*d + 1]
+        i += 2*d + 1
+        if out is not None:
+            out[j] += p
+            p = out[j]
+        pots.append(p)
+    return pots
 
 
 class Electrode(object):
@@ -54,13 +79,26 @@ class Electrode(object):
         of this electrode is proportional to the square of its RF
         potential.
     """
-    __slots__ = "name dc rf".split()
+    __slots__ = "name dc rf _version".split()
 
     def __init__(self, name="", dc=0., rf=0.):
         self.name = name
         self.dc = dc
         self.rf = rf
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # anything but the name, the voltages and private caches
+        # is geometry
+        if name not in ("name", "dc", "rf") and not name.startswith("_"):
+            object.__setattr__(self, "_version",
+                    getattr(self, "_version", 0) + 1)
+
+    def _geometry_version(self):
+        """Counter that changes whenever a geometry attribute is
+        assigned. In-place changes to arrays are not tracked."""
+        return getattr(self, "_version", 0)
+
     def potential(self, x, derivative=0, potential=1., out=None):
         """Electrical potential contribution.
 
@@ -108,6 +146,42 @@ class Electrode(object):
         """
         raise NotImplementedError
 
+    def potential_derivatives(self, x, derivatives=(0,), potential=1.,
+            out=None):
+        """Electrical potential contributions for several derivative
+        orders.
+
+        Like `potential()` but for a sequence of derivative orders.
+        Electrodes that support it evaluate all orders in a single pass
+        over their geometry.
+
+        Parameters
+        ----------
+        x : array_like, shape (n, 3)
+            Position to evaluate the electrical potential at.
+        derivatives : sequence of int
+            Derivative orders, e.g. `range(3)`.
+        potential : float
+            Scaling of the potential. See `potential()`.
+        out : None or list of array_like, shape (n, 2*derivative + 1)
+            Arrays to add the potential contributions to. One for each
+            entry in `derivatives`. If None, arrays are created and
+            returned.
+
+        Returns
+        -------
+        potentials : list of arrays, shape (n, 2*derivative + 1), double
+            The potential derivatives in the order of `derivatives`.
+
+        See Also
+        --------
+        potential
+        """
+        if out is None:
+            out = [None]*len(derivatives)
+        return [self.potential(x, d, potential, o)
+                for d, o in zip(derivatives, out)]
+
     def orientations(self):
         """Return the orientation of the electrode surfaces with respect
         to the `z > 0` half space.
@@ -257,6 +331,13 @@ class PointPixelElectrode(SurfaceElectrode):
         return point_potential(x, self.points, self.areas, potential,
                 derivative, self.cover_nmax, self.cover_height, out)
 
+    def potential_derivatives(self, x, derivatives=(0,), potential=1.,
+            out=None):
+        derivatives = np.asanyarray(derivatives, np.intc)
+        pot = point_potentials(x, self.points, self.areas, potential,
+                derivatives, self.cover_nmax, self.cover_height, None)
+        return _split_potentials(pot, derivatives, out)
+
 
 class PolygonPixelElectrode(SurfaceElectrode):
     """Surface electrode comprising several polygonal patches.
@@ -326,12 +407,51 @@ class PolygonPixelElectrode(SurfaceElectrode):
         return polygon_potential(x, self.paths, potential, derivative,
                 self.cover_nmax, self.cover_height, out)
 
+    def potential_derivatives(self, x, derivatives=(0,), potential=1.,
+            out=None):
+        derivatives = np.asanyarray(derivatives, np.intc)
+        pot = polygon_potentials(x, self.paths, potential, derivatives,
+                self.cover_nmax, self.cover_height, None)
+        return _split_potentials(pot, derivatives, out)
+
+
+def pack_polygons(electrodes):
+    """Flatten the polygons of several `PolygonPixelElectrode` into
+    a single vertex array with offset and electrode index arrays
+    (compressed sparse row layout) for `packed_polygon_potentials()`.
+
+    Parameters
+    ----------
+    electrodes : list of `PolygonPixelElectrode`
+
+    Returns
+    -------
+    points : array, shape (n, 2)
+        Vertices of all polygons.
+    offsets : array, shape (m + 1,)
+        Polygon `i` has the vertices `points[offsets[i]:offsets[i+1]]`.
+    index : array, shape (m,)
+        Index into `electrodes` of the electrode that polygon `i`
+        belongs to.
+    """
+    paths = [(i, p) for i, e in enumerate(electrodes) for p in e.paths]
+    index = np.array([i for i, p in paths], np.intc)
+    offsets = np.zeros(len(paths) + 1, np.intc)
+    offsets[1:] = np.cumsum([len(p) for i, p in paths])
+    if paths:
+        points = np.concatenate([p for i, p in paths])
+    else:
+        points = np.zeros((0, 2), np.double)
+    return np.ascontiguousarray(points, np.double), offsets, index
+
 
 class MeshPixelElectrode(SurfaceElectrode):
     """A surface electrode consisting of a polygonal mesh with
     different potential for each polygon.
 
-    .. note:: untested, unused
+    An edge that is shared by two polygons (traversed in opposite
+    directions) only needs to be stored and evaluated once. It is
+    weighted by the difference of the potentials of its two polygons.
 
     Parameters
     ----------
@@ -345,6 +465,9 @@ class MeshPixelElectrode(SurfaceElectrode):
         `potentials`.
     potentials : array_like, shape (k,)
         Polygon potential prefactors.
+    opposites : None or array_like, shape (m,)
+        Index of the polygon on the other side of each edge or -1 if
+        the edge is not shared. If None, no edges are shared.
 
     See Also
     --------
@@ -353,38 +476,161 @@ class MeshPixelElectrode(SurfaceElectrode):
     SurfaceElectrode
         `cover_nmax` and `cover_height` attributes/constructor parameters
     """
-    __slots__ = "points edges polygons potentials".split()
+    __slots__ = "points edges polygons potentials opposites".split()
 
     def __init__(self, points=[], edges=[], polygons=[], potentials=[],
-            **kwargs):
+            opposites=None, **kwargs):
         super(MeshPixelElectrode, self).__init__(**kwargs)
-        self.points = np.asanyarray(points, np.double)
-        self.edges = np.asanyarray(edges, np.intc)
+        self.points = np.asanyarray(points, np.double).reshape(-1, 2)
+        self.edges = np.asanyarray(edges, np.intc).reshape(-1, 2)
         self.polygons = np.asanyarray(polygons, np.intc)
         self.potentials = np.asanyarray(potentials, np.double)
+        if opposites is None:
+            opposites = -np.ones(self.polygons.shape, np.intc)
+        self.opposites = np.asanyarray(opposites, np.intc)
 
     @classmethod
-    def from_polygon_system(cls, s):
+    def from_polygon_system(cls, s, potentials=None, **kwargs):
+        """Create a `MeshPixelElectrode` from a `System` of
+        `PolygonPixelElectrode`.
+
+        Coinciding vertices are merged and edges shared by two
+        polygons are stored once. Edges shared by two paths of the same
+        electrode cancel and are dropped.
+
+        Parameters
+        ----------
+        s : System of PolygonPixelElectrode
+        potentials : None or array_like, shape (len(s),)
+            Potential of each electrode. If None, take `s.dcs`.
+        **kwargs : any
+            Passed to the constructor. `dc` defaults to 1.
+
+        Returns
+        -------
+        MeshPixelElectrode
+        """
         points = []
         edges = []
         polygons = []
-        potentials = []
-        for p in s:
+        n = 0
+        for i, p in enumerate(s):
             assert isinstance(p, PolygonPixelElectrode), p
-            for i in p.paths:
-                ei = len(points)+np.arange(len(i))
-                points.extend(i)
-                edges.extend(np.c_[np.roll(ei, 1, 0), ei])
-                polygons.extend(len(potentials)*np.ones(len(ei)))
-            potentials.append(p.dc)
-        return cls(dc=1, points=points, edges=edges, polygons=polygons,
-                potentials=potentials)
+            for pi in p.paths:
+                ei = n + np.arange(len(pi))
+                points.append(np.asanyarray(pi, np.double).reshape(-1, 2))
+                edges.append(np.c_[np.roll(ei, 1, 0), ei])
+                polygons.append(i*np.ones(len(ei), np.intc))
+                n += len(pi)
+        if potentials is None:
+            potentials = [p.dc for p in s]
+        if n:
+            points, inverse = np.unique(np.concatenate(points), axis=0,
+                    return_inverse=True)
+            edges = inverse.ravel()[np.concatenate(edges)]
+            polygons = np.concatenate(polygons)
+        else:
+            points = np.zeros((0, 2), np.double)
+            edges = np.zeros((0, 2), np.intc)
+            polygons = np.zeros(0, np.intc)
+        edges, polygons, opposites = _pair_edges(edges, polygons)
+        kwargs.setdefault("dc", 1)
+        return cls(points=points, edges=edges, polygons=polygons,
+                potentials=potentials, opposites=opposites, **kwargs)
+
+    def edge_potentials(self):
+        """Effective potential of each edge.
+
+        Returns
+        -------
+        array, shape (m,)
+            The potential of its polygon minus that of the opposite
+            polygon.
+        """
+        p = self.potentials[self.polygons]
+        shared = self.opposites >= 0
+        p[shared] -= self.potentials[self.opposites[shared]]
+        return p
 
     def potential(self, x, derivative=0, potential=1., out=None):
-        return mesh_potential(x, self.points, self.edges, self.polygons,
-                self.potentials*potential, derivative,
+        return mesh_potential(x, self.points, self.edges,
+                np.arange(len(self.edges), dtype=np.intc),
+                self.edge_potentials()*potential, derivative,
                 self.cover_nmax, self.cover_height, out)
 
+    def potential_derivatives(self, x, derivatives=(0,), potential=1.,
+            out=None):
+        derivatives = np.asanyarray(derivatives, np.intc)
+        pot = mesh_potentials(x, self.points, self.edges,
+                np.arange(len(self.edges), dtype=np.intc),
+                self.edge_potentials()*potential, derivatives,
+                self.cover_nmax, self.cover_height, None)
+        return _split_potentials(pot, derivatives, out)
+
+    def polygon_potentials(self, x, derivatives=(0,)):
+        """Individual unit potential contributions of the polygons.
+
+        Each edge is evaluated once and added to both of its polygons.
+
+        Parameters
+        ----------
+        x : array_like, shape (n, 3)
+            Points to evaluate at.
+        derivatives : array_like of int
+            Derivative orders.
+
+        Returns
+        -------
+        array, shape (k, n, l)
+            Contribution of each polygon with unit potential. `l` is the
+            sum of `2*derivative + 1` over `derivatives`.
+        """
+        x = np.ascontiguousarray(x, np.double).reshape(-1, 3)
+        derivatives = np.asanyarray(derivatives, np.intc)
+        pot = mesh_edge_potentials(x, self.points, self.edges,
+                derivatives, self.cover_nmax, self.cover_height, None)
+        ne = len(self.edges)
+        shared = np.flatnonzero(self.opposites >= 0)
+        incidence = sparse.csr_matrix((
+            np.r_[np.ones(ne), -np.ones(len(shared))],
+            (np.r_[self.polygons, self.opposites[shared]],
+                np.r_[np.arange(ne), shared])),
+            shape=(len(self.potentials), ne))
+        return incidence.dot(pot.reshape(ne, -1)).reshape(
+                len(self.potentials), x.shape[0], -1)
+
+
+def _pair_edges(edges, polygons):
+    """Merge edges that are traversed in opposite directions.
+
+    Returns
+    -------
+    edges : array, shape (m, 2)
+    polygons : array, shape (m,)
+    opposites : array, shape (m,)
+        Index of the polygon that traverses the edge in the opposite
+        direction or -1. Degenerate edges and edges shared within the
+        same polygon are dropped.
+    """
+    opposites = -np.ones(len(edges), np.intc)
+    keep = np.ones(len(edges), np.bool_)
+    unmatched = {}
+    for i, (a, b) in enumerate(edges.tolist()):
+        if a == b:
+            keep[i] = False
+            continue
+        other = unmatched.get((b, a))
+        if other:
+            j = other.pop()
+            opposites[j] = polygons[i]
+            keep[i] = False
+        else:
+            unmatched.setdefault((a, b), []).append(i)
+    keep &= opposites != polygons
+    return (np.ascontiguousarray(edges[keep], np.intc),
+            np.ascontiguousarray(polygons[keep], np.intc),
+            opposites[keep])
+
 
 class GridElectrode(Electrode):
     """Electrode based on a precalculated grid of electrical potentials.
@@ -398,23 +644,119 @@ class GridElectrode(Electrode):
         Position of the (n, m, k) = (0, 0, 0) voxel.
     spacing : array_like, shape (3,)
         Voxel pitch.
+    order : int
+        Interpolation order. 1 for trilinear (continuous) and 3 for
+        tricubic B-spline (twice continuously differentiable)
+        interpolation. The spline coefficients are computed once per
+        derivative order and cached.
+    path : None or str
+        Directory the data is stored in, see `save()` and
+        `from_file()`. If given, derivative orders generated later are
+        written there as well.
+    dtype : numpy dtype
+        Storage and interpolation type of the data and the spline
+        coefficients. `np.float32` halves memory and bandwidth. Its
+        unit roundoff is `2**-24 = 6e-8`. The interpolated values then
+        deviate from the `np.double` results by less than about `1e-6`
+        (`order=1`) or `1e-5` (`order=3`, the spline coefficients can
+        exceed the data by up to a factor of 3) times the largest
+        magnitude of the data. The grid coordinates are always computed
+        in double precision.
 
     See Also
     --------
     Electrode
         `name`, `dc`, `rf` attributes/parameters
     """
-    __slots__ = "data origin spacing".split()
+    __slots__ = "data origin spacing order path dtype _coefficients".split()
 
     def __init__(self, data=[], origin=(0, 0, 0), spacing=(1, 1, 1),
-            **kwargs):
+            order=1, path=None, dtype=np.double, **kwargs):
         super(GridElectrode, self).__init__(**kwargs)
-        self.data = [np.asanyarray(i, np.double) for i in data]
+        self.dtype = np.dtype(dtype)
+        self.data = [np.asanyarray(i, self.dtype) for i in data]
         self.origin = np.asanyarray(origin, np.double)
         self.spacing = np.asanyarray(spacing, np.double)
+        self.order = order
+        self.path = path
+        self._coefficients = {}
+
+    def __getstate__(self):
+        state = dict((k, getattr(self, k)) for c in type(self).__mro__
+                for k in getattr(c, "__slots__", ()) if hasattr(self, k))
+        # the memory mapped orders are reopened, not copied
+        state["data"] = [None if isinstance(d, np.memmap) else d
+                for d in self.data]
+        state["_coefficients"] = {}
+        return state
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+        self.data = [self._load(i) if d is None else d
+                for i, d in enumerate(self.data)]
+
+    def _filename(self, derivative):
+        return os.path.join(self.path, "data%i.npy" % derivative)
+
+    def _load(self, derivative, mmap_mode="r"):
+        return np.load(self._filename(derivative), mmap_mode=mmap_mode)
+
+    def save(self, path):
+        """Store the grid data in a directory.
+
+        Each derivative order is written to `data<order>.npy` and the
+        grid geometry to `grid.npz`. The data can be opened memory
+        mapped with `from_file()` and shared between processes.
+        The electrode subsequently uses the stored data.
+
+        Parameters
+        ----------
+        path : str
+            Directory name. Created if it does not exist.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.savez(os.path.join(path, "grid.npz"), origin=self.origin,
+                spacing=self.spacing)
+        self.path = path
+        for i, d in enumerate(self.data):
+            np.save(self._filename(i), d)
+            self.data[i] = self._load(i)
 
     @classmethod
-    def from_result(cls, result, maxderiv=4):
+    def from_file(cls, path, mmap_mode="r", **kwargs):
+        """Open grid data stored with `save()`.
+
+        The derivative orders are memory mapped and not read into
+        memory. Missing derivative orders are generated when first
+        needed and written to `path`.
+
+        Parameters
+        ----------
+        path : str
+            Directory name.
+        mmap_mode : str
+            See `numpy.load()`.
+        **kwargs : any
+            Passed to the constructor. `dtype` defaults to that of the
+            stored data.
+
+        Returns
+        -------
+        GridElectrode
+        """
+        grid = np.load(os.path.join(path, "grid.npz"))
+        obj = cls(origin=grid["origin"], spacing=grid["spacing"],
+                path=path, **kwargs)
+        while os.path.exists(obj._filename(len(obj.data))):
+            obj.data.append(obj._load(len(obj.data), mmap_mode))
+        if obj.data and "dtype" not in kwargs:
+            obj.dtype = obj.data[0].dtype
+        return obj
+
+    @classmethod
+    def from_result(cls, result, maxderiv=4, **kwargs):
         """Create a `GridElectrode` from a `bem.result.Result` instance.
 
         Parameters
@@ -423,6 +765,8 @@ class GridElectrode(Electrode):
         maxderiv : int
             Maximum derivative order to precompute based on the
             available data.
+        **kwargs : any
+            Passed to the constructor.
 
         Returns
         -------
@@ -433,12 +777,12 @@ class GridElectrode(Electrode):
         data = [result.potential[:, :, :, None]]
         if result.field is not None:
             data.append(result.field.transpose(1, 2, 3, 0))
-        obj = cls(origin=origin, spacing=spacing, data=data)
+        obj = cls(origin=origin, spacing=spacing, data=data, **kwargs)
         obj.generate(maxderiv)
         return obj
 
     @classmethod
-    def from_vtk(cls, fil, maxderiv=4):
+    def from_vtk(cls, fil, maxderiv=4, **kwargs):
         """Load grid potential data from vtk StructuredPoints.
 
         .. note:: needs `tvtk`
@@ -450,6 +794,8 @@ class GridElectrode(Electrode):
             gridded data.
         maxderiv : int
             Maximum derivative order to precompute.
+        **kwargs : any
+            Passed to the constructor.
 
         Returns
         -------
@@ -475,11 +821,11 @@ class GridElectrode(Electrode):
             dim = sp.number_of_components
             data = data.reshape(dimensions[::-1]+(dim,)).transpose(2, 1, 0, 3)
             pot[int((dim-1)/2)] = data
-        obj = cls(origin=origin, spacing=spacing, data=pot)
+        obj = cls(origin=origin, spacing=spacing, data=pot, **kwargs)
         obj.generate(maxderiv)
         return obj
 
-    def generate(self, maxderiv=4):
+    def generate(self, maxderiv=4, chunksize=None, pool=None):
         """Generate missing derivative orders by successive finite
         differences from the already present derivative orders.
 
@@ -491,22 +837,56 @@ class GridElectrode(Electrode):
         maxderiv : int
             Maximum derivative order to precompute if not already
             present.
+        chunksize : None or int
+        pool : None or Pool
+            See `derive()`.
         """
         for deriv in range(maxderiv):
             if len(self.data) < deriv+1:
-                self.data.append(self.derive(deriv))
+                self.data.append(self._generate(deriv, chunksize, pool))
             ddata = self.data[deriv]
             assert ddata.ndim == 4, ddata.ndim
             assert ddata.shape[-1] == 2*deriv+1, ddata.shape
             if deriv > 0:
                 assert ddata.shape[:-1] == self.data[deriv-1].shape[:-1]
 
-    def derive(self, deriv):
+    def _generate(self, deriv, chunksize=None, pool=None):
+        """Derive a new order and store it in `path` if given."""
+        if self.path is None:
+            return self.derive(deriv, chunksize=chunksize, pool=pool)
+        # write to a temporary file and move it in place to not expose
+        # incomplete data to other processes
+        fil = self._filename(deriv)
+        tmp = "%s.%i.tmp" % (fil, os.getpid())
+        shape = self.data[deriv-1].shape[:-1] + (2*deriv+1,)
+        ddata = np.lib.format.open_memmap(tmp, mode="w+",
+                dtype=self.dtype, shape=shape)
+        self.derive(deriv, out=ddata, chunksize=chunksize, pool=pool)
+        ddata.flush()
+        del ddata
+        os.rename(tmp, fil)
+        return self._load(deriv)
+
+    def derive(self, deriv, out=None, chunksize=None, pool=None):
         """Take finite differences along each axis.
 
+        Each component is the derivative of one lower order component
+        along one axis. The grid is processed in slabs of `chunksize`
+        planes along the first axis (plus one plane on either side for
+        the central differences) to bound the memory needed.
+
         Parameters
         ----------
         deriv : derivative order to generate
+        out : None or array_like, shape (n, m, k, l)
+            Array to store the result in. If None, it is created.
+        chunksize : None or int
+            Number of planes along the first axis per slab. If None,
+            the grid is processed in one slab.
+        pool : None or Pool
+            Pool to compute the slabs on, e.g. a
+            `multiprocessing.pool.ThreadPool`. If None, compute them
+            sequentially.
 
         Returns
         -------
@@ -514,20 +894,345 @@ class GridElectrode(Electrode):
             New derivative data, l = 2*deriv + 1
         """
         odata = self.data[deriv-1]
-        ddata = np.empty(odata.shape[:-1] + (2*deriv+1,), np.double)
-        for i in range(2*deriv+1):
-            (e, j), k = construct_derivative(deriv, i)
-            # TODO triple work
-            grad = np.gradient(odata[..., j], *self.spacing)[k]
-            ddata[..., i] = grad
+        ddata = out
+        if ddata is None:
+            ddata = np.empty(odata.shape[:-1] + (2*deriv+1,), self.dtype)
+        n = odata.shape[0]
+        if chunksize is None:
+            chunksize = n
+        if pool is None:
+            pool = DummyPool()
+        axes = [construct_derivative(deriv, i)
+                for i in range(2*deriv+1)]
+        # bound the number of slabs in flight
+        pending = deque()
+        for a in range(0, n, chunksize):
+            b = min(a + chunksize, n)
+            pending.append((a, b, pool.apply_async(_derive_slab,
+                (odata, axes, self.spacing, a, b))))
+            if len(pending) > 4:
+                a, b, r = pending.popleft()
+                ddata[a:b] = r.get()
+        for a, b, r in pending:
+            ddata[a:b] = r.get()
         return ddata
 
+    def coefficients(self, derivative):
+        """Interpolation coefficients of a derivative order.
+
+        For `order=1` these are the data itself, for `order=3` the
+        cubic B-spline coefficients (with mirror boundary conditions)
+        of all components. They are cached until `data[derivative]` is
+        replaced.
+
+        Parameters
+        ----------
+        derivative : int
+            Derivative order.
+
+        Returns
+        -------
+        array, shape (n, m, k, l)
+        """
+        dat = self.data[derivative]
+        if self.order == 1:
+            return dat
+        try:
+            src, coeff = self._coefficients[derivative, self.order]
+            if src is dat:
+                return coeff
+        except KeyError:
+            pass
+        coeff = np.empty(dat.shape, self.dtype)
+        for i in range(dat.shape[-1]):
+            spline_filter(dat[..., i], order=self.order,
+                    output=coeff[..., i], mode="mirror")
+        self._coefficients[derivative, self.order] = dat, coeff
+        return coeff
+
     def potential(self, x, derivative=0, potential=1., out=None):
         x = (x - self.origin[None, :])/self.spacing[None, :]
+        if out is None:
+            out = np.zeros((x.shape[0], 2*derivative+1), self.dtype)
+        if self.path is not None and derivative >= len(self.data):
+            self.generate(derivative + 1)
+        coeff = self.coefficients(derivative)
+        # interpolation weights and mirrored voxel indices for each axis
+        idx, w = [], []
+        for xi, n in zip(x.T, coeff.shape[:3]):
+            xi = np.clip(xi, 0, n - 1)
+            i = np.clip(np.floor(xi), 0, max(n - 2, 0)).astype(np.intp)
+            idx_i, w_i = _spline_weights(xi - i, self.order)
+            idx_i = np.fabs(idx_i + i[:, None]).astype(np.intp)
+            idx_i = np.where(idx_i > n - 1, 2*(n - 1) - idx_i, idx_i)
+            idx.append(idx_i.clip(0, n - 1))
+            w.append(w_i.astype(coeff.dtype))
+        # loop over the x and y neighbors and contract z while
+        # gathering to keep the temporaries at O(order + 1) per point
+        v = np.zeros(out.shape, coeff.dtype)
+        for a in range(idx[0].shape[1]):
+            for b in range(idx[1].shape[1]):
+                c = coeff[idx[0][:, a, None], idx[1][:, b, None], idx[2]]
+                v += (w[0][:, a]*w[1][:, b])[:, None]*np.einsum(
+                        "nc,ncl->nl", w[2], c)
+        out += potential*v
+        return out
+
+
+def _derive_slab(odata, axes, spacing, a, b):
+    """Finite differences of `odata` on the planes `a:b` of the first
+    axis. `axes` lists the lower order component and the axis for each
+    output component, see `construct_derivative()`."""
+    lo, hi = max(a - 1, 0), min(b + 1, odata.shape[0])
+    slab = np.asarray(odata[lo:hi])
+    ddata = np.empty((b - a,) + slab.shape[1:-1] + (len(axes),),
+            slab.dtype)
+    for i, ((e, j), k) in enumerate(axes):
+        ddata[..., i] = np.gradient(slab[..., j], spacing[k],
+                axis=k)[a - lo:b - lo]
+    return ddata
+
+
+def _spline_weights(t, order):
+    """B-spline node offsets and weights for fractional coordinates `t`
+    in `[0, 1]` relative to the lower node."""
+    t = t[:, None]
+    if order == 1:
+        return np.arange(2)[None, :], np.c_[1 - t, t]
+    elif order == 3:
+        t2, t3 = t**2, t**3
+        return np.arange(-1, 3)[None, :], np.c_[(1 - t)**3,
+                3*t3 - 6*t2 + 4, -3*t3 + 3*t2 + 3*t + 1, t3]/6
+    raise ValueError("unsupported interpolation order %i" % order)
+
+
+class MultiGridElectrode(Electrode):
+    """Electrode based on several grids of different resolution.
+
+    Each point is evaluated on the first grid in `grids` that contains
+    it. Points outside all grids are evaluated on the last grid (which
+    clamps them to its boundary). Typically the first grids are small
+    and fine and cover the regions of interest while the last is coarse
+    and covers the entire volume.
+
+    Parameters
+    ----------
+    grids : list of GridElectrode
+        Grids in order of preference.
+
+    See Also
+    --------
+    Electrode
+        `name`, `dc`, `rf` attributes/parameters
+    GridElectrode
+    """
+    __slots__ = "grids".split()
+
+    def __init__(self, grids=[], **kwargs):
+        super(MultiGridElectrode, self).__init__(**kwargs)
+        self.grids = list(grids)
+
+    def _geometry_version(self):
+        return (super(MultiGridElectrode, self)._geometry_version(),
+                ) + tuple(g._geometry_version() for g in self.grids)
+
+    @classmethod
+    def from_grid(cls, grid, regions, step=4, **kwargs):
+        """Reduce a `GridElectrode` to full resolution blocks in some
+        regions and a subsampled grid elsewhere.
+
+        The blocks are copies of the grid data so that the original
+        grid can be released.
+
+        Parameters
+        ----------
+        grid : GridElectrode
+            All derivative orders present are kept.
+        regions : list of array_like, shape (2, 3)
+            Lower and upper corners of the boxes to keep at full
+            resolution.
+        step : int
+            Subsampling step of the coarse grid.
+        **kwargs : any
+            Passed to the constructor.
+
+        Returns
+        -------
+        MultiGridElectrode
+        """
+        shape = np.array(grid.data[0].shape[:3])
+        grids = []
+        for lo, hi in regions:
+            lo = np.floor((np.asanyarray(lo) - grid.origin)/grid.spacing)
+            hi = np.ceil((np.asanyarray(hi) - grid.origin)/grid.spacing)
+            lo = np.clip(lo, 0, shape - 1).astype(int)
+            hi = np.clip(hi + 1, lo + 1, shape).astype(int)
+            idx = tuple(slice(a, b) for a, b in zip(lo, hi))
+            grids.append(GridElectrode(
+                data=[np.array(d[idx]) for d in grid.data],
+                origin=grid.origin + lo*grid.spacing,
+                spacing=grid.spacing, order=grid.order, dtype=grid.dtype))
+        idx = (slice(None, None, step),)*3
+        grids.append(GridElectrode(
+            data=[np.array(d[idx]) for d in grid.data],
+            origin=grid.origin, spacing=grid.spacing*step,
+            order=grid.order, dtype=grid.dtype))
+        return cls(grids=grids, **kwargs)
+
+    def potential(self, x, derivative=0, potential=1., out=None):
+        x = np.asanyarray(x, np.double).reshape(-1, 3)
         if out is None:
             out = np.zeros((x.shape[0], 2*derivative+1), np.double)
-        dat = self.data[derivative]
-        for i in range(2*derivative+1):
-            out[:, i] += potential*map_coordinates(dat[..., i], x.T,
-                    order=1, mode="nearest")
+        todo = np.arange(x.shape[0])
+        for k, g in enumerate(self.grids):
+            if not len(todo):
+                break
+            if k < len(self.grids) - 1:
+                shape = np.array(g.data[0].shape[:3])
+                xi = (x[todo] - g.origin)/g.spacing
+                inside = np.all((xi >= 0) & (xi <= shape - 1), axis=1)
+            else:
+                inside = np.ones(len(todo), np.bool_)
+            i = todo[inside]
+            if len(i):
+                out[i] += g.potential(x[i], derivative, potential)
+            todo = todo[~inside]
         return out
+
+
+class TaylorElectrode(Electrode):
+    """Local Taylor expansion of the potential of an electrode.
+
+    Stores the reduced potential derivatives at a point and evaluates
+    the potential and its derivatives in the vicinity as polynomials.
+    Cheap to evaluate but only accurate close to `origin`.
+
+    Parameters
+    ----------
+    origin : array_like, shape (3,)
+        Expansion point.
+    derivatives : list of array_like, shape (2*k + 1,)
+        The reduced potential derivatives of orders `k = 0...order` at
+        `origin`.
+
+    See Also
+    --------
+    Electrode
+        `name`, `dc`, `rf` attributes/parameters
+    System.expand
+        Expand all electrodes of a `System`.
+    """
+    __slots__ = "origin derivatives".split()
+
+    def __init__(self, origin=(0, 0, 0), derivatives=[], **kwargs):
+        super(TaylorElectrode, self).__init__(**kwargs)
+        self.origin = np.asanyarray(origin, np.double)
+        self.derivatives = [np.asanyarray(i, np.double)
+                for i in derivatives]
+
+    @property
+    def order(self):
+        """Expansion order."""
+        return len(self.derivatives) - 1
+
+    def potential(self, x, derivative=0, potential=1., out=None):
+        x = np.asanyarray(x, np.double).reshape(-1, 3)
+        if out is None:
+            out = np.zeros((x.shape[0], 2*derivative+1), np.double)
+        out += potential*taylor_potential([d[None, :]
+            for d in self.derivatives], x - self.origin[None, :],
+            derivative)
+        return out
+
+
+class InstanceElectrode(Electrode):
+    """Translated instance of another electrode.
+
+    Several instances can share the same `electrode` (e.g. the
+    electrodes of a unit cell that is repeated in a trap array). Only
+    the geometry is shared. Each instance has its own name and
+    voltages. `System` evaluates all instances of the same electrode
+    in a single pass over its geometry (see
+    `System._packed_potentials()`).
+
+    Parameters
+    ----------
+    electrode : Electrode
+        The shared electrode. Its `name`, `dc` and `rf` are ignored.
+    offset : array_like, shape (3,)
+        Translation of this instance.
+
+    See Also
+    --------
+    Electrode
+        `name`, `dc`, `rf` attributes/parameters
+    """
+    __slots__ = "electrode offset".split()
+
+    def __init__(self, electrode=None, offset=(0, 0, 0), **kwargs):
+        super(InstanceElectrode, self).__init__(**kwargs)
+        self.electrode = electrode
+        self.offset = np.asanyarray(offset, np.double)
+
+    def _geometry_version(self):
+        return (super(InstanceElectrode, self)._geometry_version(),
+                self.electrode._geometry_version())
+
+    @property
+    def paths(self):
+        """Translated `paths` of the shared electrode (if it is a
+        `PolygonPixelElectrode`)."""
+        return [p + self.offset[None, :2] for p in self.electrode.paths]
+
+    def orientations(self):
+        return self.electrode.orientations()
+
+    def plot(self, ax, label=None, color=None, **kw):
+        if label is None:
+            label = self.name
+        if hasattr(self.electrode, "paths"):
+            PolygonPixelElectrode(paths=self.paths).plot(ax, label, color,
+                    **kw)
+
+    def potential(self, x, derivative=0, potential=1., out=None):
+        x = np.asanyarray(x, np.double).reshape(-1, 3)
+        return self.electrode.potential(x - self.offset, derivative,
+                potential, out)
+
+    def potential_derivatives(self, x, derivatives=(0,), potential=1.,
+            out=None):
+        x = np.asanyarray(x, np.double).reshape(-1, 3)
+        return self.electrode.potential_derivatives(x - self.offset,
+                derivatives, potential, out)
+
+
+def taylor_potential(derivatives, dx, derivative=0):
+    """Evaluate local Taylor expansions.
+
+    Parameters
+    ----------
+    derivatives : list of array_like, shape (n, 2*k + 1)
+        The reduced potential derivatives of orders `k = 0...order` at
+        the expansion points. The first axis may also be 1 to use the
+        same expansion for all points.
+    dx : array_like, shape (n, 3)
+        Offsets from the expansion points.
+    derivative : int
+        Derivative order.
+
+    Returns
+    -------
+    array, shape (n, 2*derivative + 1)
+        Reduced potential derivative.
+    """
+    dx = np.asanyarray(dx, np.double).reshape(-1, 3)
+    n = dx.shape[0]
+    out = np.zeros((n, 2*derivative+1), np.double)
+    for k in range(derivative, len(derivatives)):
+        c = np.broadcast_to(derivatives[k], (n, 2*k + 1))
+        c = expand_tensor(c, k)
+        for i in range(k - derivative):
+            c = np.einsum("ni,ni...->n...", dx, c)
+        c = select_tensor(c.reshape((n,) + (3,)*derivative), derivative)
+        out += c/factorial(k - derivative)
+    return out
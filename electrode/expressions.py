@@ -21,17 +21,72 @@ from __future__ import print_function, division, absolute_import
 
 from math import pi, sqrt, atan, atan2, fabs
 import logging
+import multiprocessing
 
 import numpy as np
 
 try:
     #raise ImportError
-    from numba import jit
+    import numba
+    from numba import jit, prange
 except ImportError:
+    numba = None
     jit = lambda *a, **k: lambda f: f
+    prange = range
 
 #logging.basicConfig(level=logging.DEBUG)
 
+_num_threads = 1
+
+
+def set_num_threads(n=None):
+    """Set the number of threads the kernels split the evaluation
+    points over.
+
+    Only effective with numba. The pure python kernels are always
+    single threaded.
+
+    Parameters
+    ----------
+    n : int or None
+        Number of threads. If None, use one thread per CPU.
+        The default is one thread.
+    """
+    global _num_threads
+    if n is None:
+        n = multiprocessing.cpu_count()
+    if n < 1:
+        raise ValueError("need at least one thread")
+    if numba is not None:
+        numba.set_num_threads(min(n, numba.config.NUMBA_NUM_THREADS))
+    _num_threads = n
+
+
+def get_num_threads():
+    """Return the number of threads used by the kernels."""
+    return _num_threads
+
+
+def pjit(signature):
+    """Like `jit(signature, nopython=True)` but also provide a
+    `parallel=True` variant (compiled on first use) that is called
+    instead if more than one thread is configured. The wrapped kernel
+    should use `prange()` for its outermost loop over the points."""
+    def wrap(func):
+        serial = jit(signature, nopython=True)(func)
+        parallel = []
+        def dispatch(*args):
+            if _num_threads == 1:
+                return serial(*args)
+            if not parallel:
+                parallel.append(jit(signature, nopython=True,
+                    parallel=True)(func))
+            return parallel[0](*args)
+        dispatch.__name__ = func.__name__
+        dispatch.__doc__ = func.__doc__
+        return dispatch
+    return wrap
+
 
 @jit("void(f8,f8,f8,f8,f8,i4,f8[:])", nopython=True)
 def point_potential_expr(x, y, z, r, a, derivative, d):
@@ -85,15 +140,15 @@ def point_potential_expr(x, y, z, r, a, derivative, d):
         d[10] += ((x**2-6*y**2)*(x**2+y**2)**2+(-11*x**4+90*x**2*y**2+101*y**4)*z**2-4*(x**2+29*y**2)*z**4+8*z**6)*n
 
 
-@jit("void(f8[:,:],f8[:,:],f8[:],f8,i4,i4,f8,f8[:,:])", nopython=True)
+@pjit("void(f8[:,:],f8[:,:],f8[:],f8,i4,i4,f8,f8[:,:])")
 def _point_potential(x, points, areas, potential, derivative,
         cover_nmax, cover_height, out):
     nx = x.shape[0]
     nv = points.shape[0]
 
-    for i in range(nv):
-        a0 = areas[i]*potential
-        for j in range(nx):
+    for j in prange(nx):
+        for i in range(nv):
+            a0 = areas[i]*potential
             x0 = x[j, 0] - points[i, 0]
             y0 = x[j, 1] - points[i, 1]
             for k in range(-cover_nmax, cover_nmax+1):
@@ -116,6 +171,47 @@ def point_potential(x, points, areas, potential, derivative,
     return out
 
 
+def _offsets(derivatives):
+    offsets = np.zeros(derivatives.shape[0] + 1, dtype=np.intc)
+    np.cumsum(2*derivatives + 1, out=offsets[1:])
+    return offsets
+
+
+@pjit("void(f8[:,:],f8[:,:],f8[:],f8,i4[:],i4[:],i4,f8,f8[:,:])")
+def _point_potentials(x, points, areas, potential, derivatives, offsets,
+        cover_nmax, cover_height, out):
+    nx = x.shape[0]
+    nv = points.shape[0]
+    nd = derivatives.shape[0]
+
+    for j in prange(nx):
+        for i in range(nv):
+            a0 = areas[i]*potential
+            x0 = x[j, 0] - points[i, 0]
+            y0 = x[j, 1] - points[i, 1]
+            for k in range(-cover_nmax, cover_nmax+1):
+                z0 = x[j, 2] + 2*k*cover_height
+                r0 = sqrt(x0**2 + y0**2 + z0**2)
+                for l in range(nd):
+                    point_potential_expr(x0, y0, z0, r0, a0,
+                            derivatives[l], out[j, offsets[l]:])
+
+
+def point_potentials(x, points, areas, potential, derivatives,
+        cover_nmax, cover_height, out):
+    assert x.shape[1] == 3
+    assert points.shape[1] == 2
+
+    nx = x.shape[0]
+    offsets = _offsets(derivatives)
+    if out is None:
+        out = np.zeros([nx, offsets[-1]], dtype=np.float64)
+    assert out.shape[1] == offsets[-1]
+    _point_potentials(x, points, areas, potential, derivatives, offsets,
+        cover_nmax, cover_height, out)
+    return out
+
+
 @jit("void(f8,f8,f8,f8,f8,f8,f8,f8,f8,i4,f8[:])", nopython=True)
 def edge_potential_expr(x1, x2, y1, y2, r1, r2, l2, z, a, derivative, d):
     if derivative == 0:
@@ -172,13 +268,13 @@ def edge_potential_expr(x1, x2, y1, y2, r1, r2, l2, z, a, derivative, d):
         d[10] += (3*(x1-x2)*(2*l2**2*(r1+r2)**4*(r1**4*r2**6*(3*r1**3-2*r1**2*r2+9*r1*r2**2+9*r2**3)*y1+r1**6*r2**4*(9*r1**3+9*r1**2*r2-2*r1*r2**2+3*r2**3)*y2-6*r1**2*r2**2*(15*r1*r2**6*y1+15*r2**7*y1+r1**5*r2**2*(3*y1-4*y2)+r1**3*r2**4*(y1-2*y2)+15*r1**7*y2+15*r1**6*r2*y2+r1**4*r2**3*(-2*y1+y2)+r1**2*r2**5*(-4*y1+3*y2))*z**2+(105*r1*r2**8*y1+105*r2**9*y1-3*r1**5*r2**4*(y1-4*y2)+15*r1**7*r2**2*(y1-2*y2)+3*r1**4*r2**5*(4*y1-y2)+105*r1**9*y2+105*r1**8*r2*y2+15*r1**2*r2**7*(-2*y1+y2)-5*r1**6*r2**3*(2*y1+y2)-5*r1**3*r2**6*(y1+2*y2))*z**4)-2*l2*(r1+r2)**6*(r1**4*r2**6*(3*r1+2*r2)*(r1**2+3*r2**2)*y1+r1**6*r2**4*(2*r1+3*r2)*(3*r1**2+r2**2)*y2-6*r1**2*r2**2*(15*r1*r2**6*y1+10*r2**7*y1+10*r1**7*y2+15*r1**6*r2*y2+r1**4*r2**3*(2*y1+y2)+r1**3*r2**4*(y1+2*y2)+r1**2*r2**5*(4*y1+3*y2)+r1**5*r2**2*(3*y1+4*y2))*z**2+(105*r1*r2**8*y1+70*r2**9*y1-5*r1**3*r2**6*(y1-2*y2)+5*r1**6*r2**3*(2*y1-y2)+70*r1**9*y2+105*r1**8*r2*y2+15*r1**2*r2**7*(2*y1+y2)-3*r1**4*r2**5*(4*y1+y2)+15*r1**7*r2**2*(y1+2*y2)-3*r1**5*r2**4*(y1+4*y2))*z**4)+(r1+r2)**8*(r1**4*r2**6*(2*r1**3+4*r1**2*r2+6*r1*r2**2+3*r2**3)*y1+r1**6*r2**4*(3*r1**3+6*r1**2*r2+4*r1*r2**2+2*r2**3)*y2-6*r1**2*r2**2*(10*r1*r2**6*y1+5*r2**7*y1+5*r1**7*y2+10*r1**6*r2*y2+2*r1**2*r2**5*(4*y1+y2)+2*r1**3*r2**4*(3*y1+2*y2)+2*r1**4*r2**3*(2*y1+3*y2)+2*r1**5*r2**2*(y1+4*y2))*z**2+5*(14*r1*r2**8*y1+7*r2**9*y1+7*r1**9*y2+14*r1**8*r2*y2+2*r1**2*r2**7*(6*y1+y2)+2*r1**3*r2**6*(5*y1+2*y2)+2*r1**4*r2**5*(4*y1+3*y2)+2*r1**5*r2**4*(3*y1+4*y2)+2*r1**6*r2**3*(2*y1+5*y2)+2*r1**7*r2**2*(y1+6*y2))*z**4)+l2**4*(3*r1**4*r2**9*y1-30*r1**2*r2**9*y1*z**2+35*r2**9*y1*z**4+r1**9*y2*(3*r2**4-30*r2**2*z**2+35*z**4))-2*l2**3*(15*r1**5*r2**10*y1+r1**6*r2**9*(10*y1+y2)-150*r1**3*r2**10*y1*z**2+175*r1*r2**10*y1*z**4+70*r2**11*y1*z**4+6*r1**4*r2**9*(r2**2*y1-(16*y1+y2)*z**2)+5*r1**2*r2**9*z**2*(-12*r2**2*y1+(22*y1+y2)*z**2)+2*r1**11*y2*(3*r2**4-30*r2**2*z**2+35*z**4)+5*r1**10*r2*y2*(3*r2**4-30*r2**2*z**2+35*z**4)+r1**9*r2**2*(r2**4*(y1+10*y2)-6*r2**2*(y1+16*y2)*z**2+5*(y1+22*y2)*z**4))))*n
 
 
-@jit("void(f8[:,:],f8[:,:],f8,i4,i4,f8,f8[:,:])", nopython=True)
+@pjit("void(f8[:,:],f8[:,:],f8,i4,i4,f8,f8[:,:])")
 def _polygon_potential(x, polygon, potential, derivative, cover_nmax,
         cover_height, out):
     nx = x.shape[0]
     no = polygon.shape[0]
 
-    for j in range(nx):
+    for j in prange(nx):
         for m in range(-cover_nmax, cover_nmax+1):
             x2 = x[j, 0] - polygon[no-1, 0]
             y2 = x[j, 1] - polygon[no-1, 1]
@@ -207,17 +303,110 @@ def polygon_potential(x, polygons, potential, derivative, cover_nmax,
         _polygon_potential(x, polygon, potential, derivative,
                 cover_nmax, cover_height, out)
     return out
+
+
+@pjit("void(f8[:,:],f8[:,:],f8,i4[:],i4[:],i4,f8,f8[:,:])")
+def _polygon_potentials(x, polygon, potential, derivatives, offsets,
+        cover_nmax, cover_height, out):
+    nx = x.shape[0]
+    no = polygon.shape[0]
+    nd = derivatives.shape[0]
+
+    for j in prange(nx):
+        for m in range(-cover_nmax, cover_nmax+1):
+            x2 = x[j, 0] - polygon[no-1, 0]
+            y2 = x[j, 1] - polygon[no-1, 1]
+            z = x[j, 2] + 2*m*cover_height
+            r2 = sqrt(x2**2 + y2**2 + z**2)
+            for k in range(no):
+                x1 = x2
+                y1 = y2
+                r1 = r2 # numba issue with tuple assign
+                x2 = x[j, 0] - polygon[k, 0]
+                y2 = x[j, 1] - polygon[k, 1]
+                r2 = sqrt(x2**2 + y2**2 + z**2)
+                l2 = (x1 - x2)**2 + (y1 - y2)**2
+                for l in range(nd):
+                    edge_potential_expr(x1, x2, y1, y2, r1, r2, l2, z,
+                            potential, derivatives[l], out[j, offsets[l]:])
+
+
+def polygon_potentials(x, polygons, potential, derivatives, cover_nmax,
+        cover_height, out):
+    assert x.shape[1] == 3
+    nx = x.shape[0]
+    offsets = _offsets(derivatives)
+    if out is None:
+        out = np.zeros([nx, offsets[-1]], dtype=np.float64)
+    assert out.shape[1] == offsets[-1]
+    for polygon in polygons:
+        assert polygon.shape[1] == 2
+        _polygon_potentials(x, polygon, potential, derivatives, offsets,
+                cover_nmax, cover_height, out)
+    return out
  
 
-@jit("void(f8[:,:],f8[:,:],i4[:,:],i4[:],f8[:],i4,i4,f8,f8[:,:])",
-    nopython=True)
+@pjit("void(f8[:,:],f8[:,:],i4[:],i4[:],f8[:],i4[:],i4[:],i4,f8,"
+    "f8[:,:,:])")
+def _packed_polygon_potentials(x, points, offsets, index, potentials,
+        derivatives, doffsets, cover_nmax, cover_height, out):
+    nx = x.shape[0]
+    npoly = index.shape[0]
+    nd = derivatives.shape[0]
+
+    for j in prange(nx):
+        for i in range(npoly):
+            a = offsets[i]
+            b = offsets[i+1]
+            if b <= a:
+                continue
+            for m in range(-cover_nmax, cover_nmax+1):
+                x2 = x[j, 0] - points[b-1, 0]
+                y2 = x[j, 1] - points[b-1, 1]
+                z = x[j, 2] + 2*m*cover_height
+                r2 = sqrt(x2**2 + y2**2 + z**2)
+                for k in range(a, b):
+                    x1 = x2
+                    y1 = y2
+                    r1 = r2 # numba issue with tuple assign
+                    x2 = x[j, 0] - points[k, 0]
+                    y2 = x[j, 1] - points[k, 1]
+                    r2 = sqrt(x2**2 + y2**2 + z**2)
+                    l2 = (x1 - x2)**2 + (y1 - y2)**2
+                    for l in range(nd):
+                        edge_potential_expr(x1, x2, y1, y2, r1, r2, l2, z,
+                                potentials[i], derivatives[l],
+                                out[index[i], j, doffsets[l]:])
+
+
+def packed_polygon_potentials(x, points, offsets, index, potentials,
+        derivatives, cover_nmax, cover_height, out):
+    assert x.shape[1] == 3
+    assert points.shape[1] == 2
+    npoly = index.shape[0]
+    assert offsets.shape[0] == npoly + 1
+    assert potentials.shape[0] == npoly
+
+    nx = x.shape[0]
+    doffsets = _offsets(derivatives)
+    if out is None:
+        out = np.zeros([index.max() + 1 if npoly else 1, nx,
+            doffsets[-1]], dtype=np.float64)
+    assert out.shape[1] == nx
+    assert out.shape[2] == doffsets[-1]
+    _packed_polygon_potentials(x, points, offsets, index, potentials,
+        derivatives, doffsets, cover_nmax, cover_height, out)
+    return out
+
+
+@pjit("void(f8[:,:],f8[:,:],i4[:,:],i4[:],f8[:],i4,i4,f8,f8[:,:])")
 def _mesh_potential(x, points, edges, polygons, potentials, derivative,
         cover_nmax, cover_height, out):
     nx = x.shape[0]
     ne = edges.shape[0]
 
-    for i in range(ne):
-        for j in range(nx):
+    for j in prange(nx):
+        for i in range(ne):
             for k in range(-cover_nmax, cover_nmax+1):
                 z = x[j, 2] + 2*k*cover_height
                 x1 = x[j, 0] - points[edges[i, 0], 0]
@@ -245,3 +434,85 @@ def mesh_potential(x, points, edges, polygons, potentials, derivative,
     _mesh_potential(x, points, edges, polygons, potentials, derivative,
         cover_nmax, cover_height, out)
     return out
+
+
+@pjit("void(f8[:,:],f8[:,:],i4[:,:],i4[:],f8[:],i4[:],i4[:],i4,f8,"
+    "f8[:,:])")
+def _mesh_potentials(x, points, edges, polygons, potentials, derivatives,
+        offsets, cover_nmax, cover_height, out):
+    nx = x.shape[0]
+    ne = edges.shape[0]
+    nd = derivatives.shape[0]
+
+    for j in prange(nx):
+        for i in range(ne):
+            for k in range(-cover_nmax, cover_nmax+1):
+                z = x[j, 2] + 2*k*cover_height
+                x1 = x[j, 0] - points[edges[i, 0], 0]
+                y1 = x[j, 1] - points[edges[i, 0], 1]
+                r1 = sqrt(x1**2 + y1**2 + z**2)
+                x2 = x[j, 0] - points[edges[i, 1], 0]
+                y2 = x[j, 1] - points[edges[i, 1], 1]
+                r2 = sqrt(x2**2 + y2**2 + z**2)
+                l2 = (x1 - x2)**2 + (y1 - y2)**2
+                potential = potentials[polygons[i]]
+                for l in range(nd):
+                    edge_potential_expr(x1, x2, y1, y2, r1, r2, l2, z,
+                            potential, derivatives[l], out[j, offsets[l]:])
+
+
+def mesh_potentials(x, points, edges, polygons, potentials, derivatives,
+        cover_nmax, cover_height, out):
+    assert polygons.shape[0] == edges.shape[0]
+    assert edges.shape[1] == 2
+    assert points.shape[1] == 2
+    assert x.shape[1] == 3
+
+    nx = x.shape[0]
+    offsets = _offsets(derivatives)
+    if out is None:
+        out = np.zeros([nx, offsets[-1]], dtype=np.float64)
+    assert out.shape[1] == offsets[-1]
+    _mesh_potentials(x, points, edges, polygons, potentials, derivatives,
+        offsets, cover_nmax, cover_height, out)
+    return out
+
+
+@pjit("void(f8[:,:],f8[:,:],i4[:,:],i4[:],i4[:],i4,f8,f8[:,:,:])")
+def _mesh_edge_potentials(x, points, edges, derivatives, offsets,
+        cover_nmax, cover_height, out):
+    nx = x.shape[0]
+    ne = edges.shape[0]
+    nd = derivatives.shape[0]
+
+    for j in prange(nx):
+        for i in range(ne):
+            for k in range(-cover_nmax, cover_nmax+1):
+                z = x[j, 2] + 2*k*cover_height
+                x1 = x[j, 0] - points[edges[i, 0], 0]
+                y1 = x[j, 1] - points[edges[i, 0], 1]
+                r1 = sqrt(x1**2 + y1**2 + z**2)
+                x2 = x[j, 0] - points[edges[i, 1], 0]
+                y2 = x[j, 1] - points[edges[i, 1], 1]
+                r2 = sqrt(x2**2 + y2**2 + z**2)
+                l2 = (x1 - x2)**2 + (y1 - y2)**2
+                for l in range(nd):
+                    edge_potential_expr(x1, x2, y1, y2, r1, r2, l2, z,
+                            1., derivatives[l], out[i, j, offsets[l]:])
+
+
+def mesh_edge_potentials(x, points, edges, derivatives, cover_nmax,
+        cover_height, out):
+    assert edges.shape[1] == 2
+    assert points.shape[1] == 2
+    assert x.shape[1] == 3
+
+    nx = x.shape[0]
+    ne = edges.shape[0]
+    offsets = _offsets(derivatives)
+    if out is None:
+        out = np.zeros([ne, nx, offsets[-1]], dtype=np.float64)
+    assert out.shape == (ne, nx, offsets[-1])
+    _mesh_edge_potentials(x, points, edges, derivatives, offsets,
+        cover_nmax, cover_height, out)
+    return out
@@ -0,0 +1,333 @@
+# -*- coding: utf8 -*-
+#
+#   electrode: numeric tools for Paul traps
+#
+#   Copyright (C) 2011-2012 Robert Jordens <jordens@phys.ethz.ch>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Hierarchical far-field evaluation of polygon electrodes.
+
+The potential of a patch `A` of a surface electrode is the area
+integral of the point pixel potential `f` (see `PointPixelElectrode`).
+Seen from a point `x` far away from a cluster of patches with center `c`
+and extent `R < |x - c|` it can be Taylor expanded::
+
+    sum_ab (-1)**(a + b)/(a! b!) M_ab d_x**a d_y**b f(x - c)
+
+in terms of the area moments `M_ab` of the cluster about `c`. The
+derivatives of `f` are harmonic and are taken from the point pixel
+kernels in their reduced form. The area moments are exact surface
+integrals computed from the polygon edges with Green's theorem and
+Gauss-Legendre quadrature.
+
+The expansion is truncated at order `p` such that the total derivative
+order `derivative + p` does not exceed 5, the highest order the kernels
+provide. Its relative error is of order `(R/|x - c|)**(p + 1)`.
+"""
+
+from __future__ import (absolute_import, print_function,
+        unicode_literals, division)
+
+from math import factorial
+
+import numpy as np
+
+from .utils import deriv_to_reduced_idx, _derivative_names
+from .electrode import point_potentials, packed_polygon_potentials
+
+
+_max_derivative = 5
+
+# Gauss-Legendre nodes and weights on [0, 1], exact for the edge
+# integrands of degree up to 2*4 - 1 = 7 > _max_derivative + 1
+_gauss_t, _gauss_w = np.polynomial.legendre.leggauss(4)
+_gauss_t, _gauss_w = (_gauss_t + 1)/2, _gauss_w/2
+
+# binomial coefficients _binomial[a, i] = a!/(i! (a - i)!)
+_binomial = np.array([[factorial(a)/(factorial(i)*factorial(a - i))
+    if i <= a else 0. for i in range(_max_derivative + 1)]
+    for a in range(_max_derivative + 1)])
+
+_tables = {}
+
+
+def _exponents(order):
+    """Moment exponents `(a, b)` with `a + b <= order`."""
+    return [(a, k - a) for k in range(order + 1) for a in range(k + 1)]
+
+
+def _combination_table(derivative, order):
+    """Sparse map from the area moments and the concatenated reduced
+    point pixel derivatives of orders `derivative ... derivative +
+    order` to the reduced derivative of order `derivative`.
+
+    Returns
+    -------
+    rows : array of int
+        Index into the concatenated point pixel derivatives.
+    cols : array of int
+        Index into the reduced output derivative.
+    moments : array of int
+        Index into the flattened moments, `a*(order + 1) + b`.
+    coefficients : array of float
+    """
+    key = derivative, order
+    try:
+        return _tables[key]
+    except KeyError:
+        pass
+    offsets = np.cumsum([0] + [2*k + 1
+        for k in range(derivative, derivative + order + 1)])
+    rows, cols, moments, coefficients = [], [], [], []
+    for a, b in _exponents(order):
+        offset = offsets[a + b]
+        coeff = (-1)**(a + b)/(factorial(a)*factorial(b))
+        for j, name in enumerate(_derivative_names[derivative]):
+            r = deriv_to_reduced_idx(name + "x"*a + "y"*b)
+            if type(r) is int:
+                r, coeff_r = (r,), coeff
+            else:
+                coeff_r = -coeff # laplace
+            for ri in r:
+                rows.append(offset + ri)
+                cols.append(j)
+                moments.append(a*(order + 1) + b)
+                coefficients.append(coeff_r)
+    table = (np.array(rows), np.array(cols), np.array(moments),
+            np.array(coefficients))
+    _tables[key] = table
+    return table
+
+
+class PolygonTree(object):
+    """Binary space partitioning tree over packed polygons for
+    Barnes-Hut style far-field evaluation.
+
+    The polygons are recursively split at the median of their centers
+    along the wider axis of the bounding box until at most `leaf_size`
+    remain in a node. Each node covers a contiguous range of polygons
+    in tree order.
+
+    Parameters
+    ----------
+    points : array_like, shape (n, 2)
+    offsets : array_like, shape (m + 1,)
+        Packed polygons, see `electrode.pack_polygons()`.
+    leaf_size : int
+        Maximum number of polygons in a leaf node.
+    """
+    def __init__(self, points, offsets, leaf_size=8):
+        points = np.asanyarray(points, np.double)
+        offsets = np.asanyarray(offsets, np.intc)
+        counts = np.diff(offsets)
+        polygons = np.flatnonzero(counts)
+        vertex_polygon = np.repeat(np.arange(len(counts)), counts)
+        lower = np.full((len(counts), 2), np.inf)
+        upper = np.full((len(counts), 2), -np.inf)
+        np.minimum.at(lower, vertex_polygon, points[:offsets[-1]])
+        np.maximum.at(upper, vertex_polygon, points[:offsets[-1]])
+        self.leaf_size = leaf_size
+        self.order = []
+        self.lo, self.hi, self.children = [], [], []
+        self.centers, self.radii = [], []
+        if len(polygons):
+            self._build(polygons, lower, upper)
+        self.order = np.array(self.order, np.intc)
+        self.centers = np.array(self.centers).reshape(-1, 2)
+        self.radii = np.array(self.radii)
+
+        # polygons in tree order
+        counts = counts[self.order]
+        self.offsets = np.zeros(len(self.order) + 1, np.intc)
+        np.cumsum(counts, out=self.offsets[1:])
+        if len(self.order):
+            self.points = np.ascontiguousarray(np.concatenate([
+                points[offsets[i]:offsets[i + 1]] for i in self.order]))
+        else:
+            self.points = np.zeros((0, 2), np.double)
+
+        # edge quadrature for the moments, polygon i has the
+        # quadrature points qx[offsets[i]:offsets[i + 1]]
+        previous = np.arange(self.offsets[-1]) - 1
+        previous[self.offsets[:-1]] = self.offsets[1:] - 1
+        p0, p1 = self.points[previous], self.points
+        t = _gauss_t[None, :]
+        self.qx = p0[:, 0, None] + t*(p1[:, 0, None] - p0[:, 0, None])
+        self.qy = p0[:, 1, None] + t*(p1[:, 1, None] - p0[:, 1, None])
+        self.qw = _gauss_w[None, :]*(p1[:, 1, None] - p0[:, 1, None])
+        self.qpolygon = np.repeat(np.arange(len(self.order)), counts)
+
+    def _build(self, polygons, lower, upper):
+        node = len(self.lo)
+        self.lo.append(len(self.order))
+        self.hi.append(None)
+        self.children.append(())
+        lo, up = lower[polygons].min(0), upper[polygons].max(0)
+        center = (lo + up)/2
+        self.centers.append(center)
+        dist = np.maximum(np.fabs(lower[polygons] - center),
+                np.fabs(upper[polygons] - center))
+        self.radii.append(np.sqrt(np.square(dist).sum(1).max()))
+        if len(polygons) <= self.leaf_size:
+            self.order.extend(polygons)
+        else:
+            axis = np.argmax(up - lo)
+            mid = (lower[polygons, axis] + upper[polygons, axis])/2
+            i = np.argsort(mid, kind="mergesort")
+            k = len(polygons)//2
+            self.children[node] = (
+                self._build(polygons[i[:k]], lower, upper),
+                self._build(polygons[i[k:]], lower, upper))
+        self.hi[node] = len(self.order)
+        return node
+
+    def _moments(self, node, index, weights, order, cache):
+        """Area moments of the polygons in `node` about its center for
+        each output index occurring in the node.
+
+        Leaf moments are integrated directly. Those of inner nodes are
+        the moments of their children translated to the node center.
+        Results are memoized in `cache`.
+
+        Returns
+        -------
+        outputs : array, shape (k,)
+            Unique output indices.
+        moments : array, shape (k, order + 1, order + 1)
+            `moments[:, a, b]` is the moment `M_ab`. Only `a + b <=
+            order` is valid.
+        """
+        try:
+            return cache[node]
+        except KeyError:
+            pass
+        center = self.centers[node]
+        if not self.children[node]:
+            lo = self.offsets[self.lo[node]]
+            hi = self.offsets[self.hi[node]]
+            polygons = self.qpolygon[lo:hi]
+            outputs, inverse = np.unique(index[polygons],
+                    return_inverse=True)
+            powers = np.arange(order + 1)
+            du = (self.qx[lo:hi] - center[0]).ravel()
+            dv = (self.qy[lo:hi] - center[1]).ravel()
+            # integrate u**(a + 1)/(a + 1)*v**b dv along the edges
+            u = du[:, None]**(powers + 1)/(powers + 1)
+            v = dv[:, None]**powers
+            w = (self.qw[lo:hi]*weights[polygons, None]).ravel()
+            w = w[:, None]*np.eye(len(outputs))[
+                    inverse.ravel().repeat(len(_gauss_t))]
+            moments = np.einsum("qk,qa,qb->kab", w, u, v)
+        else:
+            parts = [self._moments(c, index, weights, order, cache)
+                    for c in self.children[node]]
+            outputs = np.unique(np.concatenate([o for o, m in parts]))
+            moments = np.zeros((len(outputs), order + 1, order + 1))
+            binomial = _binomial[:order + 1, :order + 1]
+            powers = np.subtract.outer(np.arange(order + 1),
+                    np.arange(order + 1)).clip(0)
+            for c, (o, m) in zip(self.children[node], parts):
+                dx, dy = self.centers[c] - center
+                tx, ty = binomial*dx**powers, binomial*dy**powers
+                moments[np.searchsorted(outputs, o)] += np.einsum(
+                        "ai,kij,bj->kab", tx, m, ty)
+        cache[node] = outputs, moments
+        return outputs, moments
+
+    def potential(self, x, index, weights, derivative, cover_nmax=0,
+            cover_height=50., tolerance=1e-6, out=None):
+        """Potential contributions of the polygons.
+
+        Nodes that are far enough from a point are evaluated using
+        their multipole expansion, the others are opened and in leaves
+        the polygons are evaluated exactly.
+
+        Parameters
+        ----------
+        x : array_like, shape (n, 3)
+            Points to evaluate at.
+        index : array_like, shape (m,)
+            Output index of each polygon (as passed to the
+            constructor).
+        weights : array_like, shape (m,)
+            Potential of each polygon.
+        derivative : int
+            Derivative order.
+        cover_nmax : int
+        cover_height : float
+            See `SurfaceElectrode`.
+        tolerance : float
+            Approximate relative error of the expansion. Nodes are
+            expanded if their radius is smaller than `tolerance**(1/(p +
+            1))` times their distance to the point, where `p = 5 -
+            derivative` is the expansion order. If zero, all polygons
+            are evaluated exactly.
+        out : None or array_like, shape (k, n, 2*derivative + 1)
+            Array to add the contributions of polygon `i` to at
+            `out[index[i]]`. If None, it is created.
+
+        Returns
+        -------
+        out : array, shape (k, n, 2*derivative + 1)
+        """
+        x = np.ascontiguousarray(x, np.double).reshape(-1, 3)
+        index = np.asanyarray(index, np.intc)[self.order]
+        weights = np.asanyarray(weights, np.double)[self.order]
+        if out is None:
+            out = np.zeros((index.max() + 1 if len(index) else 1,
+                x.shape[0], 2*derivative + 1), np.double)
+        if not len(self.order):
+            return out
+        order = _max_derivative - derivative
+        theta = tolerance**(1./(order + 1))
+        rows, cols, mi, coeffs = _combination_table(derivative, order)
+        derivatives = np.arange(derivative, derivative + order + 1,
+                dtype=np.intc)
+        cache = {}
+        stack = [(0, np.arange(x.shape[0]))]
+        while stack:
+            node, i = stack.pop()
+            center = self.centers[node]
+            r2 = np.square(x[i, :2] - center).sum(1) + np.square(x[i, 2])
+            far = self.radii[node]**2 < theta**2*r2
+            if np.any(far):
+                j = i[far]
+                outputs, moments = self._moments(node, index, weights,
+                        order, cache)
+                w = np.zeros((len(outputs), (2*derivatives + 1).sum(),
+                    2*derivative + 1))
+                np.add.at(w, (slice(None), rows, cols),
+                        coeffs*moments.reshape(len(outputs), -1)[:, mi])
+                d = point_potentials(np.ascontiguousarray(x[j]),
+                        center[None, :], np.ones(1), 1., derivatives,
+                        cover_nmax, cover_height, None)
+                out[np.ix_(outputs, j)] += np.einsum("nl,klm->knm", d, w)
+                i = i[~far]
+            if not len(i):
+                continue
+            if self.children[node]:
+                stack.extend((c, i) for c in self.children[node])
+                continue
+            lo, hi = self.lo[node], self.hi[node]
+            outputs, inverse = np.unique(index[lo:hi],
+                    return_inverse=True)
+            d = np.zeros((len(outputs), len(i), 2*derivative + 1))
+            packed_polygon_potentials(np.ascontiguousarray(x[i]),
+                    self.points, self.offsets[lo:hi + 1],
+                    inverse.ravel().astype(np.intc), weights[lo:hi],
+                    np.array([derivative], np.intc), cover_nmax,
+                    cover_height, d)
+            out[np.ix_(outputs, i)] += d
+        return out
@@ -48,6 +48,55 @@ class Constraint(object):
         return
         yield
 
+    def objectives(self, system, n):
+        """Matrix form of the objectives for the matrix backends of
+        `System.optimize()`.
+
+        Parameters
+        ----------
+        system : System
+        n : int
+            Number of electrode potential variables, `len(system)`.
+
+        Yields
+        ------
+        (B, v) : array, shape (m, n) and array, shape (m,)
+            The objectives `B*u` to be kept proportional to `v`.
+        """
+        raise NotImplementedError("%s has no matrix form" %
+                type(self).__name__)
+
+    def penalties(self, system, n):
+        """Matrix form of weighted penalties. Like `objectives()`
+        but yielding `(D, w, abs)` to subtract `w*sum(abs(D*u))` (or
+        `w*sum(D*u)` if not `abs`) from the maximized objective."""
+        return
+        yield
+
+    def equalities(self, system, n):
+        """Matrix form of the equality constraints for the matrix
+        backends of `System.optimize()`.
+
+        Parameters
+        ----------
+        system : System
+        n : int
+            Number of electrode potential variables, `len(system)`.
+
+        Yields
+        ------
+        (A, b) : array, shape (m, n) and array, shape (m,)
+            The constraints `A*u == b` on the electrode potentials `u`.
+        """
+        raise NotImplementedError("%s has no matrix form" %
+                type(self).__name__)
+
+    def inequalities(self, system, n):
+        """Matrix form of the inequality constraints. Like
+        `equalities()` but yielding `(G, h)` for `G*u <= h`."""
+        raise NotImplementedError("%s has no matrix form" %
+                type(self).__name__)
+
 
 class PatternRangeConstraint(Constraint):
     """Constrains the potential to lie within the given range
@@ -78,6 +127,31 @@ class PatternRangeConstraint(Constraint):
                 if self.max is not None:
                     yield variables <= self.max
 
+    def _matrix(self, n):
+        i = np.arange(n)
+        if self.index is not None:
+            i = np.atleast_1d(i[self.index])
+        e = np.zeros((len(i), n))
+        e[np.arange(len(i)), i] = 1
+        return e
+
+    def objectives(self, system, n):
+        return
+        yield
+
+    def equalities(self, system, n):
+        if self.min is not None and self.min == self.max:
+            e = self._matrix(n)
+            yield e, np.ones(e.shape[0])*self.min
+
+    def inequalities(self, system, n):
+        if self.min != self.max:
+            e = self._matrix(n)
+            if self.min is not None:
+                yield -e, -np.ones(e.shape[0])*self.min
+            if self.max is not None:
+                yield e, np.ones(e.shape[0])*self.max
+
 
 class SingleValueConstraint(Constraint):
     """Base class for Constraints/Objectives.
@@ -109,6 +183,11 @@ class SingleValueConstraint(Constraint):
             c = self.get(system, variables)
             yield c, float(self.value)
 
+    def objectives(self, system, n):
+        if self.value is not None:
+            c = self.get(system, None)
+            yield c[None, :], np.array([float(self.value)])
+
     def constraints(self, system, variables):
         if (self.offset is not None
             or self.min is not None
@@ -123,6 +202,19 @@ class SingleValueConstraint(Constraint):
             if self.max is not None:
                 yield v <= float(self.max)
 
+    def equalities(self, system, n):
+        if self.offset is not None:
+            c = self.get(system, None)
+            yield c[None, :], np.array([float(self.offset)])
+
+    def inequalities(self, system, n):
+        if self.min is not None or self.max is not None:
+            c = self.get(system, None)
+            if self.min is not None:
+                yield -c[None, :], np.array([-float(self.min)])
+            if self.max is not None:
+                yield c[None, :], np.array([float(self.max)])
+
 
 class PotentialObjective(SingleValueConstraint):
     """Constrain or optimize potential.
@@ -236,6 +328,36 @@ class VoltageDerivativeConstraint(Constraint):
             for v in self.coef(system, variables):
                 yield v >= float(self.min)
 
+    def _matrix(self, system, n):
+        # the differences of the single voltage vector: scalars, their
+        # norms are their absolute values
+        return np.array(self.get(system, list(np.identity(n)))).reshape(
+                -1, n)
+
+    def objectives(self, system, n):
+        return
+        yield
+
+    def penalties(self, system, n):
+        if self.weight:
+            yield self._matrix(system, n), float(self.weight), self.abs
+
+    def equalities(self, system, n):
+        return
+        yield
+
+    def inequalities(self, system, n):
+        d = self._matrix(system, n)
+        if self.max is not None:
+            yield d, np.ones(d.shape[0])*self.max
+            if self.abs:
+                yield -d, np.ones(d.shape[0])*self.max
+        if self.min is not None:
+            if self.abs:
+                raise ValueError("lower bound on absolute value is not "
+                        "convex")
+            yield -d, -np.ones(d.shape[0])*self.min
+
 
 class SymmetryConstaint(Constraint):
     def __init__(self, a, b):
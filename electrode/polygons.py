@@ -20,17 +20,21 @@
 from __future__ import (absolute_import, print_function,
                         unicode_literals, division)
 
+import io
+import os
 import logging
 import operator
+import struct
 
 import numpy as np
 from scipy.interpolate import splprep, splev
 from shapely import geometry, ops
-from gdsii import library, structure, elements
+from shapely.strtree import STRtree
+from gdsii import library, structure, elements, record, tags, exceptions
 
 from .system import System
-from .electrode import PolygonPixelElectrode
-from .utils import area_centroid
+from .electrode import PolygonPixelElectrode, InstanceElectrode
+from .utils import area_centroid, DummyPool
 
 logger = logging.getLogger("electrode")
 
@@ -177,7 +181,7 @@ class Polygons(list):
     @classmethod
     def from_gds(cls, fil, scale=1., name=None, poly_layers=None,
                  gap_layers=None, route_layers=[], bridge_layers=[],
-                 name_layers=None, **kwargs):
+                 name_layers=None, progress=None, **kwargs):
         """Opens a GDS Library and converts a Structure to a `Polygons`
         instance.
 
@@ -190,7 +194,8 @@ class Polygons(list):
             height. Defaults to 1 (one meter).
         name : str
             Name of the Structure (aka Cell) in the GDS file to be used.
-            The first if `name` is `None`.
+            The first if `name` is `None`. Raises `ValueError` if there
+            is no such Structure.
         poly_layers : list of tuples (layer number, data type number)
             Layers and datatypes where polygons are to be extraced and
             used. E.g. [(13, 6), (14, 0)].
@@ -207,6 +212,8 @@ class Polygons(list):
         name_layers : list of integers (layer number)
             Layers where a text at a position names the electrode at this
             position.
+        progress : callable
+            Progress callback, see `read_gds()`.
         **kwargs : passed to `cls.from_data()`
 
         Returns
@@ -215,20 +222,32 @@ class Polygons(list):
 
         See also
         --------
-        from_data()
+        from_data(), read_gds()
         """
-        lib = library.Library.load(fil)
+        path_layers = (route_layers + bridge_layers + gap_layers
+                       if gap_layers is not None else None)
+
+        def accept(e):
+            # filter before the coordinates are read
+            if isinstance(e, elements.Boundary):
+                return poly_layers is None or (
+                    e.layer, e.data_type) in poly_layers
+            elif isinstance(e, elements.Path):
+                return path_layers is None or (
+                    e.layer, e.data_type) in path_layers
+            elif isinstance(e, elements.Text):
+                return name_layers is None or e.layer in name_layers
+            logger.debug("%s skipped", e)
+            return False
+
+        physical_unit, elems = read_gds(fil, name, accept, progress)
         polys = []
         gaps = []
         routes = []
         bridges = []
         names = []
-        for stru in lib:
-            assert isinstance(stru, structure.Structure)
-            if name is None or name == stru.name.decode():
-                break
-        for e in stru:
-            path = np.array(e.xy)*lib.physical_unit/scale
+        for e in elems:
+            path = np.array(e.xy)*physical_unit/scale
             props = dict(e.properties)
             name = props.get(cls._attr_name, b"").decode()
             if isinstance(e, elements.Boundary):
@@ -391,7 +410,7 @@ class Polygons(list):
                 if edge:
                     poly = poly.intersection(field)
                 xy = np.array(poly.exterior.coords.xy).copy()
-                xy = xy.T[:, :2]*scale/phys_unit
+                xy = np.around(xy.T[:, :2]*scale/phys_unit).astype(np.int64)
                 if text_layer is not None and name:
                     p = elements.Text(layer=text_layer[0],
                                       text_type=text_layer[1], xy=xy[:1],
@@ -421,7 +440,7 @@ class Polygons(list):
             #    g = [g]
             for loop in g:
                 xy = np.array(loop.coords.xy).copy()
-                xy = xy.T[:, :2]*scale/phys_unit
+                xy = np.around(xy.T[:, :2]*scale/phys_unit).astype(np.int64)
                 #xy = np.r_[xy, xy[:1]]
                 p = elements.Path(layer=gap_layer[0],
                                   data_type=gap_layer[1], xy=xy)
@@ -445,26 +464,50 @@ class Polygons(list):
     def remove_overlaps(self):
         """Successively removes overlaps with preceeding electrodes.
 
+        Only preceeding electrodes with overlapping bounding boxes are
+        considered. Their union is formed with a divide and conquer
+        tree union.
+
         Returns
         -------
         Polygons
             Output with overlaps removed
         """
+        polys = [pi for ni, pi in self]
+        # the bounding boxes of the original polygons contain those of
+        # the trimmed ones: only those can overlap
+        neighbors = [[] for i in polys]
+        for i, j in _query_pairs(polys, polys):
+            if j < i:
+                neighbors[i].append(j)
         p = Polygons()
-        acc = geometry.Point()
-        for ni, pi in self:
+        for (ni, pi), nj in zip(self, neighbors):
+            acc = _tree_union([p[j][1] for j in nj], geometry.Point())
             pa = acc.intersection(pi)
             if pa.is_valid and pa.area > np.finfo(np.float32).eps:
                 pc = pi.difference(pa)
                 if pc.is_valid:
                     pi = pc
-            acca = acc.union(pi)
-            if acca.is_valid:
-                acc = acca
             p.append((ni, pi))
         return p
 
-    def add_gaps(self, gapsize=0):
+    def _map(self, func, args=(), pool=None):
+        """Apply `func(name, poly, *args)` to each electrode
+        (in parallel if a `pool` is given) and collect the
+        `(name, poly)` results in order. Electrodes for which `func`
+        returns `None` are dropped."""
+        if pool is None:
+            pool = DummyPool()
+        res = [(ni, pool.apply_async(func, (ni, pi) + tuple(args)))
+               for ni, pi in self]
+        p = Polygons()
+        for ni, r in res:
+            pi = r.get()
+            if pi is not None:
+                p.append((ni, pi))
+        return p
+
+    def add_gaps(self, gapsize=0, pool=None):
         """Shrinks each electrode by adding a buffer around it.
 
         Gaps between previously touching electrodes will be gapsize wide
@@ -475,19 +518,17 @@ class Polygons(list):
         gapsize : float
            Size of the gap. Each polygon will be buffered by
            `-gapsize/2`.
+        pool : None or Pool
+            Pool (e.g. `multiprocessing.pool.ThreadPool` or
+            `multiprocessing.Pool`) to process the electrodes in
+            parallel. If None, process them serially.
 
         Returns
         -------
         Polygons
             Output with gaps added
         """
-        p = Polygons()
-        for ni, pi in self:
-            pb = pi.buffer(-gapsize/2., 1)
-            if pb.is_valid:
-                pi = pb
-            p.append((ni, pi))
-        return p
+        return self._map(_add_gaps, (gapsize,), pool)
 
     def unify_by_name(self):
         """For unary unions of polygons with the same name"""
@@ -496,22 +537,24 @@ class Polygons(list):
             d.setdefault(n, []).append(pi)
         return Polygons((n, ops.unary_union(v)) for n, v in d.items())
 
-    def unify(self):
+    def unify(self, pool=None):
         """Form unary unions of polygons in each electrode
 
+        Parameters
+        ----------
+        pool : None or Pool
+            Pool (e.g. `multiprocessing.pool.ThreadPool` or
+            `multiprocessing.Pool`) to process the electrodes in
+            parallel. If None, process them serially.
+
         Returns
         -------
         Polygons
             Output containing unions of electrode polygons.
         """
-        p = Polygons()
-        for ni, pi in self:
-            if not hasattr(pi, "geoms"):
-                pi = [pi]
-            p.append((ni, ops.unary_union(list(pi))))
-        return p
+        return self._map(_unify, (), pool)
 
-    def simplify(self, buffer=0, preserve_topology=False):
+    def simplify(self, buffer=0, preserve_topology=False, pool=None):
         """Simplify the polygons.
 
         See the shapely method for details
@@ -524,6 +567,10 @@ class Polygons(list):
             `buffer` away from the original geometry.
         preserve_topology : bool
             See shapely documentation.
+        pool : None or Pool
+            Pool (e.g. `multiprocessing.pool.ThreadPool` or
+            `multiprocessing.Pool`) to process the electrodes in
+            parallel. If None, process them serially.
 
         Returns
         -------
@@ -531,14 +578,10 @@ class Polygons(list):
             Simplified output
         """
         if buffer == 0:
-            return self.add_gaps(buffer)
-        p = Polygons()
-        for ni, pi in self:
-            p.append((ni, pi.simplify(
-                buffer, preserve_topology=preserve_topology)))
-        return p
+            return self.add_gaps(buffer, pool)
+        return self._map(_simplify, (buffer, preserve_topology), pool)
 
-    def filter(self, test=None, deep=True):
+    def filter(self, test=None, deep=True, pool=None):
         """Drops all patches that fail the test function.
 
         Parameters
@@ -551,6 +594,11 @@ class Polygons(list):
         deep : bool
             If `True`, apply test to every boundary (exterior and
             interiors), else every polygon.
+        pool : None or Pool
+            Pool (e.g. `multiprocessing.pool.ThreadPool` or
+            `multiprocessing.Pool`) to process the electrodes in
+            parallel. If None, process them serially.
+            With a process pool, `test` must be picklable.
 
         Returns
         -------
@@ -558,27 +606,10 @@ class Polygons(list):
             Filtered output
         """
         if test is None and deep:
-            def test(name, boundary):
-                return abs(geometry.Polygon(boundary).area) > 1e-2
-
-        p = Polygons()
-        for ni, pi in self:
-            if not hasattr(pi, "geoms"):
-                pi = [pi]
-            if deep:
-                pe = []
-                for ppi in pi:
-                    if test(ni, ppi.exterior):
-                        pe.append(geometry.Polygon(
-                            ppi.exterior,
-                            [_ for _ in ppi.interiors if test(ni, _)]))
-            else:
-                pe = [_ for _ in pi if test(ni, _)]
-            if pe:
-                p.append((ni, geometry.MultiPolygon(pe)))
-        return p
+            test = _min_area
+        return self._map(_filter, (test, deep), pool)
 
-    def smooth(self, **kwargs):
+    def smooth(self, pool=None, **kwargs):
         """Smoothes the polygons.
 
         Parameters
@@ -589,40 +620,25 @@ class Polygons(list):
             Enables straight path detection. Straight segment weight.
         corner : float
             Enables corner detection. Corner weight.
+        pool : None or Pool
+            Pool (e.g. `multiprocessing.pool.ThreadPool` or
+            `multiprocessing.Pool`) to process the electrodes in
+            parallel. If None, process them serially.
 
         Returns
         -------
         Polygons
             Smoothed output
         """
-        p = Polygons()
-        for name, mpoly in self:
-            smoothed = []
-            if not hasattr(mpoly, "geoms"):
-                mpoly = [mpoly]
-            for poly in mpoly:
-                loops = []
-                b = poly.boundary
-                try:
-                    len(b)
-                except TypeError:
-                    b = [b]
-                for line in b:
-                    x, y = line.coords.xy
-                    xn, yn = smooth(x, y, **kwargs)
-                    loops.append(np.c_[xn, yn])
-                # TODO: does not ensure that all interiors are within
-                # exterior and that the interiors do not overlap
-                exterior, interior = loops[0], loops[1:]
-                if len(exterior) >= 3:
-                    interior = [_ for _ in interior if len(_) >= 3]
-                    smoothed.append(geometry.Polygon(exterior, interior))
-            p.append((name, geometry.MultiPolygon(smoothed)))
-        return p
+        return self._map(_smooth, (kwargs,), pool)
 
     def assign_to_pad(self, pads):
         """Finds polygons intersecting the points given.
 
+        Each pad is assigned the first not yet assigned polygon that
+        it intersects. All intersections are found in one bulk query
+        against a bounding box tree (STRtree) of the polygons.
+
         Parameters
         ----------
         pads : list of tuples (float, float)
@@ -634,25 +650,29 @@ class Polygons(list):
             Iterator over matching tuples `(pad number, polygon_index)`
             Unmatched polygons are yielded as `(None, polygon_index)`.
         """
-        polys = list(range(len(self)))
-        for pad, (x, y) in enumerate(pads):
-            p = geometry.Point(x, y)
-            for i in polys:
-                name, poly = self[i]
-                if p.intersects(poly):
-                    yield pad, i
-                    polys.remove(i)
-                    break
+        pads = [geometry.Point(x, y) for x, y in pads]
+        pairs = _query_pairs(pads, [poly for name, poly in self],
+                             predicate="intersects")
+        # greedy in pad order: each pad takes the first free polygon
+        polys = set(range(len(self)))
+        last = None
+        for pad, i in pairs:
+            if pad == last or i not in polys:
+                continue
+            yield pad, i
+            polys.remove(i)
+            last = pad
             if not polys:
                 break
-        for i in polys:
+        for i in sorted(polys):
             yield None, i
 
     def gaps_union(self):
         """Union of the boundaries of the polygons.
 
         If the boundaries of adjacent polygons coincide, this returns
-        only the gap paths.
+        only the gap paths. The union is formed with a divide and
+        conquer tree union.
 
         Returns
         -------
@@ -666,27 +686,494 @@ class Polygons(list):
             for poly in multipoly:
                 gaps.append(poly.boundary)
         #return ops.cascaded_union(gaps) # segfaults
-        g = geometry.LineString()
-        for i in gaps:
-            g = g.union(i)
-        return g
+        return _tree_union(gaps, geometry.LineString())
 
-    def restrict(self, geometry):
+    def restrict(self, geometry, pool=None):
         """Intersect each constituent with the given geometry.
 
+        Parameters
+        ----------
+        geometry : shapely geometry
+        pool : None or Pool
+            Pool (e.g. `multiprocessing.pool.ThreadPool` or
+            `multiprocessing.Pool`) to process the electrodes in
+            parallel. If None, process them serially.
+
         Returns
         -------
         Polygons
         """
-        p = Polygons()
-        for name, multipoly in self:
-            p.append((name, multipoly.intersection(geometry)))
-        return p
+        return self._map(_restrict, (geometry,), pool)
 
-    def within(self, edge=50):
+    def within(self, edge=50, pool=None):
         e = edge/2.
         g = geometry.Polygon([(e, e), (-e, e), (-e, -e), (e, -e)])
-        return self.restrict(g)
+        return self.restrict(g, pool)
+
+
+_gds_header = struct.Struct(">HH")
+
+_gds_elements = {
+    tags.BOUNDARY: elements.Boundary, tags.PATH: elements.Path,
+    tags.SREF: elements.SRef, tags.AREF: elements.ARef,
+    tags.TEXT: elements.Text, tags.NODE: elements.Node,
+    tags.BOX: elements.Box,
+}
+
+# element attributes taking the full record data
+_gds_whole = {
+    tags.ELFLAGS: "elflags", tags.PRESENTATION: "presentation",
+    tags.STRANS: "strans", tags.SNAME: "struct_name",
+    tags.STRING: "string",
+}
+
+# element attributes taking the first datum
+_gds_first = {
+    tags.PLEX: "plex", tags.LAYER: "layer", tags.DATATYPE: "data_type",
+    tags.TEXTTYPE: "text_type", tags.NODETYPE: "node_type",
+    tags.BOXTYPE: "box_type", tags.PATHTYPE: "path_type",
+    tags.WIDTH: "width", tags.BGNEXTN: "bgn_extn",
+    tags.ENDEXTN: "end_extn", tags.MAG: "mag", tags.ANGLE: "angle",
+}
+
+
+def read_gds(fil, name=None, accept=None, progress=None,
+             progress_step=1 << 24, structures=False):
+    """Streaming reader for the elements of a Structure in a GDS file.
+
+    Unlike `gdsii.library.Library.load()` this does not hold the
+    library in memory. Structures other than the selected one are
+    skipped record by record and the (large) coordinate data of
+    elements is only parsed if the element is accepted.
+
+    Parameters
+    ----------
+    fil : file or str
+        GDS file (opened in binary mode) or file name. A file opened
+        here is closed once `elements` is exhausted or closed.
+    name : str
+        Name of the Structure (aka Cell) to read. The first if `name`
+        is `None`. Iterating `elements` raises `ValueError` if there is
+        no Structure of that name.
+    accept : callable
+        Called as `accept(element)` with the `gdsii.elements` instance
+        once all its records preceeding the coordinates (layer, data
+        type, structure name etc.) are known. The element is skipped
+        without parsing its coordinates if this returns `False`. If
+        `None`, all elements are accepted.
+    progress : callable
+        Called as `progress(position, size)` every `progress_step`
+        bytes and at the end. `size` is the file size or `None` if
+        unknown.
+    progress_step : int
+    structures : bool
+        If `True`, read all structures (ignoring `name`) and yield
+        `(structure name, element)` tuples.
+
+    Returns
+    -------
+    physical_unit : float
+        Physical length of one database unit in meters.
+    elements : iterator
+        Iterator over the accepted `gdsii.elements` instances. The
+        coordinates `xy` are (n, 2) integer arrays in database units.
+    """
+    close = not hasattr(fil, "read")
+    if close:
+        fil = open(fil, "rb")
+    try:
+        size = os.fstat(fil.fileno()).st_size
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        size = None
+    seekable = hasattr(fil, "seekable") and fil.seekable()
+    pos = [0, progress_step]
+
+    def header():
+        h = fil.read(4)
+        if len(h) != 4:
+            raise exceptions.EndOfFileError
+        n, tag = _gds_header.unpack(h)
+        if n < 4 or n % 2:
+            raise exceptions.IncorrectDataSize(n)
+        pos[0] += n
+        if progress is not None and pos[0] >= pos[1]:
+            progress(pos[0], size)
+            pos[1] += progress_step
+        return tag, n - 4
+
+    def read(n):
+        data = fil.read(n)
+        if len(data) != n:
+            raise exceptions.EndOfFileError
+        return data
+
+    def parse(tag, n):
+        data = read(n)
+        return record.Record.read(io.BytesIO(
+            _gds_header.pack(n + 4, tag) + data)).data
+
+    def skip(n):
+        if seekable:
+            fil.seek(n, 1)
+        else:
+            read(n)
+
+    try:
+        tag, n = header()
+        while tag != tags.UNITS:
+            skip(n)
+            tag, n = header()
+        user_unit, physical_unit = parse(tag, n)
+    except:
+        if close:
+            fil.close()
+        raise
+
+    def iterate():
+        try:
+            for e in elements():
+                yield e
+        finally:
+            if close:
+                fil.close()
+
+    def elements():
+        selected = found = keep = False
+        e = attr = None
+        while True:
+            tag, n = header()
+            if tag == tags.ENDLIB:
+                break
+            elif tag == tags.STRNAME:
+                sname = parse(tag, n).decode()
+                selected = structures or (not found and (
+                    name is None or name == sname))
+                found |= selected
+            elif tag == tags.ENDSTR:
+                if selected and not structures:
+                    break
+            elif not selected:
+                skip(n)
+            elif tag in _gds_elements:
+                e = _gds_element(tag)
+                e.properties = []
+                keep = True
+            elif tag == tags.ENDEL:
+                if keep:
+                    yield (sname, e) if structures else e
+                e = None
+            elif not keep:
+                skip(n)
+            elif tag == tags.XY:
+                keep = accept is None or accept(e)
+                if keep:
+                    xy = np.frombuffer(read(n), ">i4")
+                    e.xy = xy.reshape(-1, 2).astype(np.int32)
+                else:
+                    skip(n)
+            elif tag == tags.PROPATTR:
+                attr = parse(tag, n)[0]
+            elif tag == tags.PROPVALUE:
+                e.properties.append((attr, parse(tag, n)))
+            elif tag == tags.COLROW:
+                e.cols, e.rows = parse(tag, n)
+            elif tag in _gds_whole:
+                setattr(e, _gds_whole[tag], parse(tag, n))
+            elif tag in _gds_first:
+                setattr(e, _gds_first[tag], parse(tag, n)[0])
+            else:
+                skip(n)
+        if not found and not structures:
+            raise ValueError("structure %s not found" % name)
+        if progress is not None:
+            progress(pos[0], size)
+
+    return physical_unit, iterate()
+
+
+def _gds_element(tag):
+    """Empty `gdsii.elements` instance for the element record `tag`.
+
+    The constructors require the mandatory records which are not known
+    yet when streaming. All attributes (the `__slots__` of the element
+    class) start out as `None`."""
+    cls = _gds_elements[tag]
+    e = cls.__new__(cls)
+    for k in cls.__slots__:
+        setattr(e, k, None)
+    return e
+
+
+def _gds_transforms(e):
+    """Affine transforms, shape (3, 3), of the instances of an `SRef`
+    or `ARef` in database units."""
+    t = np.identity(3)
+    if e.strans is not None and e.strans & 0x8000:
+        t[1, 1] = -1  # reflection about the x axis
+    a = np.deg2rad(e.angle or 0.)
+    r = np.array([[np.cos(a), -np.sin(a)], [np.sin(a), np.cos(a)]])
+    t[:2, :2] = (e.mag or 1.)*np.dot(r, t[:2, :2])
+    xy = np.asanyarray(e.xy, np.double)
+    if isinstance(e, elements.ARef):
+        dc, dr = (xy[1] - xy[0])/e.cols, (xy[2] - xy[0])/e.rows
+        origins = [xy[0] + i*dc + j*dr
+                   for j in range(e.rows) for i in range(e.cols)]
+    else:
+        origins = xy[:1]
+    for o in origins:
+        ti = t.copy()
+        ti[:2, 2] = o
+        yield ti
+
+
+def system_from_gds(fil, scale=1., name=None, poly_layers=None,
+                    progress=None, **kwargs):
+    """Read a hierarchical GDS Structure into a `System` keeping
+    repeated cells as instances.
+
+    Boundaries are grouped into electrodes by their name property
+    (see `Polygons.to_gds()`), unnamed ones by the name of their
+    Structure. Structure references (SRef) and arrays (ARef) are
+    followed recursively. Those that (including all references above
+    them) only translate the referenced Structure become
+    `InstanceElectrode` of the electrodes formed by its own
+    Boundaries. Those are shared between all instances of the
+    Structure and evaluated only once per `System` evaluation.
+    References that rotate, reflect or magnify are flattened, together
+    with everything below them, into separate electrodes and a warning
+    is logged. Both are named `"%s_%i" % (name, instance index)`,
+    counting the references to each Structure. Paths and texts are
+    ignored.
+
+    Parameters
+    ----------
+    fil : file or str
+        GDS file to be opened.
+    scale : float
+        Natural length scale to rescale the data to. Usually the ion
+        height. Defaults to 1 (one meter).
+    name : str
+        Name of the top Structure. If `None`, the last Structure that
+        is not referenced by any other. Raises `ValueError` if there is
+        no such Structure.
+    poly_layers : list of tuples (layer number, data type number)
+        Layers and datatypes of the Boundaries to be used.
+    progress : callable
+        Progress callback, see `read_gds()`.
+    **kwargs : passed to `PolygonPixelElectrode()`
+
+    Returns
+    -------
+    System
+    """
+    def accept(e):
+        if isinstance(e, elements.Boundary):
+            return poly_layers is None or (
+                e.layer, e.data_type) in poly_layers
+        return isinstance(e, (elements.SRef, elements.ARef))
+
+    physical_unit, elems = read_gds(fil, accept=accept, progress=progress,
+                                    structures=True)
+    cells = {}
+    referenced = set()
+    for sname, e in elems:
+        cells.setdefault(sname, []).append(e)
+        if hasattr(e, "struct_name"):
+            referenced.add(e.struct_name.decode())
+    if name is None:
+        name = [n for n in cells if n not in referenced][-1]
+    elif name not in cells:
+        raise ValueError("structure %s not found" % name)
+    factor = physical_unit/scale
+
+    def boundaries(cell, t, paths):
+        for e in cells.get(cell, []):
+            if not isinstance(e, elements.Boundary):
+                continue
+            xy = e.xy
+            if np.all(xy[0] == xy[-1]):
+                xy = xy[:-1]
+            p = (np.dot(xy, t[:2, :2].T) + t[:2, 2])*factor
+            if area_centroid(p)[0] < 0:
+                p = p[::-1]
+            props = dict(e.properties)
+            n = props.get(Polygons._attr_name, b"").decode() or cell
+            paths.setdefault(n, []).append(p)
+
+    def references(cell, t):
+        for e in cells.get(cell, []):
+            if not isinstance(e, elements.Boundary):
+                for ti in _gds_transforms(e):
+                    yield e.struct_name.decode(), np.dot(t, ti)
+
+    def flatten(cell, t, paths):
+        boundaries(cell, t, paths)
+        for sname, ti in references(cell, t):
+            flatten(sname, ti, paths)
+
+    s = System()
+    shared, count = {}, {}
+
+    def instantiate(cell, t):
+        for sname, ti in references(cell, t):
+            k = count[sname] = count.get(sname, -1) + 1
+            if not np.allclose(ti[:2, :2], np.identity(2)):
+                logger.warning("reference %i to %s rotates, reflects or "
+                               "magnifies, flattening", k, sname)
+                p = {}
+                flatten(sname, ti, p)
+                for n in sorted(p):
+                    s.append(PolygonPixelElectrode(name="%s_%i" % (n, k),
+                                                   paths=p[n], **kwargs))
+                continue
+            if sname not in shared:
+                p = {}
+                boundaries(sname, np.identity(3), p)
+                shared[sname] = [PolygonPixelElectrode(name=n, paths=p[n],
+                                                       **kwargs)
+                                 for n in sorted(p)]
+            offset = ti[:2, 2]*factor
+            for e in shared[sname]:
+                s.append(InstanceElectrode(name="%s_%i" % (e.name, k),
+                                           electrode=e,
+                                           offset=(offset[0], offset[1],
+                                                   0)))
+            instantiate(sname, ti)
+
+    paths = {}
+    boundaries(name, np.identity(3), paths)
+    for n in sorted(paths):
+        s.append(PolygonPixelElectrode(name=n, paths=paths[n], **kwargs))
+    instantiate(name, np.identity(3))
+    return s
+
+
+# per-electrode transforms for Polygons._map(), module level to be
+# picklable for process pools
+
+def _add_gaps(name, poly, gapsize):
+    pb = poly.buffer(-gapsize/2., 1)
+    if pb.is_valid:
+        poly = pb
+    return poly
+
+
+def _unify(name, poly):
+    if not hasattr(poly, "geoms"):
+        poly = [poly]
+    return ops.unary_union(list(poly))
+
+
+def _simplify(name, poly, buffer, preserve_topology):
+    return poly.simplify(buffer, preserve_topology=preserve_topology)
+
+
+def _min_area(name, boundary):
+    return abs(geometry.Polygon(boundary).area) > 1e-2
+
+
+def _filter(name, poly, test, deep):
+    if not hasattr(poly, "geoms"):
+        poly = [poly]
+    if deep:
+        pe = []
+        for ppi in poly:
+            if test(name, ppi.exterior):
+                pe.append(geometry.Polygon(
+                    ppi.exterior,
+                    [_ for _ in ppi.interiors if test(name, _)]))
+    else:
+        pe = [_ for _ in poly if test(name, _)]
+    if pe:
+        return geometry.MultiPolygon(pe)
+
+
+def _smooth(name, mpoly, kwargs):
+    smoothed = []
+    if not hasattr(mpoly, "geoms"):
+        mpoly = [mpoly]
+    for poly in mpoly:
+        loops = []
+        b = poly.boundary
+        try:
+            len(b)
+        except TypeError:
+            b = [b]
+        for line in b:
+            x, y = line.coords.xy
+            xn, yn = smooth(x, y, **kwargs)
+            loops.append(np.c_[xn, yn])
+        # TODO: does not ensure that all interiors are within
+        # exterior and that the interiors do not overlap
+        exterior, interior = loops[0], loops[1:]
+        if len(exterior) >= 3:
+            interior = [_ for _ in interior if len(_) >= 3]
+            smoothed.append(geometry.Polygon(exterior, interior))
+    return geometry.MultiPolygon(smoothed)
+
+
+def _restrict(name, poly, geom):
+    return poly.intersection(geom)
+
+
+def _query_pairs(queries, geoms, predicate=None):
+    """Bulk query of all (query index, geometry index) pairs whose
+    bounding boxes intersect (or that satisfy `predicate` if given)
+    using a bounding box tree. The pairs are sorted by query index,
+    then geometry index."""
+    if not len(queries) or not len(geoms):
+        return []
+    tree = STRtree(geoms)
+    try:
+        pairs = tree.query(queries, predicate=predicate)
+    except TypeError:
+        # shapely < 2: per-geometry queries returning geometries
+        index = dict((id(g), i) for i, g in enumerate(geoms))
+        pairs = [(j, index[id(g)]) for j, p in enumerate(queries)
+                 for g in tree.query(p)
+                 if predicate is None or getattr(p, predicate)(g)]
+        pairs = np.array(pairs, dtype=np.intp).reshape(-1, 2).T
+    order = np.lexsort((pairs[1], pairs[0]))
+    return pairs[:, order].T.tolist()
+
+
+def _tree_union(geoms, empty=None):
+    """Divide and conquer union.
+
+    The geometries are recursively split in two halves at the median
+    of their bounding box centers along the longer extent. Each union
+    then only involves spatially compact, similarly sized operands
+    instead of a growing accumulator.
+
+    Parameters
+    ----------
+    geoms : list of shapely geometries
+    empty : shapely geometry
+        Returned if `geoms` is empty. Defaults to an empty
+        `GeometryCollection`.
+
+    Returns
+    -------
+    shapely geometry
+        Union of `geoms`.
+    """
+    if not geoms:
+        return geometry.GeometryCollection() if empty is None else empty
+    bounds = np.array([g.bounds for g in geoms], dtype=np.double)
+    centers = (bounds[:, :2] + bounds[:, 2:])/2
+    # empty geometries have nan bounds
+    centers[np.isnan(centers)] = 0
+
+    def union(idx):
+        if len(idx) == 1:
+            return geoms[idx[0]]
+        c = centers[idx]
+        axis = np.argmax(c.max(0) - c.min(0))
+        idx = idx[np.argsort(c[:, axis], kind="mergesort")]
+        n = len(idx)//2
+        return union(idx[:n]).union(union(idx[n:]))
+
+    return union(np.arange(len(geoms)))
 
 
 def square_pads(step=10., edge=200., odd=False, start_corner=0):
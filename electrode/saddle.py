@@ -24,84 +24,132 @@ from __future__ import (absolute_import, print_function,
 import numpy as np
 
 
-def rfo(fun, grad, x0, args=(), 
+def _bofill(h, dx, dg):
+    """Batched Bofill update of the hessians `h` (n, k, k) given the
+    steps `dx` (n, k) and the gradient changes `dg` (n, k)."""
+    dp = dg - np.einsum("nij,nj->ni", h, dx)
+    dxdx = np.einsum("ni,ni->n", dx, dx)[:, None, None]
+    dpdx = np.einsum("ni,ni->n", dp, dx)[:, None, None]
+    dpdp = np.einsum("ni,ni->n", dp, dp)[:, None, None]
+    dxdx = np.where(dxdx == 0, 1., dxdx)
+    pdx = dp[:, :, None]*dx[:, None, :]
+    dh_powell = (pdx + pdx.transpose(0, 2, 1))/dxdx - \
+            dpdx*dx[:, :, None]*dx[:, None, :]/dxdx**2
+    dh_sr1 = dp[:, :, None]*dp[:, None, :]/np.where(dpdx == 0, 1., dpdx)
+    phi = dpdx**2/np.where(dpdp == 0, 1., dpdp*dxdx)
+    return phi*dh_sr1 + (1 - phi)*dh_powell
+
+
+def rfo(fun, grad, x0, args=(),
         xtol=1e-4, ftol=1e-4, maxiter=200, dx_max=1., h=None, cb=None):
     """Rational function optimization with approximate hessian.
 
     Finds a saddle point of fun near x0 using a modified Newton-Raphson.
     The Hessian is approximated with Bofill updates.
 
+    Several independent searches can be run in lockstep by passing
+    start points of shape (n, k). `fun` and `grad` are then called with
+    the (m, k) points of the m searches that have not converged yet and
+    need to return arrays of shape (m,) and (m, k). Function and
+    gradient are evaluated once per step and search.
+
     See "Comparison of methods for finding saddle points without
     knowledge of the final states", R. A. Olsen et al., J. Chem. Phys.,
     121, 20, (2004).
-    """
 
-    x = np.matrix(x0).T.copy()
-    f = fun(np.array(x).ravel())
-    g = np.matrix(grad(np.array(x).ravel())).T
+    Parameters
+    ----------
+    fun : callable
+        `fun(x, *args)`, the function.
+    grad : callable
+        `grad(x, *args)`, its gradient.
+    x0 : array_like, shape (k,) or (n, k)
+        Start point(s).
+    args : tuple
+        Additional arguments to `fun` and `grad`.
+    xtol, ftol : float
+        Relative tolerances on the step and the function change.
+    maxiter : int
+        Maximum number of steps. No limit if zero.
+    dx_max : float
+        Maximum step length.
+    h : None or array_like, shape (k, k) or (n, k, k)
+        Initial hessian, identity if None.
+    cb : None or callable
+        `cb(x, f, g, h)` is called before each step with the state of
+        the unconverged searches.
+
+    Returns
+    -------
+    x : array, shape (k,) or (n, k)
+        Saddle point(s).
+    f : float or array, shape (n,)
+        Function value(s) at `x`.
+    ret : str or array of str, shape (n,)
+        Termination reason(s), `"xtol"`, `"ftol"`, or `"iter"`.
+    """
+    x = np.array(x0, np.double)
+    single = x.ndim == 1
+    if single:
+        fun1, grad1 = fun, grad
+        fun = lambda x, *a: fun1(x[0], *a)
+        grad = lambda x, *a: grad1(x[0], *a)
+        x = x[None, :]
+    n, k = x.shape
+    f = np.array(fun(x, *args), np.double).reshape(n)
+    g = np.array(grad(x, *args), np.double).reshape(n, k)
     if h is None:
-        h = np.matrix(np.identity(x.size))
-    else:
-        h = np.matrix(h)
+        h = np.identity(k)
+    h = np.array(np.broadcast_to(h, (n, k, k)), np.double)
 
-    d = np.ones((x.size,))
+    d = np.ones((k,))
     d[0] *= -1
 
+    ret = np.zeros(n, dtype="U5")
+    active = np.arange(n)
     it = 0
 
-    ret = None
-
-    while True:
-
+    while len(active):
         it += 1
-
-        #print "i", it
-        #print "x", x
-        #print "f", f
-        #print "g", g
-        #print "h", h
-        #print
+        xa, fa, ga, ha = x[active], f[active], g[active], h[active]
         if cb is not None:
-            cb(x, f, g, h)
-        if ret:
-            break
-
-        l, v = np.linalg.eigh(h)
-        i = np.argsort(l)
-        l, v = l[i], v[i]
-        v = np.matrix(v)
-
-        gl = np.array(v.T*g).ravel()
-        lmg = .5*d*(abs(l) + np.sqrt(l**2 + 4*gl**2))
-
-        dx = -v*np.matrix(gl/lmg).T
-        dx /= max(1., np.linalg.norm(dx)/dx_max)
-        df = fun(np.array(x + dx).ravel()) - f
-        dg = np.matrix(grad(np.array(x + dx).ravel())).T - g
-        dp = dg - h*dx
-        dh_powell = (dp*dx.T + dx*dp.T)/(dx.T*dx) - \
-                float(dp.T*dx)*(dx*dx.T)/(dx.T*dx)**2
-        dh_sr1 = (dp*dp.T)/(dp.T*dx)
-        phi = float((dp.T*dx)**2/((dp.T*dp)*(dx.T*dx)))
-        dh_bofill = phi*dh_sr1 + (1-phi)*dh_powell
-        dh = dh_bofill
-
-        if 2.*np.linalg.norm(dx) <= xtol * (
-                np.linalg.norm(x+dx) + np.linalg.norm(x) + 1e-20):
-            ret = "xtol"
-
-        if 2.*np.abs(df) <= ftol * (abs(f+df) + abs(f) + 1e-20):
-            ret = "ftol"
-
+            if single:
+                cb(xa[0], fa[0], ga[0], ha[0])
+            else:
+                cb(xa, fa, ga, ha)
+        done = ret[active] != ""
+        if np.any(done):
+            active = active[~done]
+            continue
+
+        l, v = np.linalg.eigh(ha)
+        gl = np.einsum("nji,nj->ni", v, ga)
+        lmg = .5*d*(np.fabs(l) + np.sqrt(l**2 + 4*gl**2))
+        dx = -np.einsum("nij,nj->ni", v, gl/np.where(lmg == 0, 1., lmg))
+        dx /= np.maximum(1., np.sqrt(np.square(dx).sum(1))/dx_max)[:, None]
+        x1 = xa + dx
+        f1 = np.array(fun(x1, *args), np.double).reshape(-1)
+        g1 = np.array(grad(x1, *args), np.double).reshape(-1, k)
+        df = f1 - fa
+
+        r = ret[active]
+        r[2.*np.sqrt(np.square(dx).sum(1)) <= xtol*(
+            np.sqrt(np.square(x1).sum(1)) +
+            np.sqrt(np.square(xa).sum(1)) + 1e-20)] = "xtol"
+        r[2.*np.fabs(df) <= ftol*(np.fabs(f1) + np.fabs(fa) + 1e-20)] = \
+                "ftol"
         if maxiter > 0 and it > maxiter:
-            ret = "iter"
+            r[:] = "iter"
+        ret[active] = r
 
-        x += dx
-        f += df
-        g += dg
-        h += dh
+        x[active] = x1
+        f[active] = f1
+        g[active] = g1
+        h[active] = ha + _bofill(ha, dx, g1 - ga)
 
-    return np.array(x).ravel(), f, ret
+    if single:
+        return x[0], f[0], ret[0]
+    return x, f, ret
 
 
 if __name__ == "__main__":
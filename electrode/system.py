@@ -21,6 +21,7 @@ from __future__ import (absolute_import, print_function,
         unicode_literals, division)
 
 import warnings, itertools
+from collections import OrderedDict
 from contextlib import contextmanager
 import logging
 
@@ -55,9 +56,12 @@ except ImportError:
 
 from .transformations import euler_from_matrix
 from .saddle import rfo
-from .electrode import PolygonPixelElectrode
+from .electrode import (PolygonPixelElectrode, MeshPixelElectrode,
+        TaylorElectrode, InstanceElectrode, pack_polygons,
+        packed_polygon_potentials, taylor_potential, _split_potentials)
+from .multipole import PolygonTree
 from .utils import (expand_tensor, norm, rotate_tensor,
-    mathieu, name_to_deriv)
+    mathieu, name_to_deriv, DummyPool)
 from .pattern_constraints import (PatternRangeConstraint,
         PotentialObjective)
 from . import colors
@@ -65,6 +69,183 @@ from . import colors
 
 logger = logging.getLogger("electrode")
 
+# relative tolerance for merging the relative positions of
+# InstanceElectrode, see System._packed_potentials()
+_instance_rtol = 2.**-40
+
+
+def _solve_lp(g, B, v, A, b, G, h, backend="lp", verbose=False,
+        rcond=1e-9, x0=None, cost=None, **kwargs):
+    """Solve the linear program of `System.optimize()` in matrix form.
+
+    Maximizes `g*p` (or `cost*p` if given) subject to `B*p` being
+    proportional to `v`, `A*p == b` and `G*p <= h`. `g` is the
+    inhomogeneous solution of `B*g == v`. `x0` is an optional primal
+    start point for the `"lp"` backend.
+
+    Returns
+    -------
+    p : array
+        Solution.
+    c : float
+        Solution strength.
+    """
+    n = B.shape[1]
+    g2 = np.inner(g, g)
+    if cost is None:
+        cost = g
+    # B*g_perp*p == 0, one singular value vanishes by construction
+    A, b = _row_basis(np.concatenate([A, B - np.outer(v, g)/g2]),
+            np.r_[b, np.zeros(B.shape[0])], rcond)
+    if verbose:
+        logger.info("variables: %i", n)
+        logger.info("inequalities: %i", G.shape[0])
+        logger.info("equalities: %i", A.shape[0])
+    if backend == "lp":
+        cvxopt.solvers.options.update(**kwargs)
+        cvxopt.solvers.options["show_progress"] = verbose
+        m = lambda a: cvxopt.sparse(cvxopt.matrix(a))
+        start = None
+        if x0 is not None:
+            # the slacks need to be strictly positive
+            x0 = np.asanyarray(x0, np.double)
+            start = {"x": cvxopt.matrix(x0),
+                     "s": cvxopt.matrix(np.maximum(h - np.dot(G, x0),
+                         1e-6))}
+        res = cvxopt.solvers.lp(cvxopt.matrix(-cost), m(G),
+                cvxopt.matrix(h), m(A), cvxopt.matrix(b),
+                primalstart=start)
+        if not res["status"] == "optimal":
+            raise ValueError("solve failed: %s" % res["status"])
+        p = np.array(res["x"], np.double).ravel()
+    elif backend == "scipy":
+        from scipy import sparse
+        res = optimize.linprog(-cost, A_ub=sparse.csr_matrix(G)
+                if G.shape[0] else None, b_ub=h if G.shape[0] else None,
+                A_eq=sparse.csr_matrix(A), b_eq=b,
+                bounds=(None, None), options=dict(disp=verbose, **kwargs))
+        if not res.status == 0:
+            raise ValueError("solve failed: %s" % res.message)
+        p = res.x
+    else:
+        raise ValueError("unknown backend %s" % backend)
+    c = np.inner(p, g)/g2
+    return p, c
+
+
+def _lp_penalties(P, B, A, G, h):
+    """Append an auxiliary variable `t >= abs(D*p)` for each row of the
+    absolute value penalties `P` (see
+    `pattern_constraints.Constraint.penalties()`) to the linear program
+    of `_solve_lp()`.
+
+    Returns
+    -------
+    B, A, G, h : array
+        The padded and augmented matrices.
+    D : array, shape (m, n)
+        The absolute value penalty rows, `t == abs(D*p)` at the optimum.
+    cost : array, shape (n + m,)
+        To be added to the padded `g`.
+    """
+    n = B.shape[1]
+    D, w = [np.zeros((0, n))], [np.zeros(0)]
+    cost = np.zeros(n)
+    for Di, wi, absi in P:
+        if absi:
+            D.append(Di)
+            w.append(wi*np.ones(Di.shape[0]))
+        else:
+            cost -= wi*Di.sum(0)
+    D, w = np.concatenate(D), np.concatenate(w)
+    m = D.shape[0]
+    pad = lambda a: np.concatenate([a, np.zeros((a.shape[0], m))], 1)
+    t = np.identity(m)
+    G = np.concatenate([pad(G), np.c_[D, -t], np.c_[-D, -t]])
+    h = np.r_[h, np.zeros(2*m)]
+    return pad(B), pad(A), G, h, D, np.r_[cost, -w]
+
+
+def _row_basis(A, b, rcond=1e-9):
+    """Replace the linear equations `A*x == b` by an equivalent set
+    with linearly independent rows (assuming they are consistent)."""
+    if not A.shape[0]:
+        return A, b
+    u, s, v = np.linalg.svd(A, full_matrices=False)
+    r = s > rcond*s[0]
+    return s[r, None]*v[r], np.dot(u[:, r].T, b)
+
+
+def _pseudo_potential(p, derivative):
+    """Pseudopotential derivative from the expanded rf field
+    derivatives `p` of orders `1 ... derivative + 1`."""
+    if derivative == 0:
+        return np.einsum("ij,ij->i", p[0], p[0])
+    elif derivative == 1:
+        return 2*np.einsum("ij,ijk->ik", p[0], p[1])
+    elif derivative == 2:
+        return 2*(np.einsum("ijk,ijl->ikl", p[1], p[1])
+                 +np.einsum("ij,ijkl->ikl", p[0], p[2]))
+    elif derivative == 3:
+        a = np.einsum("ij,ijklm->iklm", p[0], p[3])
+        b = np.einsum("ijk,ijlm->iklm", p[1], p[2])
+        a += b
+        a += b.transpose(0, 2, 1, 3)
+        a += b.transpose(0, 3, 2, 1)
+        return 2*a
+    elif derivative == 4:
+        a = np.einsum("ij,ijklmn->iklmn", p[0], p[4])
+        b = np.einsum("ijk,ijlmn->iklmn", p[1], p[3])
+        a += b
+        a += b.transpose(0, 4, 2, 3, 1)
+        a += b.transpose(0, 3, 2, 1, 4)
+        a += b.transpose(0, 2, 1, 3, 4)
+        c = np.einsum("ijkl,ijmn->iklmn", p[2], p[2])
+        a += c
+        a += c.transpose(0, 1, 4, 3, 2)
+        a += c.transpose(0, 1, 3, 2, 4)
+        return 2*a
+    else:
+        raise ValueError("only know how to generate pseudopotentials "
+            "up to 4th order")
+
+
+class _LocalExpansion(object):
+    """Local Taylor expansions of the dc and rf potentials of a System
+    about a center for each of a set of moving points.
+
+    Calling it with the point positions returns the reduced dc and rf
+    potential derivatives of order `derivative`. The expansions of the
+    points that have moved further than `radius` from their centers are
+    renewed, all in a single pass over the electrodes.
+    """
+    def __init__(self, system, radius, order=3, derivative=1):
+        self.system = system
+        self.radius = radius
+        self.order = order
+        self.derivative = derivative
+        self.centers = np.zeros((0, 3), np.double)
+        self.dc = self.rf = None
+
+    def __call__(self, x):
+        x = np.asanyarray(x, np.double).reshape(-1, 3)
+        if x.shape != self.centers.shape:
+            self.centers = x.copy()
+            self.dc, self.rf = self.system._dc_rf_potentials(x,
+                    range(self.order + 1))
+        else:
+            i = np.flatnonzero(np.square(x - self.centers).sum(1) >
+                    self.radius**2)
+            if len(i):
+                dc, rf = self.system._dc_rf_potentials(x[i],
+                        range(self.order + 1))
+                for a, b in zip(self.dc + self.rf, dc + rf):
+                    a[i] = b
+                self.centers[i] = x[i]
+        dx = x - self.centers
+        return (taylor_potential(self.dc, dx, self.derivative),
+                taylor_potential(self.rf, dx, self.derivative))
+
 
 class System(list):
     """A collection of Electrodes.
@@ -73,10 +254,66 @@ class System(list):
     ----------
     electrodes : list of `Electrode`
         Individual Electrodes comprising this System.
+    cache_size : int
+        Number of unit response sets to cache. See `cache_size`.
+    tolerance : float
+        Far-field approximation tolerance. See `tolerance`.
+
+    Attributes
+    ----------
+    cache_size : int
+        If nonzero, the unit responses of all electrodes (the
+        individual potentials at unit voltage) are cached for the last
+        `cache_size` distinct sets of points and derivative orders.
+        Electrical potentials at the same points are then a
+        voltage-weighted sum of the cached responses and changing the
+        voltages does not require reevaluating the electrodes.
+        Adding, removing or replacing electrodes and assigning to
+        their geometry attributes (e.g. `paths`) invalidates the cache
+        automatically. After changing geometry arrays in place (e.g.
+        `paths[0] += 1`), call `clear_cache()`.
+    tolerance : float
+        If nonzero, the `PolygonPixelElectrode` are evaluated
+        hierarchically: distant clusters of polygons are replaced by
+        their multipole expansion with an approximate relative error of
+        `tolerance`. See `multipole.PolygonTree`. Zero means exact
+        evaluation.
     """
-    def __init__(self, electrodes=[], **kwargs):
+    def __init__(self, electrodes=[], cache_size=0, tolerance=0.,
+            **kwargs):
         super(System, self).__init__(**kwargs)
         self.extend(electrodes)
+        self.cache_size = cache_size
+        self.tolerance = tolerance
+        self._cache = OrderedDict()
+
+    def clear_cache(self):
+        """Discard all cached unit responses.
+
+        Needs to be called after geometry arrays of any electrode (e.g.
+        its `paths` or the `data` of a `GridElectrode`) have been
+        changed in place.
+        """
+        self._cache.clear()
+
+    def _unit_responses(self, x, derivatives):
+        """Cached individual potentials of all electrodes at unit
+        voltage for the concatenated `derivatives`, shape (len(self),
+        n, l). See `_packed_potentials()`. The returned array must not
+        be modified."""
+        electrodes = tuple(self)
+        key = (x.shape, x.tobytes(), derivatives.tobytes(),
+                self.tolerance, tuple(map(id, electrodes)),
+                tuple([ei._geometry_version() for ei in electrodes]))
+        try:
+            # the cached electrodes keep their ids from being reused
+            electrodes, pot = self._cache.pop(key)
+        except KeyError:
+            pot = self._packed_potentials(x, derivatives)
+            while len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[key] = electrodes, pot
+        return pot
    
     @property
     def names(self):
@@ -208,15 +445,72 @@ class System(list):
             Utility functions to convert between the reduced and
             expanded tensorial forms.
         """
+        return self.electrical_potentials(x, typ, (derivative,),
+                expand)[0]
+
+    def electrical_potentials(self, x, typ="dc", derivatives=(0,),
+            expand=False):
+        """Electrical potential derivatives of several orders.
+
+        Like `electrical_potential()` but evaluates all derivative
+        orders in a single pass over each electrode.
+
+        Parameters
+        ----------
+        x : array_like, shape (n, 3)
+            Positions to evaluate the potential at.
+        typ : {"dc", "rf"}
+            Potential to scale the electrodes contribution with.
+        derivatives : sequence of int
+            Derivative orders.
+        expand : bool
+            If True, return the fully expanded tensors, else return the
+            reduced forms.
+
+        Returns
+        -------
+        potentials : list of arrays
+            One potential array for each entry in `derivatives`. See
+            `electrical_potential()`.
+        """
         x = np.asanyarray(x, dtype=np.double).reshape(-1, 3)
-        pot = np.zeros((x.shape[0], 2*derivative+1), np.double)
-        for ei in self:
-            vi = getattr(ei, typ, None)
-            if vi:
-                ei.potential(x, derivative, potential=vi, out=pot)
+        derivatives = np.asanyarray(derivatives, np.intc)
+        voltages = [getattr(ei, typ, None) or 0. for ei in self]
+        if self.cache_size:
+            pot = np.tensordot(voltages, self._unit_responses(x,
+                derivatives), 1)
+        else:
+            pot = self._packed_potentials(x, derivatives, [voltages])[0]
+        pots = _split_potentials(pot, derivatives)
         if expand:
-            pot = expand_tensor(pot)
-        return pot
+            pots = [expand_tensor(pot) for pot in pots]
+        return pots
+
+    def _dc_rf_potentials(self, x, derivatives=(0,), orders=None):
+        """Reduced dc and rf potential derivatives of several orders
+        from a single pass over the electrodes.
+
+        `orders` optionally selects the derivative orders to evaluate
+        for dc and rf, see `_packed_potentials()`. The others may be
+        left zero.
+
+        Returns
+        -------
+        dc, rf : list of arrays
+            See `electrical_potentials()`.
+        """
+        x = np.asanyarray(x, dtype=np.double).reshape(-1, 3)
+        derivatives = np.asanyarray(derivatives, np.intc)
+        voltages = np.array([[getattr(ei, typ, None) or 0. for ei in self]
+            for typ in ("dc", "rf")], np.double)
+        if self.cache_size:
+            dc, rf = np.tensordot(voltages, self._unit_responses(x,
+                derivatives), 1)
+        else:
+            dc, rf = self._packed_potentials(x, derivatives, voltages,
+                    orders)
+        return (_split_potentials(dc, derivatives),
+                _split_potentials(rf, derivatives))
     
     def individual_potential(self, x, derivative=0):
         """Individual contributions to the electrical potential.
@@ -240,11 +534,180 @@ class System(list):
             1` is the derivative index.
         """
         x = np.asanyarray(x, dtype=np.double).reshape(-1, 3)
-        eff = np.zeros((len(self), x.shape[0], 2*derivative+1),
-                np.double)
-        for i, ei in enumerate(self):
-            ei.potential(x, derivative, potential=1., out=eff[i])
-        return eff
+        derivatives = np.array([derivative], np.intc)
+        if self.cache_size:
+            return self._unit_responses(x, derivatives).copy()
+        return self._packed_potentials(x, derivatives)
+
+    def _packed_potentials(self, x, derivatives, weights=None,
+            orders=None):
+        """Weighted sums of the potential contributions of the
+        electrodes.
+
+        All `PolygonPixelElectrode` that share cover parameters are
+        packed (see `electrode.pack_polygons()`) and evaluated in a
+        single kernel call or, if `tolerance` is set, using a
+        `multipole.PolygonTree`. All `InstanceElectrode` of the same
+        shared electrode are evaluated in a single pass over its
+        geometry. Coinciding relative positions (e.g. equivalent sites
+        of a lattice of instances) are evaluated only once. Relative
+        positions are taken to coincide if they agree to within
+        `_instance_rtol` times the largest coordinate of the points and
+        instance offsets, well below the accuracy of the evaluation.
+        Other electrodes are evaluated one by one.
+
+        The contributions are accumulated directly into the weighted
+        sums. An electrode with nonzero weight in several sums is
+        evaluated once for each of them, unless it is evaluated one by
+        one.
+
+        Parameters
+        ----------
+        x : array, shape (n, 3)
+        derivatives : array of int
+        weights : None or array_like, shape (k, len(self))
+            Weight of each electrode in each sum. Electrodes with zero
+            weight are skipped. If None, return the individual
+            contributions of all electrodes at unit weight, each
+            written to its own row `k = len(self)`.
+        orders : None or array_like of bool, shape (k, len(derivatives))
+            Derivative orders to evaluate for each sum. The others are
+            left zero. If None, all are evaluated.
+
+        Returns
+        -------
+        potentials : array, shape (k, n, l)
+            `l` is the sum of the `2*d + 1` over `derivatives`, the
+            concatenated derivative orders.
+        """
+        electrodes = list(self)
+        # the nonzero (row, electrode, weight) entries
+        if weights is None:
+            k = len(self)
+            rows = idx = np.arange(k)
+            w = np.ones(k)
+        else:
+            weights = np.asanyarray(weights, np.double).reshape(-1,
+                    len(self))
+            k = weights.shape[0]
+            if orders is not None:
+                orders = np.asanyarray(orders, np.bool_)
+                weights = weights*orders.any(1)[:, None]
+            rows, idx = np.nonzero(weights)
+            w = weights[rows, idx]
+        full = (True,)*len(derivatives)
+        selects = lambda r: full if orders is None else tuple(orders[r])
+        offsets_d = np.r_[0, np.cumsum(2*derivatives + 1)]
+        l = offsets_d[-1]
+        pot = np.zeros((k, x.shape[0], l), np.double)
+        columns = lambda select: np.concatenate([np.arange(a, b, dtype=int)
+            for a, b, s in zip(offsets_d[:-1], offsets_d[1:], select) if s])
+        groups = {}
+        instances = {}
+        others = {}
+        for e, (r, i) in enumerate(zip(rows, idx)):
+            ei, select = electrodes[i], selects(r)
+            if type(ei) is PolygonPixelElectrode:
+                key = ei.cover_nmax, ei.cover_height, select
+                groups.setdefault(key, []).append(e)
+            elif type(ei) is InstanceElectrode:
+                key = id(ei.electrode), select
+                instances.setdefault(key, []).append(e)
+            else:
+                others.setdefault(i, []).append(e)
+        for i, entries in others.items():
+            ei = electrodes[i]
+            if len(entries) == 1:
+                e, = entries
+                out = _split_potentials(pot[rows[e]], derivatives)
+                select = np.flatnonzero(selects(rows[e]))
+                ei.potential_derivatives(x, derivatives[select],
+                        potential=w[e], out=[out[j] for j in select])
+                continue
+            select = np.array([selects(rows[e]) for e in entries]).any(0)
+            unit = np.zeros((x.shape[0], l), np.double)
+            unit[:, columns(select)] = np.concatenate(
+                    ei.potential_derivatives(x, derivatives[select]), axis=1)
+            for e in entries:
+                cols = columns(selects(rows[e]))
+                pot[rows[e]][:, cols] += w[e]*unit[:, cols]
+        for (nmax, height, select), entries in groups.items():
+            points, offsets, index = pack_polygons([electrodes[i]
+                for i in idx[entries]])
+            wi = w[entries][index]
+            ri = rows[entries].astype(np.intc)
+            select = np.array(select)
+            d = derivatives[select]
+            if select.all():
+                index, out = ri[index], pot
+            else:
+                # only the rows of this group
+                ri, inverse = np.unique(ri, return_inverse=True)
+                index = inverse.ravel().astype(np.intc)[index]
+                out = np.zeros((len(ri), x.shape[0], (2*d + 1).sum()),
+                        np.double)
+            if self.tolerance:
+                tree = PolygonTree(points, offsets)
+                offsets_s = np.r_[0, np.cumsum(2*d + 1)]
+                for di, a, b in zip(d, offsets_s[:-1], offsets_s[1:]):
+                    tree.potential(x, index, wi, di, nmax, height,
+                            self.tolerance, out[:, :, a:b])
+            else:
+                packed_polygon_potentials(x, points, offsets, index, wi,
+                        d, nmax, height, out)
+            if out is not pot:
+                cols = columns(select)
+                for r, p in zip(ri, out):
+                    pot[r][:, cols] += p
+        for (_, select), entries in instances.items():
+            ui, inverse = np.unique(idx[entries], return_inverse=True)
+            offsets = np.array([electrodes[i].offset for i in ui])
+            dx = (x[None, :, :] - offsets[:, None, :]).reshape(-1, 3)
+            # merge relative positions that only differ by rounding
+            quantum = _instance_rtol*max(np.fabs(x).max(initial=0.),
+                    np.fabs(offsets).max()) or 1.
+            _, first, inverse_x = np.unique(np.around(dx/quantum), axis=0,
+                    return_index=True, return_inverse=True)
+            select = np.array(select)
+            unit = electrodes[ui[0]].electrode.potential_derivatives(dx[first],
+                    derivatives[select])
+            unit = np.concatenate(unit, axis=1)[inverse_x.ravel()]
+            unit = unit.reshape(len(ui), x.shape[0], -1)
+            cols = columns(select)
+            for e, j in zip(entries, inverse.ravel()):
+                pot[rows[e]][:, cols] += w[e]*unit[j]
+        return pot
+
+    def expand(self, x0, order=5):
+        """Local Taylor expansion of the System.
+
+        Evaluates the potential derivatives of all electrodes at `x0`
+        once and returns a System of `TaylorElectrode` that evaluates
+        them as polynomials. Repeated queries in a small ball around
+        `x0` (`minimum()`, `saddle()`, `modes()`, `mathieu()` etc.)
+        become cheap.
+
+        Parameters
+        ----------
+        x0 : array_like, shape (3,)
+            Expansion point.
+        order : int
+            Expansion order, at most 5 for the surface electrodes.
+
+        Returns
+        -------
+        System
+            With one `TaylorElectrode` per electrode of `self` with the
+            same `name`, `dc` and `rf`. The derivatives of orders `k`
+            are accurate to order `order - k` in the distance from `x0`.
+        """
+        x0 = np.asanyarray(x0, np.double).reshape(1, 3)
+        derivatives = np.arange(order + 1, dtype=np.intc)
+        pot = self._packed_potentials(x0, derivatives)
+        return System([TaylorElectrode(name=ei.name, dc=ei.dc, rf=ei.rf,
+            origin=x0[0], derivatives=[p[0] for p in
+                _split_potentials(pi, derivatives)])
+            for ei, pi in zip(self, pot)])
 
     def time_potential(self, x, derivative=0, t=0., expand=False):
         """Electrical potential at an instant.
@@ -269,10 +732,32 @@ class System(list):
         array
             See `electrical_potential`.
         """
-        dc, rf = (self.electrical_potential(x, typ, derivative, expand)
-                for typ in ("dc", "rf"))
+        dc, rf = self.dc_rf_potential(x, derivative, expand)
         return dc + np.cos(t)*rf
 
+    def dc_rf_potential(self, x, derivative=0, expand=False):
+        """Electrical dc and rf potentials from a single pass over the
+        electrodes.
+
+        Parameters
+        ----------
+        x : array_like, shape (n, 3)
+            Points to evaluate at.
+        derivative : int
+            Derivative order
+        expand : bool
+            Expand to full tensorial form if True
+
+        Returns
+        -------
+        dc, rf : array
+            See `electrical_potential`.
+        """
+        (dc,), (rf,) = self._dc_rf_potentials(x, (derivative,))
+        if expand:
+            dc, rf = expand_tensor(dc), expand_tensor(rf)
+        return dc, rf
+
     def pseudo_potential(self, x, derivative=0):
         """The ponderomotive/pseudo potential.
         
@@ -289,37 +774,9 @@ class System(list):
             Pseudopotential derivative. Fully expanded since this is not
             generally harmonic.
         """
-        p = [self.electrical_potential(x, "rf", i, expand=True)
-                for i in range(1, derivative+2)]
-        if derivative == 0:
-            return np.einsum("ij,ij->i", p[0], p[0])
-        elif derivative == 1:
-            return 2*np.einsum("ij,ijk->ik", p[0], p[1])
-        elif derivative == 2:
-            return 2*(np.einsum("ijk,ijl->ikl", p[1], p[1])
-                     +np.einsum("ij,ijkl->ikl", p[0], p[2]))
-        elif derivative == 3:
-            a = np.einsum("ij,ijklm->iklm", p[0], p[3])
-            b = np.einsum("ijk,ijlm->iklm", p[1], p[2])
-            a += b
-            a += b.transpose(0, 2, 1, 3)
-            a += b.transpose(0, 3, 2, 1)
-            return 2*a
-        elif derivative == 4:
-            a = np.einsum("ij,ijklmn->iklmn", p[0], p[4])
-            b = np.einsum("ijk,ijlmn->iklmn", p[1], p[3])
-            a += b
-            a += b.transpose(0, 4, 2, 3, 1)
-            a += b.transpose(0, 3, 2, 1, 4)
-            a += b.transpose(0, 2, 1, 3, 4)
-            c = np.einsum("ijkl,ijmn->iklmn", p[2], p[2])
-            a += c
-            a += c.transpose(0, 1, 4, 3, 2)
-            a += c.transpose(0, 1, 3, 2, 4)
-            return 2*a
-        else:
-            raise ValueError("only know how to generate pseudopotentials "
-                "up to 4th order")
+        p = self.electrical_potentials(x, "rf", range(1, derivative+2),
+                expand=True)
+        return _pseudo_potential(p, derivative)
 
     def potential(self, x, derivative=0):
         """Combined electrical and ponderomotive potential.
@@ -337,9 +794,15 @@ class System(list):
             Pseudopotential derivative. Fully expanded since this is not
             generally harmonic.
         """
-        dc = self.electrical_potential(x, "dc", derivative,
-                expand=True)
-        rf = self.pseudo_potential(x, derivative)
+        # dc of order `derivative` and rf of orders `1 ... derivative + 1`
+        # from a single pass
+        start = min(derivative, 1)
+        derivatives = np.arange(start, derivative + 2)
+        orders = [derivatives == derivative, derivatives > 0]
+        dc, rf = self._dc_rf_potentials(x, derivatives, orders)
+        dc = expand_tensor(dc[derivative - start])
+        rf = _pseudo_potential([expand_tensor(p) for p in rf[1 - start:]],
+                derivative)
         return dc + rf
 
     def plot(self, ax, alpha=.3, **kwargs):
@@ -435,6 +898,105 @@ class System(list):
         x[axis] = res.x
         return x
 
+    def _extrema(self, x0, axis, coord, saddle, dx_max, xtol, maxiter,
+            distance):
+        """Batched search for minima or first order saddle points.
+
+        All start points are advanced together with rational function
+        optimization steps based on the exact gradient and hessian
+        (evaluated for all active points in a single pass over the
+        electrodes). Points converge independently and are retired from
+        the active set. Converged points of the wrong type and duplicates
+        closer than `distance` are discarded.
+
+        Returns
+        -------
+        x : array, shape (m, 3)
+        """
+        x = np.array(x0, np.double).reshape(-1, 3)
+        axis = list(axis)
+        d = np.ones(len(axis))
+        if saddle:
+            d[0] = -1
+        derivatives = np.arange(1, 4)
+        # dc of orders 1, 2 and rf of orders 1 ... 3 from a single pass
+        orders = [derivatives < 3, derivatives > 0]
+        def gradient_hessian(x):
+            dc, rf = self._dc_rf_potentials(np.dot(x, coord.T),
+                    derivatives, orders)
+            rf = [expand_tensor(p) for p in rf]
+            g = expand_tensor(dc[0]) + _pseudo_potential(rf, 1)
+            h = expand_tensor(dc[1]) + _pseudo_potential(rf, 2)
+            return (rotate_tensor(g, coord)[:, axis],
+                    rotate_tensor(h, coord)[:, axis][:, :, axis])
+        active = np.arange(x.shape[0])
+        converged = np.zeros(x.shape[0], np.bool_)
+        for it in range(maxiter):
+            if not len(active):
+                break
+            g, h = gradient_hessian(x[active])
+            l, v = np.linalg.eigh(h)
+            gl = np.einsum("nji,nj->ni", v, g)
+            lmg = .5*d*(np.fabs(l) + np.sqrt(l**2 + 4*gl**2))
+            dx = -np.einsum("nij,nj->ni", v,
+                    gl/np.where(lmg == 0, 1., lmg))
+            dn = norm(dx)
+            dx /= np.maximum(1., dn/dx_max)[:, None]
+            x[np.ix_(active, axis)] += dx
+            done = dn <= xtol
+            converged[active[done]] = True
+            active = active[~done]
+        x = x[converged]
+        if not len(x):
+            return x
+        g, h = gradient_hessian(x)
+        negative = (np.linalg.eigvalsh(h) < 0).sum(1)
+        x = x[negative == (1 if saddle else 0)]
+        unique = []
+        for xi in x:
+            if not any(norm(xi - xj) < distance for xj in unique):
+                unique.append(xi)
+        return np.array(unique).reshape(-1, 3)
+
+    def minima(self, x0, axis=(0, 1, 2), coord=np.identity(3),
+            dx_max=.1, xtol=1e-7, maxiter=100, distance=1e-4):
+        """Find potential minima from several start points at once.
+
+        Like `minimum()` but all start points are advanced in lockstep
+        and the potential derivatives of all of them are evaluated in
+        the same calls. Suited to mapping all sites of a trap array.
+
+        Parameters
+        ----------
+        x0 : array_like, shape (n, 3)
+            Start points.
+        axis : tuple of int
+            Only vary the given axis in the given coordinate system.
+        coord : array, shape (3, 3)
+            Coordinate system to vary the axes in.
+        dx_max : float
+            Maximum step length.
+        xtol : float
+            Absolute step length for convergence.
+        maxiter : int
+            Maximum number of steps. Start points that have not
+            converged by then are dropped.
+        distance : float
+            Minima closer than this are considered duplicates.
+
+        Returns
+        -------
+        x : array, shape (m, 3)
+            Unique minima, in order of the first start point converging
+            to each of them.
+
+        See Also
+        --------
+        minimum
+        """
+        return self._extrema(x0, axis, coord, False, dx_max, xtol,
+                maxiter, distance)
+
     def saddle(self, x0, axis=(0, 1, 2), coord=np.identity(3), **kw):
         """Find a saddle point using rational function optimization.
 
@@ -459,7 +1021,7 @@ class System(list):
         """
         kwargs = dict(dx_max=.1, xtol=1e-5, ftol=1e-5)
         kwargs.update(kw)
-        x = np.array(x0)
+        x = np.array(x0, np.double)
         axis = list(axis)
         def f(xi):
             x[axis] = xi
@@ -467,16 +1029,47 @@ class System(list):
         def g(xi):
             x[axis] = xi
             return rotate_tensor(self.potential(np.dot(coord, x), 1),
-                    coord.T)[0, axis]
+                    coord)[0, axis]
         h = rotate_tensor(self.potential(np.dot(coord, x), 2),
-                coord.T)[0, axis][:, axis]
+                coord)[0, axis][:, axis]
         # rational function optimization
-        xs, p, ret = rfo(f, g, np.array(x0)[axis], h=h, **kwargs)
+        xs, p, ret = rfo(f, g, x[axis], h=h, **kwargs)
         if not ret in ("ftol", "xtol"):
             raise ValueError("%s", ((x0, axis, x, xs, p, ret),))
-        # f(xs) # update x
+        x[axis] = xs
         return x, p
 
+    def saddles(self, x0, axis=(0, 1, 2), coord=np.identity(3),
+            dx_max=.1, xtol=1e-7, maxiter=100, distance=1e-4):
+        """Find saddle points from several start points at once.
+
+        Like `saddle()` but all start points are advanced in lockstep
+        using the exact hessian and the potential derivatives of all of
+        them are evaluated in the same calls.
+
+        Parameters
+        ----------
+        x0 : array_like, shape (n, 3)
+            Start points.
+        axis, coord, dx_max, xtol, maxiter, distance
+            See `minima()`.
+
+        Returns
+        -------
+        x : array, shape (m, 3)
+            Unique saddle points (one negative curvature in the varied
+            axes).
+        p : array, shape (m,)
+            Potential at the saddle points.
+
+        See Also
+        --------
+        saddle
+        """
+        x = self._extrema(x0, axis, coord, True, dx_max, xtol, maxiter,
+                distance)
+        return x, self.potential(np.dot(x, coord.T), 0)
+
     def modes(self, x, sorted=True):
         """Curvatures and eigenmode vectors.
 
@@ -555,8 +1148,101 @@ class System(list):
             t += dt
             yield t, q.copy(), p.copy()
 
+    def trajectories(self, x0, v0, t0=0., dt=.0063*2*np.pi, t1=1e4,
+            nsteps=1, scale=1., coulomb=0., radius=0., order=3):
+        """Calculate many ion trajectories at once.
+
+        Integrates the equations of motion without the
+        adiabatic/pseudopotential approximation using the symplectic
+        velocity Verlet scheme::
+
+            x'' = -scale*grad(e_dc) - 2*sqrt(scale)*cos(t)*grad(e_rf)
+
+        with time in units of the inverse rf angular frequency and the
+        rf voltages rescaled as in `analyze_static()` such that the
+        time average is the `potential()`. The forces on all ions are
+        evaluated in one pass over the electrodes per step.
+
+        Parameters
+        ----------
+        x0 : array_like, shape (k, 3)
+            Initial positions.
+        v0 : array_like, shape (k, 3)
+            Initial speeds.
+        t0 : float
+            Initial time.
+        dt : float
+            Time step.
+        t1 : float
+            Final time.
+        nsteps : int
+            Interval to report position and speed at. Every `nsteps`
+            time step (each `dt`) is reported.
+        scale : float or array_like, shape (k,)
+            Scale factor `q/((l*o)**2*m)` of each ion, see `mathieu()`.
+        coulomb : float
+            Coulomb constant (see `ions()`). If nonzero, the ions
+            interact, else they are independent trajectories.
+        radius : float
+            If nonzero, evaluate the forces from local Taylor expansions
+            of order `order` about a center for each ion. The expansion
+            of an ion is renewed once it has moved further than
+            `radius` from its center. The relative force error is of
+            order `(radius/d)**order` where `d` is the distance to the
+            electrodes.
+        order : int
+            Expansion order.
+
+        Returns
+        -------
+        t : array, shape (m,)
+            Times reported, starting with `t0`.
+        x : array, shape (m, k, 3)
+            Positions.
+        v : array, shape (m, k, 3)
+            Speeds.
+        """
+        x = np.array(x0, np.double).reshape(-1, 3)
+        v = np.array(v0, np.double).reshape(-1, 3)
+        k = x.shape[0]
+        scale = np.broadcast_to(np.asanyarray(scale, np.double),
+                (k,))[:, None]
+        rf_scale = 2*np.sqrt(scale)
+        n = int(round((t1 - t0)/dt))
+        m = n//nsteps + 1
+        ts = t0 + dt*nsteps*np.arange(m)
+        xs = np.empty((m, k, 3), np.double)
+        vs = np.empty((m, k, 3), np.double)
+        xs[0], vs[0] = x, v
+
+        if radius:
+            forces = _LocalExpansion(self, radius, order, derivative=1)
+        else:
+            forces = lambda x: self.dc_rf_potential(x, 1)
+
+        def accel(x, t, a):
+            dc, rf = forces(x)
+            np.multiply(-scale, dc, out=a)
+            a -= rf_scale*np.cos(t)*rf
+            if coulomb:
+                d = x[:, None] - x[None, :]
+                r2 = np.square(d).sum(-1)
+                np.fill_diagonal(r2, np.inf)
+                a += coulomb*scale*np.einsum("ij,ijk->ik", r2**-1.5, d)
+            return a
+
+        a = accel(x, t0, np.empty_like(x))
+        for i in range(1, n + 1):
+            v += .5*dt*a
+            x += dt*v
+            accel(x, t0 + i*dt, a)
+            v += .5*dt*a
+            if not i % nsteps:
+                xs[i//nsteps], vs[i//nsteps] = x, v
+        return ts, xs, vs
+
     def shims(self, x_coord_deriv, objectives=[], constraints=None,
-            **kwargs):
+            backend="lp", pool=None, **kwargs):
         """Determine shim vectors.
 
         Solves the shim equations (orthogonalizes) simultaneously at
@@ -575,8 +1261,17 @@ class System(list):
         constraints : None or list of `pattern_constraints.Constraint`
             List of constraints. If None, the pattern electrode
             potential values are constrained between -1 and 1.
+        backend : {"lp", "scipy", "modeling"}
+            See `optimize()`. For the matrix backends the objective and
+            constraint matrices are evaluated once, a single
+            pseudoinverse yields the inhomogeneous solutions for all
+            shims and only the linear programs are solved per shim.
+            With `"modeling"`, `optimize()` is called for each shim.
+        pool : None or `multiprocessing.Pool`
+            Pool to solve the linear programs of the matrix backends
+            in. Synchronous if None.
         **kwargs : any
-            Passed to `self.optimize`.
+            Passed to `self.optimize` or the solver.
 
         Returns
         -------
@@ -593,12 +1288,44 @@ class System(list):
             constraints = [PatternRangeConstraint(min=-1, max=1)]
         vectors = np.empty((len(obj), len(self)),
                 np.double)
-        for i, objective in enumerate(obj):
-            objective.value = 1
-            p, c = self.optimize(constraints+obj, verbose=False,
-                    **kwargs)
-            objective.value = 0
-            vectors[i] = p/c
+        if backend == "modeling":
+            for i, objective in enumerate(obj):
+                objective.value = 1
+                p, c = self.optimize(constraints+obj, verbose=False,
+                        backend=backend, **kwargs)
+                objective.value = 0
+                vectors[i] = p/c
+            return vectors
+
+        # evaluate each (x, derivative) only once
+        cache_size = self.cache_size
+        self.cache_size = max(cache_size, len(obj))
+        try:
+            B, v, A, b, G, h, P = self._lp_matrices(constraints)
+            B1 = np.array([oi.get(self, None) for oi in obj],
+                    np.double).reshape(-1, len(self))
+        finally:
+            self.cache_size = cache_size
+            if not cache_size:
+                self.clear_cache()
+        B = np.concatenate([B, B1])
+        # all inhomogeneous solutions at once
+        rcond = kwargs.pop("rcond", 1e-9)
+        Bp = np.linalg.pinv(B, rcond=rcond)
+        B, A, G, h, D, cost = _lp_penalties(P, B, A, G, h)
+        z = np.zeros(D.shape[0])
+        if pool is None:
+            pool = DummyPool()
+        res = []
+        for i in range(len(obj)):
+            vi = np.r_[v, np.identity(len(obj))[i]]
+            gi = np.r_[np.dot(Bp, vi), z]
+            res.append(pool.apply_async(_solve_lp, (gi, B, vi,
+                A, b, G, h, backend, False, rcond, None, gi + cost),
+                kwargs))
+        for i, r in enumerate(res):
+            p, c = r.get()
+            vectors[i] = p[:len(self)]/c
         return vectors
 
     def _run_cvxopt(self, obj, ctrs, verbose=True, **kwargs):
@@ -660,7 +1387,8 @@ class System(list):
         u = np.array([np.array(v.value).ravel() for v in variables])
         return u, c
 
-    def optimize(self, constraints, rcond=1e-9, verbose=True, **kwargs):
+    def optimize(self, constraints, rcond=1e-9, verbose=True,
+            backend="modeling", x0=None, **kwargs):
         """Find electrode potentials that maximize given
         constraints/objectives.
         
@@ -673,6 +1401,20 @@ class System(list):
             for details.
         verbose : bool
             Passed to the solver.
+        backend : {"modeling", "lp", "scipy"}
+            How the linear program is built and solved. `"modeling"`
+            uses `cvxopt.modeling` expressions. `"lp"` and `"scipy"`
+            assemble the constraints directly into matrices (see
+            `pattern_constraints.Constraint.objectives()`, `penalties()`,
+            `equalities()` and `inequalities()`) and solve with `cvxopt.solvers.lp` or
+            `scipy.optimize.linprog` respectively. Much faster to set up
+            for many electrodes and constraints.
+        x0 : None or array_like, shape (n,)
+            Start point for the interior point solver of the `"lp"`
+            backend, e.g. a previous solution to a similar problem.
+            Ignored by the other backends.
+        **kwargs : any
+            Solver options.
         
         Returns
         -------
@@ -683,11 +1425,20 @@ class System(list):
             Solution strength. `c` times the objective value could
             be achieved using `potentials`.
         """
+        if backend != "modeling":
+            return self._optimize_matrix(constraints, rcond, verbose,
+                    backend, x0, **kwargs)
         p = cvxopt.modeling.variable(len(self))
         obj = []
         ctrs = []
+        penalty = 0.
         for ci in constraints:
-            obj.extend(ci.objective(self, p))
+            for coef, val in ci.objective(self, p):
+                if isinstance(coef, np.ndarray):
+                    obj.append((coef, val))
+                else:
+                    # weighted penalty functions
+                    penalty += val*coef
             ctrs.extend(ci.constraints(self, p))
         B = np.array([i[0] for i in obj])
         b = np.array([i[1] for i in obj])
@@ -702,13 +1453,63 @@ class System(list):
         # B*g_perp*p == 0
         ctrs.append(cvxopt.modeling.dot(cvxopt.matrix(B1.T), p) == 0.)
 
-        solver = self._run_cvxopt(-obj, ctrs, verbose, **kwargs)
+        solver = self._run_cvxopt(penalty - obj, ctrs, verbose, **kwargs)
 
         p = np.array(p.value, np.double).ravel()
         c = np.inner(p, g)/g2
         return p, c
 
-    def group(self, thresholds=[0], voltages=None):
+    def _lp_matrices(self, constraints):
+        """Matrix forms of the objectives and constraints.
+
+        Returns
+        -------
+        B, v : array, shape (k, n) and (k,)
+            Objective rows and their values.
+        A, b : array, shape (l, n) and (l,)
+            Equality constraints.
+        G, h : array, shape (m, n) and (m,)
+            Inequality constraints.
+        P : list of (D, w, abs)
+            Weighted penalties.
+        """
+        n = len(self)
+        obj, A, b, G, h, P = [], [], [], [], [], []
+        for ci in constraints:
+            obj.extend(ci.objectives(self, n))
+            P.extend(ci.penalties(self, n))
+            for Ai, bi in ci.equalities(self, n):
+                A.append(Ai)
+                b.append(bi)
+            for Gi, hi in ci.inequalities(self, n):
+                G.append(Gi)
+                h.append(hi)
+        B = np.concatenate([i[0] for i in obj]).reshape(-1, n) if obj \
+                else np.zeros((0, n))
+        v = np.concatenate([i[1] for i in obj]) if obj else np.zeros(0)
+        A = np.concatenate(A).reshape(-1, n) if A else np.zeros((0, n))
+        b = np.concatenate(b) if b else np.zeros(0)
+        G = np.concatenate(G).reshape(-1, n) if G else np.zeros((0, n))
+        h = np.concatenate(h) if h else np.zeros(0)
+        return B, v, A, b, G, h, P
+
+    def _optimize_matrix(self, constraints, rcond, verbose, backend,
+            x0=None, **kwargs):
+        """`optimize()` with the linear program in matrix form."""
+        B, v, A, b, G, h, P = self._lp_matrices(constraints)
+        n = len(self)
+        # the inhomogeneous solution
+        g = np.dot(np.linalg.pinv(B, rcond=rcond), v)
+        B, A, G, h, D, cost = _lp_penalties(P, B, A, G, h)
+        g = np.r_[g, np.zeros(D.shape[0])]
+        if x0 is not None:
+            x0 = np.asanyarray(x0, np.double)
+            x0 = np.r_[x0, np.fabs(np.dot(D, x0))]
+        p, c = _solve_lp(g, B, v, A, b, G, h, backend, verbose, rcond,
+                x0, g + cost, **kwargs)
+        return p[:n], c
+
+    def group(self, thresholds=[0], voltages=None, mesh=False):
         """Group electrodes by their potentials.
 
         Regroups all electrodes and combines those that fall in the same
@@ -721,6 +1522,11 @@ class System(list):
         voltages : None or array_like, shape (m,)
             Electrode potentials to use for binning. If None, take
             `self.dcs`.
+        mesh : bool
+            Return the groups as `MeshPixelElectrode` instead of
+            `PolygonPixelElectrode`. Edges shared within a group cancel
+            and are dropped, those shared between two electrodes of a
+            group are stored only once.
 
         Returns
         -------
@@ -748,8 +1554,13 @@ class System(list):
                 paths.extend(el.paths)
                 dcs.append(el.dc)
                 rfs.append(el.rf)
-            eles.append(PolygonPixelElectrode(paths=paths,
-                dc=np.mean(dcs), rf=np.mean(rfs)))
+            if mesh:
+                eles.append(MeshPixelElectrode.from_polygon_system(
+                    [PolygonPixelElectrode(paths=paths)], [1.],
+                    dc=np.mean(dcs), rf=np.mean(rfs)))
+            else:
+                eles.append(PolygonPixelElectrode(paths=paths,
+                    dc=np.mean(dcs), rf=np.mean(rfs)))
         return System(eles)
 
     def mathieu(self, x, scale, r=2, sorted=True):
@@ -855,7 +1666,7 @@ class System(list):
         trap = self.minimum(x)
         yield " minimum is at offset: %s" % (trap - x,)
         yield "                      (%s µm)" % ((trap - x)*l/1e-6,)
-        p_dc = self.electrical_potential(x, "dc", 0)[0]
+        p_dc = self.electrical_potential(x, "dc", 0)[0, 0]
         p_rf = self.pseudo_potential(x, 0)[0]
         yield "potential:"
         yield " dc electrical: %.2g eV" % p_dc
@@ -903,84 +1714,113 @@ class System(list):
                 ci, semi*q**2/(4*m*ct.h*fi), semi*fi)
         if ions > 1:
             xi = x+np.random.randn(ions)[:, None]*1e-3
-            qi = np.ones(ions)*q/(l*4*np.pi*ct.epsilon_0)**.5
-            xis, cis, mis = self.ions(xi, qi)
-            freqs_ppi = (cis/l**2/m)**.5/(1e6*np.pi)
+            # potentials are in V for the ion (q, m), lengths in l
+            coulomb = q/(4*np.pi*ct.epsilon_0*l)
+            xis, cis, mis = self.ions(xi, coulomb=coulomb)
+            freqs_ppi = np.sqrt(q*cis/m)/(2*np.pi*l)
             r2 = norm(xis[1]-xis[0])
             r2a = ((q*l)**2/(2*np.pi*ct.epsilon_0*q*curves[0]))**(1/3.)
-            yield "two ion modes:"
+            yield "%i ion modes:" % ions
             yield " separation: %.3g (%.3g µm, %.3g µm harmonic)" % (
                 r2, r2*l/1e-6, r2a/1e-6)
-            for ci, fi, mi in zip("abcdef", freqs_ppi, mis.transpose(2, 0, 1)):
-                yield " %s: %.4g MHz, %s/%s" % (ci, fi/1e6, mi)
+            for ci, fi, mi in zip("abcdefghijklmnopqrstuvwxyz",
+                    freqs_ppi, mis.transpose(2, 0, 1)):
+                yield " %s: %.4g MHz, %s" % (ci, fi/1e6,
+                        "/".join(str(mij) for mij in mi))
 
-    def ions(self, x0, q):
-        """Find minimum energy positions of an multiple ions and
+    def ions(self, x0, q=None, m=None, coulomb=1., **kwargs):
+        """Find minimum energy positions of multiple ions and
         calculate normal modes.
-       
-        .. note:: unused, untested, probably broken
+
+        The energy of ion `i` in the trap is `q[i]*dc + q[i]**2/m[i]*rf`
+        where `dc` and `rf` are the electrical and the pseudo potential
+        of a reference ion with unit charge and mass. Pairs of ions
+        interact through `coulomb*q[i]*q[j]/r`. The trap potentials of
+        all ions are evaluated in one pass over the electrodes, the
+        Coulomb energy, its gradient and hessian are vectorized over all
+        pairs.
 
         Parameters
         ----------
         x0 : array_like, shape (n, 3)
             Initial positions of `n` ions
-        q : array_like, shape (n,)
-            Normalized charge to mass ratios of the ions.
+        q : None or array_like, shape (n,)
+            Charges of the ions. Defaults to 1.
+        m : None or array_like, shape (n,)
+            Masses of the ions. Defaults to 1.
+        coulomb : float
+            Coulomb constant in the units of potential and length of
+            the system, e.g. `ct.e/(4*np.pi*ct.epsilon_0*l)` for
+            potentials in V and lengths in units of `l`.
+        **kwargs : any
+            Passed to `scipy.optimize.minimize(method="trust-exact")`.
 
         Returns
         -------
         x : array, shape (n, 3)
             Equilibrium positions.
         ew : array, shape (3*n,)
-            Eigenvalues.
-        ev : array, shape (3*n, 3*n)
-            Normal mode vectors.
-        """
-        n = len(x0)
-        qs = q[:, None]*q[None, :]
-
-        def f(x0):
-            x0 = x0.reshape(-1, 3)
-            p0 = self.potential(x0, 0)
-            x, y, z = (x0[None, :] - x0[:, None]).transpose(2, 0, 1)
-            pi = .5*qs/np.ma.array(
-                    x**2+y**2+z**2)**(1/2.)
-            return (p0+pi.sum(-1)).sum()
-
-        def g(x0):
-            x0 = x0.reshape(-1, 3)
-            p0 = self.potential(x0, 1).T
-            x, y, z = (x0[None, :] - x0[:, None]).transpose(2, 0, 1)
-            pi = qs*[x, y, z]/np.ma.array(
-                    x**2+y**2+z**2)**(3/2.)
-            return (p0+pi.sum(-1)).T.ravel()
-
-        def h(x0):
-            x0 = x0.reshape(-1, 3)
-            p0 = self.potential(x0, 2).T
-            x, y, z = (x0[None, :] - x0[:, None]).transpose(2, 0, 1)
-            p = expand_tensor(
-                (-qs*[2*x**2-y**2-z**2, 3*x*y, 3*x*z,
-                    2*y**2-x**2-z**2, 3*y*z]/np.ma.array(
-                    x**2+y**2+z**2)**(5/2.)).T)
-            p = p.transpose(2, 0, 3, 1)
-            for i, (p0i, pii) in enumerate(
-                    zip(p0.transpose(2, 0, 1), p.sum(2))):
-                p[i, :, i, :] += p0i-pii
-            return p.reshape(p.shape[0]*p.shape[1], -1)
-
-        with np.errstate(divide="ignore", invalid="ignore"):
-            x = optimize.fmin_ncg(f=f, fprime=g, fhess=h, x0=x0.ravel(),
-                disp=0)
-            #print warn
-            #x1, e0, e1, e2, itf, itg, warn = optimize.fmin_bfgs(
-            #    f=f, fprime=g, x0=x0.ravel(), full_output=1, disp=1)
-            #print (np.sort(x1)-np.sort(x))/np.sort(x)
-            #x2, e0, itf, itg, warn = optimize.fmin_cg(
-            #    f=f, fprime=g, x0=x0.ravel(), full_output=1, disp=1)
-            #print (np.sort(x2)-np.sort(x))/np.sort(x)
-            c = h(x)
-        ew, ev = np.linalg.eigh(c)
-        i = np.argsort(ew)
-        ew, ev = ew[i], ev[i, :].reshape(n, 3, -1)
-        return x.reshape(-1, 3), ew, ev
+            Eigenvalues of the mass weighted hessian in ascending order
+            (squares of the mode frequencies).
+        ev : array, shape (n, 3, 3*n)
+            Normal mode vectors in mass weighted coordinates. The mode
+            index is the last axis.
+
+        Raises
+        ------
+        ValueError
+            If the minimization fails.
+        """
+        x0 = np.asanyarray(x0, np.double).reshape(-1, 3)
+        n = x0.shape[0]
+        q = np.ones(n) if q is None else np.asanyarray(q, np.double)
+        m = np.ones(n) if m is None else np.asanyarray(m, np.double)
+        qq = coulomb*q[:, None]*q[None, :]
+        np.fill_diagonal(qq, 0)
+        qp = q**2/m
+        cache = {}
+
+        def terms(x):
+            if cache.get("x") != x.tobytes():
+                xi = x.reshape(-1, 3)
+                dc, rf = self._dc_rf_potentials(xi, range(4))
+                dc = [expand_tensor(p) for p in dc[:3]]
+                rf = [expand_tensor(p) for p in rf[1:]]
+                d = xi[:, None] - xi[None, :]
+                r2 = np.square(d).sum(-1)
+                np.fill_diagonal(r2, 1)
+                cache.update(x=x.tobytes(), dc=dc, rf=rf, d=d, r2=r2,
+                        c=qq/np.sqrt(r2))
+            return cache
+
+        def f(x):
+            t = terms(x)
+            e = (np.dot(q, t["dc"][0]) + np.dot(qp,
+                _pseudo_potential(t["rf"], 0)) + .5*t["c"].sum())
+            g = (q[:, None]*t["dc"][1] + qp[:, None]*_pseudo_potential(
+                t["rf"], 1) - np.einsum("ij,ijk->ik", t["c"]/t["r2"],
+                    t["d"]))
+            return e, g.ravel()
+
+        def h(x):
+            t = terms(x)
+            d, r2 = t["d"], t["r2"]
+            # hessian of the pair energies with respect to x[i] - x[j]
+            c = (t["c"]/r2**2)[:, :, None, None]*(3*d[:, :, :, None]*
+                d[:, :, None, :] - r2[:, :, None, None]*np.identity(3))
+            hi = -c.transpose(0, 2, 1, 3)
+            i = np.arange(n)
+            hi[i, :, i, :] = (q[:, None, None]*t["dc"][2] +
+                    qp[:, None, None]*_pseudo_potential(t["rf"], 2) +
+                    c.sum(1))
+            return hi.reshape(3*n, 3*n)
+
+        res = optimize.minimize(f, x0.ravel(), jac=True, hess=h,
+                method="trust-exact", **kwargs)
+        if not res.success:
+            raise ValueError("failed, %i, %s, %s" % (res.success,
+                res.message, res))
+        x = res.x
+        w = 1/np.sqrt(np.repeat(m, 3))
+        ew, ev = np.linalg.eigh(h(x)*w[:, None]*w[None, :])
+        return x.reshape(-1, 3), ew, ev.reshape(n, 3, -1)
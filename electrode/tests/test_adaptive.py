@@ -0,0 +1,93 @@
+# -*- coding: utf8 -*-
+#
+#   electrode.py: numeric tools for Paul traps
+#
+#   Copyright (C) 2011-2013 Robert Jordens <jordens@phys.ethz.ch>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, print_function,
+        unicode_literals, division)
+
+import unittest
+
+import numpy as np
+from numpy import testing as nptest
+
+from electrode import system, electrode, pattern_constraints
+
+try:
+    from electrode import adaptive
+except ImportError:
+    adaptive = None
+
+
+@unittest.skipIf(adaptive is None, "no bem")
+class AdaptiveCase(unittest.TestCase):
+    x = np.array([.3, .2, 1.])
+
+    def setUp(self):
+        self.variable = [np.array([[-1, -1], [1, -1], [1, 1], [-1, 1.]])]
+        self.fixed = [electrode.PolygonPixelElectrode(paths=[
+            np.array([[1.5, -1], [2, -1], [2, 1], [1.5, 1.]])])]
+        self.constraints = [
+            pattern_constraints.PatternRangeConstraint(min=-1, max=1),
+            pattern_constraints.PotentialObjective(x=self.x,
+                derivative="x", value=1),
+            pattern_constraints.PotentialObjective(x=self.x,
+                derivative="y", value=0)]
+
+    def adapt(self, **kwargs):
+        return adaptive.adapt_mesh(self.constraints, self.variable,
+                self.fixed, nmax=400, a=.5, **kwargs)
+
+    def test_incremental(self):
+        s, v, c = self.adapt()
+        for mesh in False, True:
+            s1, v1, c1 = self.adapt(incremental=True, mesh=mesh)
+            self.assertEqual(len(s1), len(s))
+            for a, b in zip(s, s1):
+                nptest.assert_allclose(a.paths, b.paths)
+            # warm started: same optimum up to the solver tolerance
+            nptest.assert_allclose(v1, v, atol=1e-3)
+            nptest.assert_allclose(c1, c, rtol=1e-6)
+            for d in range(3):
+                nptest.assert_allclose(s1.individual_potential(self.x, d),
+                        s.individual_potential(self.x, d), rtol=1e-9,
+                        atol=1e-12)
+            # a plain System without the shared responses
+            self.assertIs(type(s1), system.System)
+            keys = set(adaptive._triangle_key(e) for e in s1)
+            self.assertEqual(len(keys), len(s1))
+
+    def test_prune(self):
+        e = [electrode.PolygonPixelElectrode(paths=[p]) for p in
+                np.random.RandomState(0).uniform(-1, 1, (6, 3, 2))]
+        responses = {}
+        s = adaptive._AdaptiveSystem(e, responses=responses)
+        p = s.individual_potential(self.x, 1)
+        s1 = adaptive._AdaptiveSystem(e[::2], responses=responses)
+        nptest.assert_allclose(s1.individual_potential(self.x, 1), p[::2])
+        s1.prune()
+        cache, = responses.values()
+        self.assertEqual(set(cache),
+                set(adaptive._triangle_key(ei) for ei in e[::2]))
+        s2 = adaptive._AdaptiveSystem(e, responses=responses)
+        nptest.assert_allclose(s2.individual_potential(self.x, 1), p)
+        nptest.assert_allclose(system.System(e).individual_potential(
+            self.x, 1), p)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -21,12 +21,18 @@ from __future__ import (absolute_import, print_function,
         unicode_literals, division)
 
 import os
+import pickle
+import shutil
+import tempfile
+import time
 import unittest
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 from numpy import testing as nptest
+from scipy.ndimage import map_coordinates
 
-from electrode import utils, electrode, system
+from electrode import utils, electrode, system, multipole
 
 
 class CoverCase(unittest.TestCase):
@@ -238,6 +244,91 @@ class GridElectrodeCase(unittest.TestCase):
             pp = self.p.potential(x, d)
             nptest.assert_allclose(pe, pp, rtol=r, atol=1e-4)
 
+    def test_cubic(self):
+        self.e.generate(3)
+        x = np.random.RandomState(0).rand(20, 3)*[2, 2.5, 2] + [
+                -1., -1.2, 1.5]
+        for d in range(3):
+            self.e.order = 1
+            pl = self.e.potential(x, d)
+            self.e.order = 3
+            pc = self.e.potential(x, d)
+            if d < 2: # higher orders are limited by finite differences
+                pp = self.p.potential(x, d)
+                self.assertLess(np.fabs(pc - pp).max(),
+                        .1*np.fabs(pl - pp).max())
+            xi = ((x - self.e.origin)/self.e.spacing).T
+            for i in range(2*d + 1):
+                nptest.assert_allclose(pc[:, i], map_coordinates(
+                    self.e.data[d][..., i], xi, order=3, mode="mirror"))
+        self.assertIs(self.e.coefficients(2), self.e.coefficients(2))
+
+    def test_float32(self):
+        self.e.generate(3)
+        f = electrode.GridElectrode(data=self.e.data, origin=self.e.origin,
+                spacing=self.e.spacing, dtype=np.float32)
+        f.generate(4)
+        self.assertEqual(f.data[3].dtype, np.float32)
+        x = np.random.RandomState(0).rand(50, 3)*[3, 3.5, 3] + [
+                -1.4, -1.6, 1.]
+        for order, bound in (1, 1e-6), (3, 1e-5):
+            self.e.order = f.order = order
+            for d in range(3):
+                a = self.e.potential(x, d)
+                b = f.potential(x, d)
+                self.assertEqual(b.dtype, np.float32)
+                self.assertLess(np.fabs(a - b).max(),
+                        bound*np.fabs(self.e.data[d]).max())
+
+    def test_multigrid(self):
+        self.e.generate(3)
+        m = electrode.MultiGridElectrode.from_grid(self.e,
+                [[[-.5, -.5, 1.5], [.5, .5, 2.5]]], step=3)
+        self.assertEqual(len(m.grids), 2)
+        self.assertLess(sum(g.data[0].size for g in m.grids),
+                .2*self.e.data[0].size)
+        rs = np.random.RandomState(0)
+        fine = rs.rand(10, 3) + [-.5, -.5, 1.5]
+        coarse = rs.rand(10, 3)*[1, 1, 1] + [.6, .6, 2.6]
+        x = np.r_[fine, coarse]
+        for d in range(3):
+            a = m.potential(x, d)
+            nptest.assert_allclose(a[:10], self.e.potential(fine, d))
+            nptest.assert_allclose(a[10:], m.grids[1].potential(coarse, d))
+            nptest.assert_allclose(a, self.p.potential(x, d),
+                    rtol=.05, atol=1e-3)
+
+    def test_derive_chunked(self):
+        a = self.e.derive(2)
+        for i in range(2*2 + 1):
+            (e, j), k = utils.construct_derivative(2, i)
+            nptest.assert_allclose(a[..., i], np.gradient(
+                self.e.data[1][..., j], *self.e.spacing)[k])
+        for chunksize in 1, 4, 100:
+            b = self.e.derive(2, chunksize=chunksize, pool=ThreadPool(2))
+            nptest.assert_array_equal(a, b)
+
+    def test_file(self):
+        d = tempfile.mkdtemp()
+        try:
+            self.e.save(d)
+            e = electrode.GridElectrode.from_file(d)
+            self.assertEqual(len(e.data), 2)
+            self.assertIsInstance(e.data[1], np.memmap)
+            x = np.array([[1.4567, 1.67858, 1.49533]])
+            a = e.potential(x, 2)
+            self.assertTrue(os.path.exists(os.path.join(d, "data2.npy")))
+            self.assertIsInstance(e.data[2], np.memmap)
+            self.e.generate(3)
+            nptest.assert_allclose(a, self.e.potential(x, 2))
+            f = pickle.loads(pickle.dumps(e))
+            self.assertIsInstance(f.data[2], np.memmap)
+            nptest.assert_allclose(f.potential(x, 2), a)
+            self.assertEqual(len(electrode.GridElectrode.from_file(
+                d).data), 3)
+        finally:
+            shutil.rmtree(d)
+
 
 # @unittest.skipIf(electrode.tvtk is None, "no tvtk")
 class GridElectrodeVtkCase(unittest.TestCase):
@@ -266,6 +357,377 @@ class MeshElectrodeCase(unittest.TestCase):
             b = self.m.potential(self.x, di)
             nptest.assert_allclose(a, b)
 
+    def test_shared_edges(self):
+        # a 3x3 grid of triangle pairs with all interior edges shared
+        g = np.mgrid[:4, :4].reshape(2, -1).T.astype(np.double)
+        paths = []
+        for i in range(3):
+            for j in range(3):
+                a, b, c, d = 4*i + j, 4*i + j + 4, 4*i + j + 5, 4*i + j + 1
+                paths.extend([g[[a, b, c]], g[[a, c, d]]])
+        dcs = np.random.RandomState(0).randn(len(paths))
+        s = system.System([electrode.PolygonPixelElectrode(paths=[p],
+            dc=v) for p, v in zip(paths, dcs)])
+        m = electrode.MeshPixelElectrode.from_polygon_system(s)
+        self.assertEqual(len(m.points), 16)
+        self.assertEqual(len(m.edges), 12 + 21)
+        for di in range(4):
+            nptest.assert_allclose(m.potential(self.x, di),
+                    s.electrical_potential(self.x, "dc", di))
+        a = m.polygon_potentials(self.x, [1, 2])
+        b = s.individual_potential(self.x, 1)
+        nptest.assert_allclose(a[:, :, :3], b, atol=1e-15)
+        g = s.group(thresholds=[0], mesh=True)
+        h = s.group(thresholds=[0])
+        self.assertLess(len(g[0].edges) + len(g[1].edges),
+                2*len(paths)*3)
+        for di in range(3):
+            nptest.assert_allclose(g.individual_potential(self.x, di),
+                h.individual_potential(self.x, di), atol=1e-15)
+
+
+class PotentialDerivativesCase(unittest.TestCase):
+    def setUp(self):
+        p = np.array([[1, 0], [2, 3], [2, 7], [3, 8],
+            [-2, 8], [-5, 2]])
+        self.p = electrode.PolygonPixelElectrode(paths=[p, p[::-1]+[7, 0]],
+                cover_nmax=2, cover_height=20., rf=1.)
+        self.e = self.p.to_points()
+        self.m = electrode.MeshPixelElectrode.from_polygon_system(
+            system.System([self.p]))
+        self.c = electrode.CoverElectrode(height=20.)
+        self.x = np.array([[1, 2, 3.], [-2, 3, 1.5]])
+
+    def test_orders(self):
+        for ee in self.p, self.e, self.m, self.c:
+            for derivs in [0], [2, 1], range(6):
+                a = ee.potential_derivatives(self.x, derivs, 1.5)
+                self.assertEqual(len(a), len(derivs))
+                for ai, di in zip(a, derivs):
+                    b = ee.potential(self.x, di, 1.5)
+                    nptest.assert_allclose(ai, b)
+
+    def test_out(self):
+        derivs = range(3)
+        out = [np.ones((2, 2*d+1)) for d in derivs]
+        a = self.p.potential_derivatives(self.x, derivs, out=out)
+        for ai, oi, di in zip(a, out, derivs):
+            self.assertIs(ai, oi)
+            nptest.assert_allclose(ai, self.p.potential(self.x, di)+1)
+
+    def test_system(self):
+        s = system.System([self.p, self.c])
+        a = s.electrical_potentials(self.x, "rf", range(4), expand=True)
+        for di, ai in enumerate(a):
+            nptest.assert_allclose(ai,
+                s.electrical_potential(self.x, "rf", di, expand=True))
+
+
+class PackedCase(unittest.TestCase):
+    def setUp(self):
+        p = np.array([[1, 0], [2, 3], [2, 7], [3, 8],
+            [-2, 8], [-5, 2]])
+        self.s = system.System([
+            electrode.PolygonPixelElectrode(paths=[p], dc=1.),
+            electrode.PolygonPixelElectrode(paths=[], dc=2.),
+            electrode.PolygonPixelElectrode(paths=[p + [1, 0]],
+                cover_nmax=2, cover_height=20., dc=-.5),
+            electrode.CoverElectrode(height=20., dc=.3),
+            electrode.PolygonPixelElectrode(paths=[p[::-1] + [7, 0],
+                p + [-7, 0]], rf=1., dc=1.5),
+            ])
+        self.x = np.random.RandomState(0).randn(5, 3) + [0, 3, 5]
+
+    def test_pack(self):
+        points, offsets, index = electrode.pack_polygons(
+                [self.s[i] for i in (0, 1, 2, 4)])
+        self.assertEqual(list(offsets), [0, 6, 12, 18, 24])
+        self.assertEqual(list(index), [0, 2, 3, 3])
+        nptest.assert_allclose(points[18:], self.s[4].paths[1])
+
+    def test_individual(self):
+        for di in range(4):
+            a = self.s.individual_potential(self.x, di)
+            for ai, ei in zip(a, self.s):
+                nptest.assert_allclose(ai, ei.potential(self.x, di))
+
+    def test_electrical(self):
+        for di in range(4):
+            a = self.s.electrical_potential(self.x, "dc", di)
+            b = sum(ei.potential(self.x, di, ei.dc) for ei in self.s)
+            nptest.assert_allclose(a, b)
+
+    def test_many(self):
+        # per-electrode evaluation is linear in the number of electrodes
+        n = 5000
+        s = system.System([electrode.PolygonPixelElectrode(
+            paths=[[[i, 0], [i + 1, 0], [i, 1.]]]) for i in range(n)])
+        x = np.array([[0, 0, 1.]])
+        t = time.time()
+        a = s.individual_potential(x, 1)
+        self.assertLess(time.time() - t, 1.)
+        self.assertEqual(a.shape, (n, 1, 3))
+        for i in 0, 1, n - 1:
+            nptest.assert_allclose(a[i], s[i].potential(x, 1))
+
+    def test_weights(self):
+        d = np.array([0, 2, 1], np.intc)
+        w = np.random.RandomState(1).randn(3, len(self.s))
+        w[0, 1] = w[2, 3] = 0
+        orders = np.array([[1, 1, 1], [0, 1, 1], [1, 0, 0]], np.bool_)
+        cols = np.repeat(orders, 2*d + 1, axis=1)
+        unit = [np.concatenate(ei.potential_derivatives(self.x, d), axis=1)
+                for ei in self.s]
+        b = np.tensordot(w, unit, 1)*cols[:, None, :]
+        for tolerance in 0, 1e-6:
+            self.s.tolerance = tolerance
+            a = self.s._packed_potentials(self.x, d, w, orders)
+            self.assertEqual(a.shape, (3, 5, 9))
+            nptest.assert_allclose(a, b, rtol=0,
+                    atol=max(tolerance, 1e-12)*np.fabs(b).max())
+            a = self.s._packed_potentials(self.x, d)
+            self.assertEqual(a.shape, (len(self.s), 5, 9))
+            for ai, ui in zip(a, unit):
+                nptest.assert_allclose(ai, ui, rtol=0,
+                        atol=max(tolerance, 1e-12)*np.fabs(ui).max())
+        self.s.tolerance = 0.
+
+    def test_dc_rf(self):
+        for di in range(3):
+            dc, rf = self.s.dc_rf_potential(self.x, di, expand=True)
+            nptest.assert_allclose(dc, self.s.electrical_potential(self.x,
+                "dc", di, expand=True), atol=1e-14)
+            nptest.assert_allclose(rf, self.s.electrical_potential(self.x,
+                "rf", di, expand=True), atol=1e-14)
+        dc, rf = self.s.dc_rf_potential(self.x, 1)
+        nptest.assert_allclose(self.s.time_potential(self.x, 1, 1.),
+                dc + np.cos(1.)*rf)
+
+    def test_potential(self):
+        for di in range(5):
+            p = self.s.potential(self.x, di)
+            q = (self.s.electrical_potential(self.x, "dc", di, expand=True)
+                    + self.s.pseudo_potential(self.x, di))
+            self.assertEqual(p.shape, q.shape)
+            nptest.assert_allclose(p, q, rtol=1e-12, atol=1e-14)
+
+
+class CacheCase(unittest.TestCase):
+    def setUp(self):
+        p = np.array([[1, 0], [2, 3], [2, 7], [3, 8],
+            [-2, 8], [-5, 2]])
+        self.s = system.System([
+            electrode.PolygonPixelElectrode(paths=[p], dc=1.),
+            electrode.PolygonPixelElectrode(paths=[p + [5, 0]], rf=1.),
+            electrode.CoverElectrode(height=20., dc=.3),
+            ], cache_size=2)
+        self.x = np.random.RandomState(0).randn(5, 3) + [0, 3, 5]
+
+    def test_voltages(self):
+        for dcs in [1, 0, .3], [-1, 2, .5]:
+            self.s.dcs = dcs
+            for di in range(3):
+                a = self.s.electrical_potential(self.x, "dc", di)
+                b = sum(ei.potential(self.x, di, ei.dc) for ei in self.s)
+                nptest.assert_allclose(a, b)
+        self.assertEqual(len(self.s._cache), 2)
+
+    def test_geometry(self):
+        a = self.s.individual_potential(self.x, 1)
+        self.s[0].paths = [p + 1 for p in self.s[0].paths]
+        b = self.s.individual_potential(self.x, 1)
+        nptest.assert_allclose(b[0], self.s[0].potential(self.x, 1))
+        self.assertGreater(np.fabs(b[0] - a[0]).max(), 0)
+        nptest.assert_allclose(b[1:], a[1:])
+        self.s[2].height = 10.
+        b = self.s.individual_potential(self.x, 1)
+        nptest.assert_allclose(b[2], self.s[2].potential(self.x, 1))
+        # in-place changes need clear_cache()
+        self.s[0].paths[0] += 1
+        self.s.clear_cache()
+        b = self.s.individual_potential(self.x, 1)
+        nptest.assert_allclose(b[0], self.s[0].potential(self.x, 1))
+        d = np.array([1], np.intc)
+        u = self.s._unit_responses(self.x, d)
+        self.s.dcs = [2, 0, 1]
+        self.assertIs(self.s._unit_responses(self.x, d), u)
+        self.s.append(electrode.PolygonPixelElectrode(paths=[[[0, 0],
+            [1, 0], [0, 1]]]))
+        self.assertEqual(self.s.individual_potential(self.x, 1).shape,
+                (4, 5, 3))
+
+
+class MultipoleCase(unittest.TestCase):
+    def setUp(self):
+        p = np.array([[0, 0], [2, 0], [2.5, 2], [0, 2.]])
+        paths = [p + [3*i, 3*j] for i in range(6) for j in range(6)]
+        self.s = system.System([
+            electrode.PolygonPixelElectrode(paths=paths[::2], dc=1.),
+            electrode.PolygonPixelElectrode(paths=paths[1::2], dc=-.5,
+                cover_nmax=1, cover_height=30.),
+            electrode.PolygonPixelElectrode(paths=paths[1::3], dc=2.),
+            ])
+        self.x = np.random.RandomState(0).rand(20, 3)*[60, 60, 10] + [
+                -20, -20, 5]
+
+    def test_tree(self):
+        points, offsets, index = electrode.pack_polygons(self.s)
+        t = multipole.PolygonTree(points, offsets, leaf_size=4)
+        self.assertEqual(sorted(t.order), list(range(len(index))))
+        weights = np.random.RandomState(1).randn(len(index))
+        for d in range(4):
+            a = t.potential(self.x, index, weights, d, tolerance=0)
+            b = electrode.packed_polygon_potentials(self.x,
+                    points, offsets, index, weights,
+                    np.array([d], np.intc), 0, 50., None)
+            nptest.assert_allclose(a, b, rtol=1e-9, atol=1e-12)
+            a = t.potential(self.x, index, weights, d, tolerance=1e-6)
+            self.assertLess(np.fabs(a - b).max(), 1e-6*np.fabs(b).max())
+            self.assertGreater(np.fabs(a - b).max(), 0)
+
+    def test_empty(self):
+        t = multipole.PolygonTree(np.zeros((0, 2)), [0])
+        nptest.assert_allclose(t.potential(self.x, [], [], 1),
+                np.zeros((1, 20, 3)))
+        s = system.System([electrode.PolygonPixelElectrode(paths=[],
+            dc=1.)], tolerance=1e-3)
+        for d in range(3):
+            nptest.assert_allclose(s.electrical_potential(self.x, "dc", d),
+                    np.zeros((20, 2*d + 1)))
+
+    def test_system(self):
+        for d in range(3):
+            a = self.s.individual_potential(self.x, d)
+            b = self.s.electrical_potential(self.x, "dc", d)
+            self.s.tolerance = 1e-6
+            c = self.s.individual_potential(self.x, d)
+            nptest.assert_allclose(c, a, rtol=0, atol=1e-6*np.fabs(a).max())
+            c = self.s.electrical_potential(self.x, "dc", d)
+            nptest.assert_allclose(c, b, rtol=0, atol=1e-6*np.fabs(b).max())
+            self.s.tolerance = 0.
+
+
+class InstanceCase(unittest.TestCase):
+    def setUp(self):
+        p = np.array([[1, 0], [2, 3], [2, 7], [3, 8],
+            [-2, 8], [-5, 2]])
+        self.cell = electrode.PolygonPixelElectrode(paths=[p])
+        self.offsets = [(i*10., j*12., 0) for i in range(3) for j in range(2)]
+        self.s = system.System([electrode.InstanceElectrode(
+            electrode=self.cell, offset=o, dc=i + 1., name="e%i" % i)
+            for i, o in enumerate(self.offsets)])
+        self.s.append(electrode.PolygonPixelElectrode(paths=[p[::-1]],
+            rf=1.))
+        self.f = system.System([electrode.PolygonPixelElectrode(
+            paths=e.paths, dc=e.dc) for e in self.s[:-1]] + [self.s[-1]])
+        # random points and points commensurate with the lattice
+        self.x = np.r_[np.random.RandomState(0).randn(5, 3) + [0, 3, 5],
+                np.array(self.offsets) + [[1, 2, 3]]]
+
+    def test_paths(self):
+        nptest.assert_allclose(self.s[1].paths[0],
+                self.cell.paths[0] + [0, 12])
+
+    def test_potential(self):
+        for d in range(3):
+            for a, b in zip(self.s, self.f):
+                nptest.assert_allclose(a.potential(self.x, d),
+                        b.potential(self.x, d))
+
+    def test_system(self):
+        for d in range(4):
+            nptest.assert_allclose(self.s.individual_potential(self.x, d),
+                    self.f.individual_potential(self.x, d))
+            nptest.assert_allclose(
+                    self.s.electrical_potential(self.x, "dc", d),
+                    self.f.electrical_potential(self.x, "dc", d))
+        nptest.assert_allclose(self.s.potential(self.x, 2),
+                self.f.potential(self.x, 2))
+
+    def test_close_points(self):
+        # SI scaled, points closer than 1e-9 must stay distinct
+        c = 1e-6
+        cell = electrode.PolygonPixelElectrode(
+                paths=[p*c for p in self.cell.paths])
+        s = system.System([electrode.InstanceElectrode(electrode=cell,
+            offset=np.array(o)*c, dc=1.) for o in self.offsets])
+        f = system.System([electrode.PolygonPixelElectrode(paths=e.paths,
+            dc=1.) for e in s])
+        x = np.array([[1, 2, 3.]])*c + [[0, 0, 0], [1e-10, 0, 0],
+                [0, 3e-10, 0]]
+        for d in range(3):
+            a = s.electrical_potential(x, "dc", d)
+            nptest.assert_allclose(a, f.electrical_potential(x, "dc", d),
+                    rtol=1e-9)
+            self.assertGreater(np.fabs(a[1:] - a[0]).min(axis=1).max(), 0)
+
+
+class TaylorCase(unittest.TestCase):
+    def setUp(self):
+        p = np.array([[1, 0], [2, 3], [2, 7], [3, 8],
+            [-2, 8], [-5, 2]])
+        self.s = system.System([
+            electrode.PolygonPixelElectrode(paths=[p], dc=1., name="a"),
+            electrode.PolygonPixelElectrode(paths=[p[::-1] + [7, 0]],
+                rf=2., name="b"),
+            ])
+        self.x0 = np.array([1, 3, 5.])
+
+    def test_quadrupole(self):
+        # x**2 - z**2
+        e = electrode.TaylorElectrode(origin=(1, 0, 0),
+                derivatives=[[1], [2, 0, 0], [2, 0, 0, 0, 0]])
+        x = np.array([[1, 2, 3], [-1, 0, .5]])
+        nptest.assert_allclose(e.potential(x, 0)[:, 0],
+                x[:, 0]**2 - x[:, 2]**2)
+        nptest.assert_allclose(e.potential(x, 1),
+                2*x*[1, 0, -1])
+        nptest.assert_allclose(e.potential(x, 2),
+                [[2, 0, 0, 0, 0]]*2)
+        nptest.assert_allclose(e.potential(x, 3), np.zeros((2, 7)))
+
+    def test_expand(self):
+        t = self.s.expand(self.x0)
+        self.assertEqual(t.names, self.s.names)
+        nptest.assert_allclose(t.rfs, self.s.rfs)
+        x = self.x0 + np.random.RandomState(0).randn(5, 3)*1e-2
+        for d in range(4):
+            for typ in "dc", "rf":
+                nptest.assert_allclose(
+                    t.electrical_potential(self.x0, typ, d),
+                    self.s.electrical_potential(self.x0, typ, d))
+                a = t.electrical_potential(x, typ, d)
+                b = self.s.electrical_potential(x, typ, d)
+                nptest.assert_allclose(a, b, rtol=0,
+                        atol=1e-2**(5 - d)*np.fabs(b).max())
+        nptest.assert_allclose(t.potential(x, 2), self.s.potential(x, 2),
+                rtol=1e-6)
+
+
+class ThreadsCase(unittest.TestCase):
+    def setUp(self):
+        self.threads = electrode.get_num_threads()
+        p = np.array([[1, 0], [2, 3], [2, 7], [3, 8],
+            [-2, 8], [-5, 2]])
+        self.p = electrode.PolygonPixelElectrode(paths=[p])
+        self.e = self.p.to_points()
+        self.m = electrode.MeshPixelElectrode.from_polygon_system(
+            system.System([self.p]))
+        self.x = np.random.RandomState(0).randn(17, 3) + [0, 3, 5]
+
+    def tearDown(self):
+        electrode.set_num_threads(self.threads)
+
+    def test_threads(self):
+        for ee in self.p, self.e, self.m:
+            for di in range(6):
+                electrode.set_num_threads(1)
+                a = ee.potential(self.x, di)
+                electrode.set_num_threads(4)
+                self.assertEqual(electrode.get_num_threads(), 4)
+                b = ee.potential(self.x, di)
+                nptest.assert_allclose(a, b)
+
 
 if __name__ == "__main__":
     unittest.main()
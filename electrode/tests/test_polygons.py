@@ -20,8 +20,14 @@
 from __future__ import (absolute_import, print_function,
         unicode_literals, division)
 
+import io
 import os
+import gc
+import shutil
+import tempfile
+import warnings
 import unittest
+from multiprocessing.pool import ThreadPool
 
 try:
     import matplotlib as mpl
@@ -36,6 +42,11 @@ from numpy import testing as nptest
 
 from electrode import electrode, system
 
+try:
+    from shapely import geometry
+except ImportError:
+    geometry = None
+
 try:
     from electrode import polygons
 except ImportError:
@@ -91,6 +102,182 @@ class PolygonsCase(unittest.TestCase):
     def test_gaps_union(self):
         g = self.p.gaps_union()
 
+    def test_assign_to_pad(self):
+        r = np.random.RandomState(0)
+        x = r.uniform(0, 10, (200, 2))
+        p = polygons.Polygons(("", geometry.box(a, b, a + 1, b + 1))
+                              for a, b in x)
+        pads = r.uniform(0, 11, (300, 2))
+        free = list(range(len(p)))
+        ref = []
+        for pad, (a, b) in enumerate(pads):
+            for i in free:
+                if geometry.Point(a, b).intersects(p[i][1]):
+                    ref.append((pad, i))
+                    free.remove(i)
+                    break
+        ref.extend((None, i) for i in free)
+        self.assertEqual(list(p.assign_to_pad(pads)), ref)
+
+    def test_tree_union(self):
+        r = np.random.RandomState(0)
+        x = r.uniform(0, 10, (100, 2))
+        p = polygons.Polygons(("", geometry.box(a, b, a + 1, b + 1))
+                              for a, b in x)
+        g = geometry.LineString()
+        for name, poly in p:
+            g = g.union(poly.boundary)
+        self.assertTrue(p.gaps_union().equals(g))
+        acc = geometry.Point()
+        for (name, poly), (name1, poly1) in zip(p, p.remove_overlaps()):
+            self.assertAlmostEqual(
+                poly.difference(acc).symmetric_difference(poly1).area, 0)
+            acc = acc.union(poly)
+
+    def test_pool(self):
+        r = np.random.RandomState(0)
+        x = r.uniform(0, 10, (50, 2))
+        p = polygons.Polygons(("e%i" % i, geometry.box(a, b, a + 1, b + 1))
+                              for i, (a, b) in enumerate(x))
+        pool = ThreadPool(4)
+        for f in (lambda q, **k: q.add_gaps(.1, **k),
+                  lambda q, **k: q.simplify(1e-2, **k),
+                  lambda q, **k: q.unify(**k).filter(**k),
+                  lambda q, **k: q.within(12, **k)):
+            p1, p2 = f(p), f(p, pool=pool)
+            self.assertEqual([n for n, q in p1], [n for n, q in p])
+            self.assertEqual(len(p1), len(p2))
+            for (n1, q1), (n2, q2) in zip(p1, p2):
+                self.assertEqual(n1, n2)
+                self.assertTrue(q1.equals(q2))
+        pool.close()
+
+    def test_read_gds(self):
+        lib = self.p.add_gaps(.1).to_gds(scale=1e-6, gap_layer=(1, 2))
+        from gdsii import library, structure
+        stru = structure.Structure(name=b"other")
+        stru.extend(lib[0])
+        lib.insert(0, stru)
+        fil = io.BytesIO()
+        lib.save(fil)
+        fil.seek(0)
+        pos = []
+        unit, elems = polygons.read_gds(fil, "trap_electrodes",
+                lambda e: getattr(e, "layer", None) == 1,
+                lambda p, s: pos.append(p), progress_step=1000)
+        elems = list(elems)
+        self.assertEqual(unit, lib.physical_unit)
+        fil.seek(0)
+        ref = [e for e in library.Library.load(fil)[1] if e.layer == 1]
+        self.assertEqual(len(elems), len(ref))
+        for a, b in zip(elems, ref):
+            self.assertEqual(type(a), type(b))
+            self.assertEqual(a.data_type, b.data_type)
+            self.assertEqual(a.properties, b.properties)
+            nptest.assert_equal(a.xy, b.xy)
+        self.assertGreater(len(pos), 2)
+        self.assertEqual(pos, sorted(pos))
+        # stops after the (first) selected structure
+        fil.seek(0)
+        del pos[:]
+        unit, elems = polygons.read_gds(
+            fil, progress=lambda p, s: pos.append(p))
+        self.assertEqual(len(list(elems)), len(lib[0]))
+        self.assertLess(pos[-1], len(fil.getvalue())/2 + 100)
+        fil.seek(0)
+        unit, elems = polygons.read_gds(fil, "missing")
+        self.assertRaises(ValueError, list, elems)
+        fil.seek(0)
+        p = polygons.Polygons.from_gds(fil, scale=1e-6,
+                name="trap_electrodes", poly_layers=[(0, 0)], gap_layers=[])
+        self.assertEqual([n for n, q in p], ["rf"])
+        # rounded to 1e-3 database units
+        self.assertAlmostEqual(p[0][1].area, self.p.add_gaps(.1)[0][1].area,
+                               places=2)
+
+    def test_read_gds_name(self):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        fil = os.path.join(d, "trap.gds")
+        lib = self.p.to_gds(scale=1e-6)
+        with open(fil, "wb") as f:
+            lib.save(f)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always", ResourceWarning)
+            unit, elems = polygons.read_gds(fil)
+            self.assertEqual(len(list(elems)), len(lib[0]))
+            unit, elems = polygons.read_gds(fil)
+            next(elems)
+            elems.close()
+            unit, elems = polygons.read_gds(fil, "missing")
+            self.assertRaises(ValueError, list, elems)
+            del elems
+            gc.collect()
+        self.assertEqual([str(i.message) for i in w
+                          if issubclass(i.category, ResourceWarning)], [])
+
+    def test_system_from_gds(self):
+        from gdsii import library, structure, elements
+        lib = library.Library(version=5, name=b"lib", physical_unit=1e-9,
+                              logical_unit=1e-3)
+        sq = np.array([[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]])*1000
+        unit = structure.Structure(name=b"unit")
+        for n, o in ("a", (0, 0)), ("b", (2000, 0)):
+            e = elements.Boundary(layer=0, data_type=0, xy=sq + o)
+            e.properties = [(polygons.Polygons._attr_name, n.encode())]
+            unit.append(e)
+        top = structure.Structure(name=b"top")
+        top.append(elements.Boundary(layer=0, data_type=0,
+                                     xy=sq*[10, 1] + [-5000, -3000]))
+        top.append(elements.ARef(b"unit", 3, 2,
+                                 [(0, 0), (12000, 0), (0, 6000)]))
+        r = elements.SRef(b"unit", [(-1000, 5000)])
+        r.strans, r.angle = 0, 90.
+        top.append(r)
+        # nested translations: instances all the way down
+        pair = structure.Structure(name=b"pair")
+        e = elements.Boundary(layer=0, data_type=0, xy=sq + (0, -2000))
+        e.properties = [(polygons.Polygons._attr_name, b"c")]
+        pair.append(e)
+        pair.append(elements.SRef(b"unit", [(0, 20000)]))
+        for o in (30000, 0), (30000, 10000):
+            top.append(elements.SRef(b"pair", [o]))
+        lib.extend([unit, pair, top])
+        fil = io.BytesIO()
+        lib.save(fil)
+        fil.seek(0)
+        with self.assertLogs("electrode", "WARNING") as log:
+            s = polygons.system_from_gds(fil, scale=1e-6)
+        self.assertEqual(len(log.output), 1)
+        self.assertIn("reference 6 to unit", log.output[0])
+        self.assertEqual(s.names, ["top"] + [
+            "%s_%i" % (n, i) for i in range(7) for n in "ab"] + [
+            "c_0", "a_7", "b_7", "c_1", "a_8", "b_8"])
+        self.assertIs(s[1].electrode, s[3].electrode)
+        nptest.assert_allclose(s["a_4"].offset, [4, 3, 0])
+        self.assertIs(s["a_8"].electrode, s["a_0"].electrode)
+        self.assertIs(s["c_1"].electrode, s["c_0"].electrode)
+        nptest.assert_allclose(s["c_1"].offset, [30, 10, 0])
+        nptest.assert_allclose(s["a_7"].offset, [30, 20, 0])
+        nptest.assert_allclose(s["b_8"].offset, [30, 30, 0])
+        # rotated by 90 degrees: flattened into separate electrodes
+        self.assertIsInstance(s["b_6"], electrode.PolygonPixelElectrode)
+        self.assertEqual(len(s["b_6"].paths), 1)
+        nptest.assert_allclose(s["b_6"].paths[0],
+                [[-1, 7], [-1, 8], [-2, 8], [-2, 7]])
+        nptest.assert_allclose(s["a_6"].paths[0],
+                [[-1, 5], [-1, 6], [-2, 6], [-2, 5]])
+        fil.seek(0)
+        self.assertRaises(ValueError, polygons.system_from_gds, fil,
+                          name="missing")
+        f = system.System(electrode.PolygonPixelElectrode(paths=e.paths)
+                          for e in s)
+        x = np.random.RandomState(0).randn(7, 3) + [2, 2, 1]
+        x = np.concatenate([x, x + [30, 20, 0]])
+        for d in range(3):
+            nptest.assert_allclose(s.individual_potential(x, d),
+                                   f.individual_potential(x, d))
+
 
 fil1 = "test.gds"
 
@@ -0,0 +1,72 @@
+# -*- coding: utf8 -*-
+#
+#   electrode.py: numeric tools for Paul traps
+#
+#   Copyright (C) 2011-2012 Robert Jordens <jordens@phys.ethz.ch>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, print_function,
+        unicode_literals, division)
+
+import unittest
+
+import numpy as np
+from numpy import testing as nptest
+
+from electrode.saddle import rfo
+
+
+class RfoCase(unittest.TestCase):
+    # cerjan-miller surface, saddle at (0, 0) and (+-1, 1), minimum at
+    # (0, 0)
+    def f(self, x):
+        x, y = x[..., 0], x[..., 1]
+        return (1 - y)*x**2*np.exp(-x**2) + y**2/2
+
+    def g(self, x):
+        x, y = x[..., 0], x[..., 1]
+        return np.array([2*x*(1 - y)*(1 - x**2)*np.exp(-x**2),
+            y - x**2*np.exp(-x**2)]).T
+
+    def test_single(self):
+        calls, steps = [], []
+        def f(x):
+            calls.append(x)
+            return self.f(x)
+        def cb(x, f, g, h):
+            steps.append(x)
+        x, p, ret = rfo(f, self.g, [.9, .8], dx_max=.2, xtol=1e-8,
+                ftol=1e-10, cb=cb)
+        self.assertIn(ret, ("xtol", "ftol"))
+        nptest.assert_allclose(self.g(x), 0, atol=1e-6)
+        # one evaluation per step
+        self.assertEqual(len(calls), len(steps))
+
+    def test_batched(self):
+        x0 = np.array([[.9, .8], [-.9, .8], [1.1, 1.2]])
+        x, p, ret = rfo(self.f, self.g, x0, dx_max=.2, xtol=1e-8,
+                ftol=1e-10)
+        self.assertEqual(x.shape, (3, 2))
+        self.assertTrue(np.all((ret == "xtol") | (ret == "ftol")))
+        nptest.assert_allclose(self.g(x), 0, atol=1e-6)
+        nptest.assert_allclose(p, self.f(x))
+        for xi, x0i in zip(x, x0):
+            xs, ps, rets = rfo(self.f, self.g, x0i, dx_max=.2, xtol=1e-8,
+                    ftol=1e-10)
+            nptest.assert_allclose(xs, xi)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -21,6 +21,7 @@ from __future__ import (absolute_import, print_function,
         unicode_literals, division)
 
 import unittest
+from multiprocessing.pool import ThreadPool
 import logging
 
 try:
@@ -30,7 +31,7 @@ try:
 except ImportError:
     plt = None
 
-from scipy import constants as ct
+from scipy import constants as ct, integrate
 import numpy as np
 from numpy import testing as nptest
 
@@ -73,6 +74,7 @@ class ThreefoldOptimizeCase(unittest.TestCase):
                 ct.append(pattern_constraints.PotentialObjective(derivative=i,
                         x=x, rotation=r, value=2**(-1/3.)))
         s.rfs, self.c = s.optimize(ct, verbose=False)
+        self.ct = ct
         self.h = h
         
         self.x0 = np.array([d/3**.5, 0, h])
@@ -118,6 +120,48 @@ class ThreefoldOptimizeCase(unittest.TestCase):
         nptest.assert_almost_equal(c[0]/self.c,
             2**(-1/3.)*np.eye(3)*[1, 1, -2])
 
+    def test_backends(self):
+        self.get()
+        for backend in "lp", "scipy":
+            p, c = self.s.optimize(self.ct, verbose=False, backend=backend)
+            nptest.assert_allclose(c, self.c, rtol=1e-5)
+            self.assertTrue(np.all(p >= -1e-7) and np.all(p <= 1+1e-7))
+            for ci in self.ct[1:]:
+                nptest.assert_allclose(np.dot(ci.get(self.s, None), p),
+                        c*ci.value, atol=1e-6)
+        p1, c1 = self.s.optimize(self.ct, verbose=False, backend="lp",
+                x0=.9*p)
+        nptest.assert_allclose(c1, c, rtol=1e-5)
+
+    def test_voltage_derivative(self):
+        self.get()
+        ct = self.ct + [pattern_constraints.VoltageDerivativeConstraint(1,
+            max=.8)]
+        p, c = self.s.optimize(ct, verbose=False, backend="lp")
+        self.assertTrue(np.all(np.fabs(np.diff(p)) <= .8 + 1e-7))
+        p1, c1 = self.s.optimize(ct, verbose=False)
+        nptest.assert_allclose(c, c1, rtol=1e-4)
+
+    def test_voltage_derivative_weight(self):
+        self.get()
+        d = []
+        for weight in 0, 1e-3, 1e-2:
+            ct = self.ct + [pattern_constraints.VoltageDerivativeConstraint(
+                1, weight=weight)]
+            p, c = self.s.optimize(ct, verbose=False)
+            for backend in "lp", "scipy":
+                p1, c1 = self.s.optimize(ct, verbose=False, backend=backend)
+                nptest.assert_allclose(c1, c, rtol=1e-5)
+                self.assertTrue(np.all(p1 >= -1e-7) and np.all(p1 <= 1+1e-7))
+                for ci in self.ct[1:]:
+                    nptest.assert_allclose(np.dot(ci.get(self.s, None), p1),
+                            c1*ci.value, atol=1e-6)
+                nptest.assert_allclose(np.fabs(np.diff(p1)).sum(),
+                        np.fabs(np.diff(p)).sum(), rtol=1e-4)
+            d.append(np.fabs(np.diff(p)).sum())
+        self.assertLess(d[1], d[0])
+        self.assertLess(d[2], d[1])
+
     def test_main_saddle(self):
         self.get()
         xs, xsp = self.s.saddle((0, 0, .5), axis=(0, 1, 2,))
@@ -165,6 +209,14 @@ class FiveWireCase(unittest.TestCase):
         nptest.assert_almost_equal(xs, [0, -.125, 1.8], decimal=3)
         nptest.assert_almost_equal(xsp, .0036, decimal=4)
 
+    def test_minima_saddles(self):
+        x0 = np.random.RandomState(0).rand(20, 3)*[0, .3, 1] + [0, -.15, .7]
+        x = self.s.minima(x0, axis=(1, 2))
+        nptest.assert_almost_equal(x, [[0, 0, 1.]], decimal=3)
+        xs, xsp = self.s.saddles(x0 + [0, 0, .5], axis=(1, 2))
+        nptest.assert_almost_equal(xs, [[0, -.125, 1.8]], decimal=3)
+        nptest.assert_almost_equal(xsp, [.0036], decimal=4)
+
     def test_scale(self):
         q = 1*ct.elementary_charge
         u = 100.
@@ -331,6 +383,17 @@ class MagtrapCase(unittest.TestCase):
         self.assertEqual(vectors.shape, (len(derivs), len(eln)))
         return vectors, s, derivs
 
+    @unittest.skipIf(system.cvxopt is None, "no cvxopt")
+    def test_shims_batched(self):
+        vectors, s, derivs = self.test_shims()
+        x = self.x0
+        v1 = s.shims([(x, None, d) for d in derivs], backend="modeling")
+        nptest.assert_allclose(vectors, v1, rtol=1e-4, atol=1e-4)
+        pool = ThreadPool(2)
+        v2 = s.shims([(x, None, d) for d in derivs], pool=pool)
+        pool.close()
+        nptest.assert_allclose(vectors, v2)
+
     @unittest.skipIf(system.cvxopt is None, "no cvxopt")
     def test_shims_shift(self):
         vectors, s, derivs = self.test_shims()
@@ -346,36 +409,52 @@ class MagtrapCase(unittest.TestCase):
                 else:
                     nptest.assert_allclose(p, 0, atol=1e-4)
 
-    @unittest.skip("ions() broken")
+    def confine(self):
+        for n in "c1 c3 c4 c6".split():
+            self.s[n].dc = .1
+        for n in "c2 c5".split():
+            self.s[n].dc = -.1
+        x = self.s.minimum(self.x0)
+        return x, self.s.modes(x)[0]
+
     def test_ions_simple(self):
-        vectors, s, derivs = self.test_shims()
-        s.dcs = .1*vectors[3]
-        x = self.x0
+        x, curves = self.confine()
         n = 3
-        xi = x[0]+np.random.randn(n)[:, None]*1e-3
-        qi = np.ones((n))*1e-3
-        xis, ois, vis = self.s.ions(xi, qi)
-        nptest.assert_almost_equal(
-                xis[np.argmin(np.abs(xis)[:, 0])], x, 3)
+        xi = x + np.random.RandomState(0).randn(n, 3)*1e-2
+        xis, ois, vis = self.s.ions(xi, coulomb=1e-3*curves[0])
+        xis = xis[np.argsort(xis[:, 0])]
+        nptest.assert_almost_equal(xis[1], x, 3)
+        nptest.assert_almost_equal(xis[:, 1:], [x[1:]]*n, 3)
+        nptest.assert_almost_equal(xis[0, 0] + xis[2, 0], 2*x[0], 3)
 
-    @unittest.skip("ions() broken")
     def test_ions_modes(self):
-        """fails sometimes due to near degeneracy"""
-        vectors, s, derivs = self.test_shims()
-        s.dcs = .1*vectors[3]
-        x = self.x0
+        x, (cx, cy, cz) = self.confine()
         n = 2
-        xi = x+np.random.randn(n)[:, None]*1e-3
-        qi = np.ones((n))*1e-3
-        xis, ois, vis = self.s.ions(xi, qi)
-        nptest.assert_almost_equal(
-                ois, [.01, .03, .085, .095, .105, .128], 2)
+        xi = x + np.random.RandomState(0).randn(n, 3)*1e-2
+        xis, ois, vis = self.s.ions(xi, coulomb=1e-3*cx)
+        # com, stretch and rocking modes
+        nptest.assert_allclose(ois,
+                [cx, 3*cx, cy - cx, cy, cz - cx, cz], rtol=.05)
+        nptest.assert_allclose(np.fabs(vis[:, :, 0]),
+                [[2**-.5, 0, 0]]*n, atol=1e-2)
+
+    def test_ions_fail(self):
+        x, curves = self.confine()
+        xi = x + np.random.RandomState(0).randn(3, 3)*1e-2
+        self.assertRaises(ValueError, self.s.ions, xi,
+                coulomb=1e-3*curves[0], options=dict(maxiter=1))
 
     def test_analyze_static(self):
         self.s.analyze_static(self.x0, log=logging.DEBUG)
         s = list(self.s.analyze_static(self.x0))
         self.assertEqual(len(s), 36)
 
+    def test_analyze_static_ions(self):
+        x, curves = self.confine()
+        s = list(self.s.analyze_static(x, ions=2))
+        self.assertEqual(len(s), 36 + 2 + 6)
+        self.assertEqual(s[36], "2 ion modes:")
+
 
 class RingtrapCase(unittest.TestCase):
     def ringtrap(self):
@@ -437,6 +516,82 @@ class RingtrapCase(unittest.TestCase):
 
 
 
+class HarmonicCase(unittest.TestCase):
+    def setUp(self):
+        # axial curvature 2, radial 8 - 1 = 7
+        self.s = system.System([
+            electrode.TaylorElectrode(derivatives=[[0], [0, 0, 0],
+                [-1, 0, 0, -1, 0]], dc=1.),
+            electrode.TaylorElectrode(derivatives=[[0], [0, 0, 0],
+                [2, 0, 0, -2, 0]], rf=1.),
+            ])
+
+    def test_two_ions(self):
+        x, ew, ev = self.s.ions([[.01, 0, -1], [0, .02, 1]])
+        nptest.assert_allclose(x, [[0, 0, -.5], [0, 0, .5]], atol=1e-6)
+        # com, rocking, stretch
+        nptest.assert_allclose(ew, [2, 5, 5, 6, 7, 7], rtol=1e-5)
+        nptest.assert_allclose(np.fabs(ev[:, 2, 0]), np.sqrt(.5),
+                rtol=1e-5)
+
+    def test_species(self):
+        # the heavier ion feels a weaker pseudopotential
+        x, ew, ev = self.s.ions([[0, 0, -1], [0, 0, 1]], m=[1, 2])
+        nptest.assert_allclose(x[:, 2], [-.5, .5], rtol=1e-5)
+        # trap plus coulomb at distance 1 (radial -1, axial 2)
+        h = np.diag([7 - 1, 7 - 1, 2 + 2, 3 - 1, 3 - 1, 2 + 2.])
+        h[[0, 1, 2], [3, 4, 5]] = h[[3, 4, 5], [0, 1, 2]] = [1, 1, -2]
+        w = 1/np.sqrt([1, 1, 1, 2, 2, 2])
+        nptest.assert_allclose(ew, np.linalg.eigvalsh(h*w*w[:, None]),
+                rtol=1e-5)
+
+    def test_chain(self):
+        n = 10
+        self.s[1].rf = 4. # radial 127
+        x0 = np.c_[np.zeros((n, 2)), np.linspace(-3, 3, n)]
+        x, ew, ev = self.s.ions(x0 + np.random.RandomState(0).randn(n,
+            3)*1e-3)
+        nptest.assert_allclose(x[:, :2], 0, atol=1e-6)
+        nptest.assert_allclose(x[:, 2], -x[::-1, 2], atol=1e-6)
+        # axial com and breathing modes are independent of n
+        nptest.assert_allclose(ew[:2], [2, 6], rtol=1e-5)
+
+    def test_trajectories(self):
+        self.s[0].dc, self.s[1].rf = .001, .05
+        x0 = np.array([[1, 0, 0], [0, .5, .3], [.2, -.1, 1.]])
+        t, x, v = self.s.trajectories(x0, np.zeros((3, 3)), dt=.01,
+                t1=50, nsteps=100)
+        self.assertEqual(x.shape, (51, 3, 3))
+
+        def f(t, y):
+            dc, rf = (self.s.electrical_potential(y[:9].reshape(3, 3),
+                typ, 1) for typ in ("dc", "rf"))
+            return np.r_[y[9:], (-dc - 2*np.cos(t)*rf).ravel()]
+        r = integrate.solve_ivp(f, (0, 50), np.r_[x0.ravel(),
+            np.zeros(9)], rtol=1e-10, atol=1e-12, t_eval=t)
+        nptest.assert_allclose(x, r.y[:9].T.reshape(-1, 3, 3), atol=1e-4)
+        nptest.assert_allclose(v, r.y[9:].T.reshape(-1, 3, 3), atol=1e-4)
+
+    def test_trajectories_expansion(self):
+        self.s[0].dc, self.s[1].rf = .001, .05
+        x0 = np.array([[1, 0, 0], [0, .5, .3], [.2, -.1, 1.]])
+        a = self.s.trajectories(x0, np.zeros((3, 3)), dt=.01, t1=10,
+                nsteps=100)
+        b = self.s.trajectories(x0, np.zeros((3, 3)), dt=.01, t1=10,
+                nsteps=100, radius=.1, order=2)
+        for ai, bi in zip(a, b):
+            nptest.assert_allclose(ai, bi, rtol=1e-9, atol=1e-12)
+
+    def test_trajectories_coulomb(self):
+        # two ions at their equilibrium in a static trap stay there
+        self.s[1].rf = 0.
+        x0 = [[0, 0, -.5], [0, 0, .5]]
+        t, x, v = self.s.trajectories(x0, np.zeros((2, 3)), dt=.01,
+                t1=10, nsteps=10, coulomb=1.)
+        nptest.assert_allclose(x, np.array(x0)[None].repeat(len(t), 0),
+                atol=1e-12)
+
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -92,8 +92,10 @@ http://dx.doi.org/10.1088/0143-0807/22/1/304
                          ],
                     extra_compile_args=[
                         "-ffast-math", # improves expressions
+                        "-fopenmp", # prange() over points
                         #"-Wa,-adhlns=cexprssions.lst", # for amusement
                         ],
+                    extra_link_args=["-fopenmp"],
                     include_dirs=[numpy.get_include()]),
             ],
         cmdclass = {"build_ext": build_ext},